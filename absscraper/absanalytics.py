@@ -0,0 +1,94 @@
+import argparse
+import sys
+from time import perf_counter
+from config import defaults
+from helpers import ats, ok
+from metrics import metrics
+from profiling import profiler, add_profile_arguments
+
+
+class AbsAnalytics(object):
+    """
+    App class computing delinquency transitions and prepayment and loss curves of auto loan pools from the
+    panel. pandas, numpy and database models are imported by methods that use them, so that argument
+    validation starts without loading them.
+    """
+    def __init__(self, ind_trusts=[], parquet=None):
+        """
+        :param ind_trusts: trust ciks, all trusts with parsed auto loan filings if empty
+        :param parquet: folder with Parquet files holding autoloans table, database is used if None
+        """
+        self.ind_trusts = ind_trusts
+        self.parquet = parquet
+
+    def dispatch(self):
+        """
+        Compute and store results of selected trusts.
+        :return: None
+        """
+        from assets import AssetDb, AssetFiling
+        # Optional dependency, only needed for analytics
+        from analytics import PanelAnalytics
+        AssetDb().setup()
+        with AssetDb.get_session() as session:
+            q = session.query(AssetFiling.trustCik) \
+                .filter(AssetFiling.assetType == 'autoloan') \
+                .filter(AssetFiling.isComplete == True)
+            if len(self.ind_trusts):
+                q = q.filter(AssetFiling.trustCik.in_(self.ind_trusts))
+            trusts = sorted({r.trustCik for r in q.distinct()})
+        if len(trusts) == 0:
+            print(f'{ats()} No parsed auto loan filings. Aborting.')
+            sys.exit(1)
+
+        analytics = PanelAnalytics(self.parquet)
+        with profiler.stage('analytics'):
+            for counter, trust_cik in enumerate(trusts, 1):
+                start = perf_counter()
+                with AssetDb.get_session() as session:
+                    records = analytics.run(session, trust_cik)
+                metrics.observe('analytics_seconds', perf_counter() - start)
+                metrics.inc('analytics_records', records)
+                metrics.inc('analytics_trusts')
+                print(f'{ats()} Trust {trust_cik} done ({counter}/{len(trusts)}, {records} records, '
+                      f'{perf_counter() - start:.1f} s).')
+
+        print(f"{ats()} Finished. Good job!")
+        ok()
+
+
+def main():
+
+    ap = argparse.ArgumentParser(description="Roll rates, prepayment and loss curves of auto loan pools.")
+
+    ap.add_argument("-t", "--trust", required=False, type=str,
+                    help="trust ciks separated by ':'")
+    ap.add_argument("-p", "--parquet", required=False, type=str, default=None,
+                    help="read panel from Parquet files in this folder instead of database")
+    ap.add_argument("--metrics", required=False, type=str, default=defaults['metrics_folder'],
+                    help="folder for run metrics in json and Prometheus textfile formats")
+    add_profile_arguments(ap)
+
+    args = vars(ap.parse_args())
+
+    if args['profile_mode'] not in profiler.modes:
+        print('Unknown profile mode:', args['profile_mode'])
+        ap.print_help()
+        sys.exit(2)
+    profiler.configure(args['profile'], args['profile_mode'], args['profile_memory'])
+
+    ind_trusts = []
+    if args['trust'] is not None:
+        ind_trusts = list(map(lambda x: int(x), args['trust'].split(":")))
+
+    abs_analytics = AbsAnalytics(ind_trusts, args['parquet'])
+    metrics.reset('absanalytics')
+    try:
+        abs_analytics.dispatch()
+    finally:
+        if args['metrics']:
+            metrics.export(args['metrics'])
+
+
+if __name__ == '__main__':
+    main()
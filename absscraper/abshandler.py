@@ -1,26 +1,43 @@
 import argparse
 import sys
-from sqlalchemy import case
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import defaults
 from helpers import ats, ok
-from assets import *
+from metrics import metrics
+from profiling import profiler, add_profile_arguments
 
 
 class AbsHandler(object):
     """
-    App class for abs handler.
+    App class for abs handler. SQLAlchemy and database models are imported by methods that use them,
+    so that argument validation starts without loading them.
     """
-    def __init__(self, company, rebuild=False, quick=False, ind_trusts=[], ind_filings=[]):
+    def __init__(self, company, rebuild=False, quick=False, ind_trusts=[], ind_filings=[], incremental=False,
+                 workers=1, buckets=1, retry_failed=False, engine='sql', parquet=None):
         self.rebuild = rebuild
         self.quick = quick
+        # Retried partitions are merged into existing records
+        self.incremental = incremental or retry_failed
+        self.workers = workers
+        self.buckets = buckets
+        self.retry_failed = retry_failed
         self.ind_trusts = ind_trusts
         self.ind_filings = ind_filings
         self.company = company
+        self.engine = engine
+        self.flattener = None
+        if engine == 'pandas':
+            # Optional dependency, only needed for this engine
+            from vectorized import FrameFlattener
+            self.flattener = FrameFlattener(parquet)
 
     def dispatch(self):
         """
         Direct logic flow depending on passed command-line arguments.
         :return: None
         """
+        from assets import AssetDb, AssetFiling, AutoloanFlat, FlatPartition, PoolMonthly
 
         if self.rebuild:
             answer = input("You sure you want to reprocess? [yes/No]? ")
@@ -31,11 +48,20 @@ class AbsHandler(object):
                 except:
                     pass
                 db.setup_table(AutoloanFlat.__tablename__)
+                # All filings have to be folded into flat and monthly tables again, and all partitions rerun
+                with AssetDb.get_session() as session:
+                    session.query(PoolMonthly).delete(synchronize_session=False)
+                    session.query(FlatPartition).delete(synchronize_session=False)
+                    session.query(AssetFiling).update({AssetFiling.isFlattened: False, AssetFiling.isPooled: False},
+                                                      synchronize_session=False)
                 print(f"{ats()} Flat table cleared...")
             else:
                 print(f"{ats()} Aborting...")
                 sys.exit(1)
 
+        # Create missing tables
+        AssetDb().setup()
+
         self.process()
 
         print(f"{ats()} Finished. Good job!")
@@ -43,110 +69,389 @@ class AbsHandler(object):
 
     def process(self):
         """
-        Process raw auto loan data and put it into a "flat" table.
+        Process raw auto loan data and put it into a "flat" table. Work is split into partitions
+        by trust (and by loan id modulo if several buckets are used) processed by a pool of workers.
         :return: None
         """
+        from assets import AssetDb, AssetFiling, FlatPartition
         with AssetDb.get_session() as session:
 
             print(f'{ats()} Querying database...')
-            # Build subquery with different filters depending on passed arguments
-            if len(self.ind_filings):
-                qs = session.query(Autoloan, AssetFiling.trustCik, AssetFiling.trustName, AssetFiling.dateFiling) \
-                    .outerjoin(AssetFiling, Autoloan.filingAccNo == AssetFiling.accNo) \
-                    .filter(AssetFiling.accNo.in_(self.ind_filings)).subquery()
-            elif len(self.ind_trusts):
-                qs = session.query(Autoloan, AssetFiling.trustCik, AssetFiling.trustName, AssetFiling.dateFiling) \
-                    .outerjoin(AssetFiling, Autoloan.filingAccNo == AssetFiling.accNo) \
-                    .filter(AssetFiling.trustCik.in_(self.ind_trusts)).subquery()
-            elif self.company:
-                qs = session.query(Autoloan, AssetFiling.trustCik, AssetFiling.trustName, AssetFiling.dateFiling) \
-                    .outerjoin(AssetFiling, Autoloan.filingAccNo == AssetFiling.accNo) \
-                    .filter(AssetFiling.trustName.like(f'%{self.company}%')).subquery()
-            # Build query
-            q = session.query(
-                func.concat(qs.c.trustCik, "_", qs.c.assetNumber).label('trustAssetNumber'),
-                func.min(qs.c.dateFiling).label('dateFirstFiling'),
-                func.any_value(qs.c.trustCik).label('trustCik'),
-                func.any_value(qs.c.assetNumber).label('assetNumber'),
-                func.any_value(qs.c.originationDate).label('originationDate'),
-                func.any_value(qs.c.originalLoanAmount).label('originalLoanAmount'),
-                func.any_value(qs.c.originalLoanTerm).label('originalLoanTerm'),
-                func.any_value(qs.c.loanMaturityDate).label('loanMaturityDate'),
-                func.any_value(qs.c.originalInterestRatePercentage).label('originalInterestRatePercentage'),
-                func.any_value(qs.c.underwritingIndicator).label('underwritingIndicator'),
-                func.any_value(qs.c.gracePeriodNumber).label('gracePeriodNumber'),
-                func.any_value(qs.c.subvented).label('subvented'),
-                func.any_value(qs.c.vehicleManufacturerName).label('vehicleManufacturerName'),
-                func.any_value(qs.c.vehicleModelName).label('vehicleModelName'),
-                func.any_value(qs.c.vehicleNewUsedCode).label('vehicleNewUsedCode'),
-                func.any_value(qs.c.vehicleModelYear).label('vehicleModelYear'),
-                func.any_value(qs.c.vehicleTypeCode).label('vehicleTypeCode'),
-                func.any_value(qs.c.vehicleValueAmount).label('vehicleValueAmount'),
-                func.any_value(qs.c.obligorCreditScore).label('obligorCreditScore'),
-                func.any_value(qs.c.obligorIncomeVerificationLevelCode) \
-                    .label('obligorIncomeVerificationLevelCode'),
-                func.any_value(qs.c.obligorEmploymentVerificationCode) \
-                    .label('obligorEmploymentVerificationCode'),
-                func.any_value(qs.c.coObligorIndicator).label('coObligorIndicator'),
-                func.any_value(qs.c.paymentToIncomePercentage).label('paymentToIncomePercentage'),
-                func.any_value(qs.c.obligorGeographicLocation).label('obligorGeographicLocation'),
-                func.min(qs.c.zeroBalanceEffectiveDate).label('zeroBalanceEffectiveDate'),
-                func.min(qs.c.zeroBalanceCode).label('zeroBalanceCode'),
-                func.min(case(
-                    [(qs.c.currentDelinquencyStatus > 30, qs.c.reportingPeriodEndingDate)],
-                    else_=None
-                    )).label('delinquency30Days'),
-                func.min(case(
-                    [(qs.c.currentDelinquencyStatus > 90, qs.c.reportingPeriodEndingDate)],
-                    else_=None
-                    )).label('delinquency90Days'),
-                func.max(qs.c.repossessedIndicator).label('repossessedIndicator'),
-                func.min(case(
-                    [(qs.c.repossessedIndicator > 0, qs.c.reportingPeriodEndingDate)],
-                    else_=None
-                    )).label('repossessedDate'),
-                ) \
-                .group_by('trustAssetNumber') \
-                .order_by('originationDate')
-
-            if self.quick:
-                # Do quick insert using from_select (whole query result is appended to existing table)
-                table = AssetBase.metadata.tables[AutoloanFlat.__tablename__]
-                session.execute(table.insert().from_select(names=table.columns._data.keys(), select=q))
-                print(f'{ats()} Results received! Done quick insert.')
+            if self.retry_failed:
+                # Rerun partitions that failed previously, folding in filings that are still pending
+                failed = session.query(FlatPartition).filter(FlatPartition.status == 'failed').all()
+                trusts = {}
+                for partition in failed:
+                    fq = session.query(AssetFiling.accNo) \
+                        .filter(AssetFiling.trustCik == partition.trustCik) \
+                        .filter(AssetFiling.isComplete == True) \
+                        .filter(AssetFiling.isFlattened == False)
+                    trusts[partition.trustCik] = [r.accNo for r in fq]
+                partitions = [(p.trustCik, p.bucket, p.buckets) for p in failed if len(trusts[p.trustCik])]
             else:
-                # Go line-by-line and insert results one-by-one (slow), but necessary for update
-                field_names = [c['name'] for c in q.column_descriptions]
-                loan_counter = 0
-                for row in q:
-                    # Display message only when results received
-                    if loan_counter == 0:
-                        print(f'{ats()} Results received! Start processing...')
-
-                    # Build dict of field-value pairs
-                    row_d = {f: v for f, v in zip(field_names, row)}
-                    # Construct unique loan identifier (string)
-                    trustAssetNumber = str(row.trustCik) + "_" + str(row.assetNumber)
-
-                    # Retrieve object from db
-                    flatloan = session.query(AutoloanFlat).get(trustAssetNumber)
-                    if flatloan is None:
-                        # Create new object if record does not exist
-                        flatloan = AutoloanFlat(trustAssetNumber=trustAssetNumber)
-                        for field, value in row_d.items():
-                            setattr(flatloan, field, value)
-                        session.add(flatloan)
-                    else:
-                        # Create new object if record does not exist
-                        for field, value in row_d.items():
-                            # Only update field if they are empty
-                            if field in flatloan.updatable_fields:
-                                if getattr(flatloan, field) is None:
-                                    setattr(flatloan, field, value)
-
-                    loan_counter += 1
-                    print(f'Processed {loan_counter} records...', end="\r")
-                print("")
+                # Select filings to process depending on passed arguments
+                fq = session.query(AssetFiling.accNo, AssetFiling.trustCik).filter(self.filing_filter())
+                if self.incremental:
+                    # Only take fully parsed filings not yet folded into flat table
+                    fq = fq.filter(AssetFiling.isComplete == True).filter(AssetFiling.isFlattened == False)
+                trusts = {}
+                for r in fq:
+                    trusts.setdefault(r.trustCik, []).append(r.accNo)
+                partitions = [(trust_cik, bucket, self.buckets) for trust_cik in sorted(trusts)
+                              for bucket in range(self.buckets)]
+            if len(partitions) == 0:
+                print(f'{ats()} No new filings to process.')
+                return
+            print(f'{ats()} Processing {sum(len(a) for a in trusts.values())} filing(s) '
+                  f'in {len(partitions)} partition(s)...')
+            # Register partitions
+            if not self.retry_failed:
+                session.query(FlatPartition).filter(FlatPartition.trustCik.in_(list(trusts))) \
+                    .delete(synchronize_session=False)
+            for trust_cik, bucket, buckets in partitions:
+                session.merge(FlatPartition(trustCik=trust_cik, bucket=bucket, buckets=buckets, status='pending'))
+
+        # Run partitions on worker pool
+        done_counter = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.process_partition, p[0], p[1], p[2], trusts[p[0]]): p
+                       for p in partitions}
+            for future in as_completed(futures):
+                trust_cik, bucket, buckets = futures[future]
+                done_counter += 1
+                if future.result():
+                    print(f'{ats()} Partition {trust_cik}/{bucket} done ({done_counter}/{len(partitions)}).')
+                else:
+                    print(f'{ats()} Partition {trust_cik}/{bucket} failed ({done_counter}/{len(partitions)}).')
+
+        with AssetDb.get_session() as session:
+            # Remember filings of trusts with all partitions folded into flat table
+            failed_trusts = {r.trustCik for r in session.query(FlatPartition.trustCik)
+                             .filter(FlatPartition.status != 'done')}
+            for trust_cik, acc_nos in trusts.items():
+                if trust_cik in failed_trusts:
+                    continue
+                session.query(AssetFiling) \
+                    .filter(AssetFiling.accNo.in_(acc_nos)) \
+                    .filter(AssetFiling.isComplete == True) \
+                    .update({AssetFiling.isFlattened: True}, synchronize_session=False)
+        if len(failed_trusts):
+            print(f'{ats()} Some partitions failed. Rerun with --retry-failed to process them.')
+
+        with profiler.stage('pool'):
+            self.refresh_pool(trusts)
+
+    def process_partition(self, trust_cik, bucket, buckets, acc_nos):
+        """
+        Aggregate data of one partition and put it into flat table (runs in worker thread).
+        :param trust_cik: trust cik
+        :param bucket: loan id bucket
+        :param buckets: total number of buckets per trust
+        :param acc_nos: accession numbers of trust's filings to process
+        :return: True if successful
+        """
+        from assets import AssetDb, AssetBase, AutoloanFlat
+        self.set_partition_status(trust_cik, bucket, 'running')
+        start = perf_counter()
+        try:
+            with profiler.stage('flatten'), AssetDb.get_session() as session:
+                if self.flattener is not None:
+                    q = self.frame_query(session, acc_nos, bucket, buckets)
+                else:
+                    q = self.aggregate_query(session, acc_nos, bucket, buckets)
+                if self.quick and not self.retry_failed:
+                    # Do quick insert using from_select (whole query result is appended to existing table)
+                    table = AssetBase.metadata.tables[AutoloanFlat.__tablename__]
+                    session.execute(table.insert().from_select(names=table.columns._data.keys(), select=q))
+                else:
+                    # Insert new records and update existing ones in one set-based operation
+                    self.upsert(session, q)
+        except Exception as e:
+            error = str(e).splitlines()[0]
+            print(f'{ats()} Partition {trust_cik}/{bucket} error: {error}')
+            self.set_partition_status(trust_cik, bucket, 'failed', error)
+            metrics.inc('partitions_failed')
+            return False
+        metrics.observe('flatten_seconds', perf_counter() - start)
+        metrics.inc('partitions_done')
+        self.set_partition_status(trust_cik, bucket, 'done')
+        return True
+
+    @staticmethod
+    def set_partition_status(trust_cik, bucket, status, error=None):
+        """
+        Update status of partition in db.
+        :param trust_cik: trust cik
+        :param bucket: loan id bucket
+        :param status: pending, running, done or failed
+        :param error: error message for failed partitions
+        :return: None
+        """
+        from assets import AssetDb, FlatPartition
+        with AssetDb.get_session() as session:
+            partition = session.query(FlatPartition).get((trust_cik, bucket))
+            partition.status = status
+            partition.error = error[:255] if error else None
+            if status == 'failed':
+                partition.attempts = (partition.attempts or 0) + 1
+
+    def aggregate_query(self, session, acc_nos, bucket=0, buckets=1):
+        """
+        Build query aggregating panel data into flat records.
+        :param session: database session
+        :param acc_nos: accession numbers of filings to aggregate
+        :param bucket: loan id bucket
+        :param buckets: total number of buckets, 1 for no bucketing
+        :return: query with columns of flat table
+        """
+        from sqlalchemy import func, case
+        from assets import AssetFiling, Autoloan, AutoloanFlat, decoded_query, period_filter, record_fields
+        from sqlcompat import any_value, trust_asset_key
+        # Build subquery with panel and static fields used in flat table (dictionary-encoded values are decoded)
+        fields = [c.key for c in AutoloanFlat.__table__.columns if c.key in record_fields(Autoloan)] + \
+                 ['reportingPeriodEndingDate', 'currentDelinquencyStatus']
+        qs = decoded_query(session, Autoloan, fields, AssetFiling.trustCik, AssetFiling.trustName, AssetFiling.dateFiling) \
+            .outerjoin(AssetFiling, Autoloan.filingAccNo == AssetFiling.accNo) \
+            .filter(AssetFiling.accNo.in_(acc_nos)) \
+            .filter(period_filter(session, Autoloan.reportingPeriodEndingDate, acc_nos))
+        if buckets > 1:
+            qs = qs.filter(Autoloan.loanId % buckets == bucket)
+        qs = qs.subquery()
+        # Build query
+        q = session.query(
+            qs.c.loanId.label('loanId'),
+            any_value(trust_asset_key(qs.c.trustCik, qs.c.assetNumber)).label('trustAssetNumber'),
+            func.min(qs.c.dateFiling).label('dateFirstFiling'),
+            any_value(qs.c.trustCik).label('trustCik'),
+            any_value(qs.c.assetNumber).label('assetNumber'),
+            any_value(qs.c.originationDate).label('originationDate'),
+            any_value(qs.c.originalLoanAmount).label('originalLoanAmount'),
+            any_value(qs.c.originalLoanTerm).label('originalLoanTerm'),
+            any_value(qs.c.loanMaturityDate).label('loanMaturityDate'),
+            any_value(qs.c.originalInterestRatePercentage).label('originalInterestRatePercentage'),
+            any_value(qs.c.underwritingIndicator).label('underwritingIndicator'),
+            any_value(qs.c.gracePeriodNumber).label('gracePeriodNumber'),
+            any_value(qs.c.subvented).label('subvented'),
+            any_value(qs.c.vehicleManufacturerName).label('vehicleManufacturerName'),
+            any_value(qs.c.vehicleModelName).label('vehicleModelName'),
+            any_value(qs.c.vehicleNewUsedCode).label('vehicleNewUsedCode'),
+            any_value(qs.c.vehicleModelYear).label('vehicleModelYear'),
+            any_value(qs.c.vehicleTypeCode).label('vehicleTypeCode'),
+            any_value(qs.c.vehicleValueAmount).label('vehicleValueAmount'),
+            any_value(qs.c.obligorCreditScore).label('obligorCreditScore'),
+            any_value(qs.c.obligorIncomeVerificationLevelCode) \
+                .label('obligorIncomeVerificationLevelCode'),
+            any_value(qs.c.obligorEmploymentVerificationCode) \
+                .label('obligorEmploymentVerificationCode'),
+            any_value(qs.c.coObligorIndicator).label('coObligorIndicator'),
+            any_value(qs.c.paymentToIncomePercentage).label('paymentToIncomePercentage'),
+            any_value(qs.c.obligorGeographicLocation).label('obligorGeographicLocation'),
+            func.min(qs.c.zeroBalanceEffectiveDate).label('zeroBalanceEffectiveDate'),
+            func.min(qs.c.zeroBalanceCode).label('zeroBalanceCode'),
+            func.min(case(
+                [(qs.c.currentDelinquencyStatus > 30, qs.c.reportingPeriodEndingDate)],
+                else_=None
+                )).label('delinquency30Days'),
+            func.min(case(
+                [(qs.c.currentDelinquencyStatus > 90, qs.c.reportingPeriodEndingDate)],
+                else_=None
+                )).label('delinquency90Days'),
+            func.max(qs.c.repossessedIndicator).label('repossessedIndicator'),
+            func.min(case(
+                [(qs.c.repossessedIndicator > 0, qs.c.reportingPeriodEndingDate)],
+                else_=None
+                )).label('repossessedDate'),
+            ) \
+            .group_by(qs.c.loanId) \
+            .order_by(qs.c.loanId)
+        return q
+
+    def frame_query(self, session, acc_nos, bucket=0, buckets=1):
+        """
+        Aggregate panel data in process and stage results in a temporary table, so that they are
+        written to flat table the same way as results of aggregate query.
+        :param session: database session
+        :param acc_nos: accession numbers of filings to aggregate
+        :param bucket: loan id bucket
+        :param buckets: total number of buckets, 1 for no bucketing
+        :return: query with columns of flat table
+        """
+        from sqlalchemy import Table, MetaData
+        from assets import AutoloanFlat
+        frame = self.flattener.flatten(session, acc_nos, bucket, buckets)
+        table = AutoloanFlat.__table__
+        stage = Table(table.name + '_frame', MetaData(), *[c.copy() for c in table.columns],
+                      prefixes=['TEMPORARY'])
+        stage.drop(session.connection(), checkfirst=True)
+        stage.create(session.connection())
+        if len(frame):
+            session.execute(stage.insert(), self.flattener.records(frame))
+        return session.query(*stage.columns).order_by(stage.c.loanId)
+
+    def upsert(self, session, q):
+        """
+        Insert aggregated records into flat table, updating records that already exist.
+        Existing updatable fields are only filled if empty, in incremental mode they are merged
+        according to merge rules.
+        :param session: database session
+        :param q: aggregate query with columns of flat table
+        :return: None
+        """
+        from sqlalchemy import select, Table, MetaData
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        from assets import AutoloanFlat
+        table = AutoloanFlat.__table__
+        names = [c['name'] for c in q.column_descriptions]
+        if session.bind.dialect.name == 'mysql':
+            # Single INSERT ... SELECT ... ON DUPLICATE KEY UPDATE statement
+            stmt = mysql_insert(table).from_select(names=names, select=q)
+            stmt = stmt.on_duplicate_key_update(
+                **{f: self.merge_expr(table.c[f], stmt.inserted[f]) for f in self.merged_fields()})
+            session.execute(stmt)
+            return
+        # Other databases: aggregate into staging table, then update matching and insert missing records
+        stage = Table(table.name + '_stage', MetaData(), *[c.copy() for c in table.columns],
+                      prefixes=['TEMPORARY'])
+        stage.drop(session.connection(), checkfirst=True)
+        stage.create(session.connection())
+        session.execute(stage.insert().from_select(names=names, select=q))
+        pk = table.c.loanId
+        session.execute(table.update()
+                        .where(pk.in_(select([stage.c.loanId])))
+                        .values({f: self.merge_expr(table.c[f], select([stage.c[f]])
+                                                    .where(stage.c.loanId == pk).as_scalar())
+                                 for f in self.merged_fields()}))
+        session.execute(table.insert().from_select(
+            names=names,
+            select=select([stage.c[f] for f in names])
+                .where(~stage.c.loanId.in_(select([pk])))))
+        stage.drop(session.connection())
+
+    def merged_fields(self):
+        """
+        Fields of existing flat records that can change.
+        :return: list of field names
+        """
+        from assets import AutoloanFlat
+        if self.incremental:
+            return [c.key for c in AutoloanFlat.__table__.columns if c.key not in ('loanId', 'trustAssetNumber')]
+        return AutoloanFlat.updatable_fields
+
+    def merge_expr(self, old_value, new_value):
+        """
+        Build sql expression merging existing and new value of a field.
+        :param old_value: column of flat table
+        :param new_value: expression with value aggregated from new filings
+        :return: sql expression
+        """
+        from sqlalchemy import func, case, and_
+        from assets import AutoloanFlat
+        rule = AutoloanFlat.merge_rules.get(old_value.key) if self.incremental else None
+        if rule is None:
+            # Only fill empty fields
+            return func.coalesce(old_value, new_value)
+        better = new_value < old_value if rule == 'min' else new_value > old_value
+        return case([(old_value == None, new_value), (and_(new_value != None, better), new_value)],
+                    else_=old_value)
+
+    def refresh_pool(self, trusts):
+        """
+        Update monthly pool table with filings not summarized yet. Only reporting periods covered
+        by new filings are recomputed.
+        :param trusts: dict of trust ciks and lists of accession numbers of their filings
+        :return: None
+        """
+        from assets import AssetDb, AssetFiling, Autoloan, PoolMonthly
+        for trust_cik, acc_nos in trusts.items():
+            start = perf_counter()
+            with AssetDb.get_session() as session:
+                new_acc_nos = [r.accNo for r in session.query(AssetFiling.accNo)
+                               .filter(AssetFiling.accNo.in_(acc_nos))
+                               .filter(AssetFiling.isComplete == True)
+                               .filter(AssetFiling.isPooled == False)]
+                if len(new_acc_nos) == 0:
+                    continue
+                periods = [r[0] for r in session.query(Autoloan.reportingPeriodEndingDate)
+                           .filter(Autoloan.filingAccNo.in_(new_acc_nos)).distinct()]
+                # Periods can be reported in earlier filings as well, so all trust's filings are summarized
+                trust_acc_nos = [r.accNo for r in session.query(AssetFiling.accNo)
+                                 .filter(AssetFiling.trustCik == trust_cik)
+                                 .filter(AssetFiling.isComplete == True)]
+                session.query(PoolMonthly) \
+                    .filter(PoolMonthly.trustCik == trust_cik) \
+                    .filter(PoolMonthly.reportingPeriodEndingDate.in_(periods)) \
+                    .delete(synchronize_session=False)
+                q = self.pool_query(session, trust_cik, trust_acc_nos, periods)
+                session.execute(PoolMonthly.__table__.insert().from_select(
+                    names=[c['name'] for c in q.column_descriptions], select=q))
+                session.query(AssetFiling) \
+                    .filter(AssetFiling.accNo.in_(new_acc_nos)) \
+                    .update({AssetFiling.isPooled: True}, synchronize_session=False)
+            metrics.observe('pool_refresh_seconds', perf_counter() - start)
+            metrics.inc('pool_periods', len(periods))
+            print(f'{ats()} Monthly pool data of trust {trust_cik} updated ({len(periods)} period(s)).')
+
+    @staticmethod
+    def pool_query(session, trust_cik, acc_nos, periods):
+        """
+        Build query summarizing panel data of trust by reporting period.
+        :param session: database session
+        :param trust_cik: trust cik
+        :param acc_nos: accession numbers of trust's filings
+        :param periods: reporting period ending dates to summarize
+        :return: query with columns of monthly pool table
+        """
+        from sqlalchemy import func, case, and_, literal
+        from assets import Autoloan, encoded_value
+        status = Autoloan.currentDelinquencyStatus
+        balance = Autoloan.reportingPeriodActualEndBalanceAmount
+        # Loan paid off by borrower (zero balance code 1) during period
+        prepaid = and_(Autoloan.zeroBalanceCode == encoded_value('zeroBalanceCode', '1'),
+                       Autoloan.reportingPeriodBeginningLoanBalanceAmount > 0,
+                       func.coalesce(balance, 0) == 0)
+
+        def count_if(condition):
+            return func.sum(case([(condition, 1)], else_=0))
+
+        q = session.query(
+            literal(trust_cik).label('trustCik'),
+            Autoloan.reportingPeriodEndingDate.label('reportingPeriodEndingDate'),
+            func.count().label('loanCount'),
+            func.sum(Autoloan.reportingPeriodBeginningLoanBalanceAmount).label('beginningBalance'),
+            func.sum(balance).label('endingBalance'),
+            count_if(func.coalesce(status, 0) < 30).label('currentCount'),
+            count_if(and_(status >= 30, status < 60)).label('delinquent30Count'),
+            count_if(and_(status >= 60, status < 90)).label('delinquent60Count'),
+            count_if(and_(status >= 90, status < 120)).label('delinquent90Count'),
+            count_if(status >= 120).label('delinquent120Count'),
+            func.sum(case([(status >= 30, balance)], else_=0)).label('delinquentBalance'),
+            count_if(Autoloan.chargedoffPrincipalAmount > 0).label('chargedoffCount'),
+            func.sum(Autoloan.chargedoffPrincipalAmount).label('chargedoffAmount'),
+            func.sum(Autoloan.recoveredAmount).label('recoveredAmount'),
+            count_if(Autoloan.repossessedIndicator == True).label('repossessedCount'),
+            count_if(prepaid).label('prepaidCount'),
+            func.sum(case([(prepaid, Autoloan.reportingPeriodBeginningLoanBalanceAmount)], else_=0))
+                .label('prepaidAmount'),
+            ) \
+            .filter(Autoloan.filingAccNo.in_(acc_nos)) \
+            .filter(Autoloan.reportingPeriodEndingDate.in_(periods)) \
+            .group_by(Autoloan.reportingPeriodEndingDate)
+        return q
+
+    def filing_filter(self):
+        """
+        Build filter on filings depending on passed arguments.
+        :return: sql expression, true for all filings if no filings, trusts or company were passed
+        """
+        from sqlalchemy import true
+        from assets import AssetFiling
+        if len(self.ind_filings):
+            return AssetFiling.accNo.in_(self.ind_filings)
+        elif len(self.ind_trusts):
+            return AssetFiling.trustCik.in_(self.ind_trusts)
+        elif self.company is not None:
+            return AssetFiling.trustName.like(f'%{self.company}%')
+        return true()
 
 
 def main():
@@ -156,13 +461,28 @@ def main():
     ap.add_argument("-r", "--rebuild", required=False, action='store_true', default=False,
                     help="redo everything from scratch")
     ap.add_argument("-q", "--quick", required=False, action='store_true', default=False,
-                    help="use quick insert from_select instead of slow row-by-row insert")
+                    help="use plain insert from_select instead of upsert (only if loans are not in flat table yet)")
+    ap.add_argument("-i", "--incremental", required=False, action='store_true', default=False,
+                    help="only fold filings parsed since last run into flat table")
+    ap.add_argument("-w", "--workers", required=False, type=int, default=1,
+                    help="number of partitions processed concurrently")
+    ap.add_argument("-b", "--buckets", required=False, type=int, default=1,
+                    help="number of partitions per trust (split by loan id)")
+    ap.add_argument("-e", "--engine", required=False, type=str, default='sql',
+                    help="aggregation engine: sql (default, runs in database) or pandas (runs in process)")
+    ap.add_argument("-p", "--parquet", required=False, type=str, default=None,
+                    help="read panel from Parquet files in this folder instead of database (pandas engine only)")
+    ap.add_argument("--retry-failed", required=False, action='store_true', default=False,
+                    help="only rerun partitions that failed in previous runs")
     ap.add_argument("-t", "--trust", required=False, type=str,
                     help="trust ciks separated by ':'")
     ap.add_argument("-f", "--filing", required=False, type=str,
                     help="filing accession numbers separated by ':'")
     ap.add_argument("-c", "--company", required=False, type=str,
                     help="company name")
+    ap.add_argument("--metrics", required=False, type=str, default=defaults['metrics_folder'],
+                    help="folder for run metrics in json and Prometheus textfile formats")
+    add_profile_arguments(ap)
 
     args = vars(ap.parse_args())
 
@@ -179,6 +499,31 @@ def main():
         print("Cannot use both filing and brand options.")
         ap.print_help()
         sys.exit(2)
+    # Failed partitions are rerun as recorded, all other runs need a selection of filings
+    elif args['trust'] is None and args['filing'] is None and args['company'] is None and not args['retry_failed']:
+        print("One of trust, filing or company options is required.")
+        ap.print_help()
+        sys.exit(2)
+    # Quick insert cannot update existing records
+    if args['incremental'] and args['quick']:
+        print("Cannot use both incremental and quick options.")
+        ap.print_help()
+        sys.exit(2)
+
+    if args['engine'] not in ('sql', 'pandas'):
+        print('Unknown engine:', args['engine'])
+        ap.print_help()
+        sys.exit(2)
+    elif args['parquet'] is not None and args['engine'] != 'pandas':
+        print("Parquet input requires pandas engine.")
+        ap.print_help()
+        sys.exit(2)
+
+    if args['profile_mode'] not in profiler.modes:
+        print('Unknown profile mode:', args['profile_mode'])
+        ap.print_help()
+        sys.exit(2)
+    profiler.configure(args['profile'], args['profile_mode'], args['profile_memory'])
 
     ind_trusts = []
     if args['trust'] is not None:
@@ -188,8 +533,15 @@ def main():
         ind_filings = list(map(lambda x: int(x), args['filing'].split(":")))
 
     # Initiate and run parser
-    abs_handler = AbsHandler(args['company'], args['rebuild'], args['quick'], ind_trusts, ind_filings)
-    abs_handler.dispatch()
+    abs_handler = AbsHandler(args['company'], args['rebuild'], args['quick'], ind_trusts, ind_filings,
+                             args['incremental'], args['workers'], args['buckets'], args['retry_failed'],
+                             args['engine'], args['parquet'])
+    metrics.reset('abshandler')
+    try:
+        abs_handler.dispatch()
+    finally:
+        if args['metrics']:
+            metrics.export(args['metrics'])
 
 
 if __name__ == '__main__':
@@ -1,22 +1,24 @@
 import argparse
 import sys
 import os
-import boto3
 import re
-from lxml import etree
-from datetime import date
-from helpers import ats, ok
-from assets import *
-from models import *
+from time import perf_counter
+from datetime import date, datetime
+from config import defaults
+from helpers import ats, ok, s3_resource, filing_key
+from metrics import metrics
+from profiling import profiler, add_profile_arguments
 
 
 class AbsParser(object):
     """
-    Class for the xml parser app.
+    Class for the xml parser app. Database models, lxml and boto3 are imported by methods that use them,
+    so that argument validation and index-only runs (e.g. warnings) start without loading them.
     """
     def __init__(self, warn=False, rebuild=False, use_s3=False,  n_limit=0,
                  asset_types={'autoloan', 'autolease'}, ind_trusts=[], ind_filings=[],
-                 output='csv'):
+                 output='csv', prefetch=defaults['prefetch_depth'], loan_ids=False,
+                 drop_month=None, lease=False):
         self.warn = warn
         self.use_s3 = use_s3
         self.rebuild = rebuild
@@ -25,6 +27,10 @@ class AbsParser(object):
         self.ind_trusts = ind_trusts
         self.ind_filings = ind_filings
         self.output = output
+        self.prefetch = prefetch
+        self.loan_ids = loan_ids
+        self.drop_month = drop_month
+        self.lease = lease
 
     def dispatch(self):
         """
@@ -36,6 +42,12 @@ class AbsParser(object):
             print(f'{ats()} Done!')
             sys.exit(1)
 
+        if self.loan_ids:
+            self.backfill_loan_ids()
+            print(f'{ats()} Done!')
+            sys.exit(1)
+
+        from assets import AssetDb
         if self.rebuild:
             answer = input("You sure you want to reparse? [yes/No]? ")
             if answer.lower() == 'yes':
@@ -47,7 +59,14 @@ class AbsParser(object):
                 print(f"{ats()} Aborting...")
                 sys.exit(1)
 
-        self.parse()
+        # Create missing tables
+        AssetDb().setup()
+
+        if self.drop_month:
+            self.drop_period(self.drop_month)
+
+        with profiler.stage('parse'):
+            self.parse()
 
         print(f"{ats()} Finished. Good job!")
         ok()
@@ -57,10 +76,13 @@ class AbsParser(object):
         Compile a list of filings filed on the same date (skipping those with skip flag in db.
         :return: None (print output to stdout)
         """
+        from sqlalchemy import func
+        from models import IndexDb, Filing, Company
         with IndexDb.get_session() as session:
             multifilings = session.query(Company.name.label('trust'), Filing.cik_trust, Filing.date_filing,
                               func.count().label('num_filings')) \
                 .filter(Filing.skip == False) \
+                .filter(Filing.duplicate_of == None) \
                 .filter(Filing.cik_trust == Company.cik) \
                 .filter(Company.asset_type.in_(self.asset_types))\
                 .order_by(Company.name)\
@@ -79,9 +101,10 @@ class AbsParser(object):
         Top-level parse procedure.
         :return:
         """
+        from models import IndexDb, Filing, Company, update_filings
+        from leases import FilingQueue, FilingLeases
 
         # Retrieve filings from index db and filter accordingly
-        filings = []
         with IndexDb.get_session() as session:
             q = session.query(Filing, Company) \
                 .filter(Company.cik == Filing.cik_trust) \
@@ -95,6 +118,8 @@ class AbsParser(object):
 
         # Drop filings that should be skipped (e.g. duplicates)
         q = q.filter(Filing.skip == False)
+        # Drop filings with content identical to earlier filings
+        q = q.filter(Filing.duplicate_of == None)
 
         # Filter by user-defined asset type
         q = q.filter(Company.asset_type.in_(self.asset_types))
@@ -105,76 +130,75 @@ class AbsParser(object):
         if len(self.ind_filings) > 0:
             q = q.filter(Filing.acc_no.in_(self.ind_filings))
 
-        # Apply document limit
-        if self.n_limit:
-            q = q[:self.n_limit]
-
-        if len(q.all()) == 0:
-            print(f'{ats()} No filings to parse. Aborting.')
-            sys.exit(1)
-
         # Only leave filings that have not been parsed yet
         if self.rebuild:
             print(f"{ats()} Updating index...")
-            for row in q.all():
-                row.Filing.is_parsed = False
+            update_filings([r.acc_no for r in q.with_entities(Filing.acc_no)], {Filing.is_parsed: False})
             print(f'{ats()} Done!')
         else:
             q = q.filter(Filing.is_parsed == False)
 
-        filings = q.all()
+        # Apply document limit
+        if self.n_limit:
+            q = q.limit(self.n_limit)
 
-        # Some preparation
-        if self.use_s3:
-            # Use S3
-            filings_path = os.path.dirname(__file__)
-            s3_resource = boto3.resource('s3')
-        else:
-            # Use local storage
-            filings_path = os.path.join(os.path.dirname(__file__), defaults['filings_folder'])
-
-        # Iterate through entries on the index
-        doc_counter = 0
-        for row in filings:  # row contains two objects: Filing and Company
-            # Build filename
-            xml_name = row.Filing.url.split("/")[-1]  # Original filename from filing
-            filename = "_".join([row.Filing.date_filing.strftime("%Y-%m-%d"), str(row.Filing.acc_no), xml_name])
-            # Get file
+        # Only keep accession numbers in memory, filings are loaded in chunks while parsing
+        acc_nos = [r.acc_no for r in q.with_entities(Filing.acc_no)]
+        session.close()
+        if len(acc_nos) == 0:
+            print(f'{ats()} No filings to parse. Aborting.')
+            sys.exit(1)
+        # Filings are claimed in batches if work is shared with other workers
+        with (FilingLeases('parse', acc_nos) if self.lease else FilingQueue(acc_nos)) as filings:
+            # Some preparation
             if self.use_s3:
-                # Download from s3
-                s3_path_components = [row.Company.asset_type, row.Company.name, filename]
-                s3_path = "/".join(s3_path_components)
-                # Use project folder for temporary storage
-                local_path = os.path.join(filings_path, filename)
-                try:
-                    print(f'{ats()} Downloading filing {s3_path}...')
-                    s3_resource.Bucket(defaults['s3_bucket']).download_file(s3_path, local_path)
-                except:
-                    print(f'{ats()} Could not download filing {s3_path} from s3.')
+                # Use S3, project folder serves as temporary storage
+                filings_path = os.path.dirname(__file__)
+                bucket = s3_resource().Bucket(defaults['s3_bucket'])
+                s3_items = ((filing_key(row.Filing, row.Company), row) for row in filings)
+                # Download next filings while current one is being parsed
+                from prefetch import S3Prefetcher
+                from s3manifest import S3Manifest
+                from filecache import FileCache
+                sources = S3Prefetcher(s3_items, bucket, filings_path, depth=self.prefetch,
+                                       max_bytes=defaults['prefetch_max_bytes'], manifest=S3Manifest(bucket).load(),
+                                       cache=FileCache())
+            else:
+                # Use local storage
+                filings_path = os.path.join(os.path.dirname(__file__), defaults['filings_folder'])
+                sources = ((row, os.path.join(filings_path, *filing_key(row.Filing, row.Company).split("/")))
+                           for row in filings)
+
+            # Iterate through entries on the index
+            doc_counter = 0
+            for row, file_path in sources:  # row contains two objects: Filing and Company
+                if file_path is None:
+                    filings.fail(row.Filing.acc_no)
                     continue
+                parsed = self.parse_row(row, file_path)
+                # Remove temporary copy of file downloaded from s3
+                if self.use_s3:
+                    sources.release(file_path)
+                if parsed:
+                    doc_counter += 1
+                    filings.complete(row.Filing.acc_no)
                 else:
-                    print(f'{ats()} Download complete!')
-                    file_path = local_path
-            else:
-                # Get local file path
-                asset_path = os.path.join(filings_path, row.Company.asset_type)
-                subfolder_path = os.path.join(asset_path, row.Company.name)
-                file_path = os.path.join(subfolder_path, filename)
-            print(f'{ats()} Parsing...')
-
-            # Parse xml
-            if self.parse_filing(file_path, row.Company.asset_type, row.Filing.acc_no, self.output):
-                print(f'{ats()} Parsing complete!')
-                print("-" * 5)
-            # Remove file from local storage
-            os.remove(file_path)
-            # Mark filing as parsed in index db
-            with IndexDb.get_session() as session:
-                f = session.query(Filing).get(row.Filing.acc_no)
-                if f is not None:
-                    f.is_parsed = True
-            # Add filing info to database
-            with AssetDb.get_session() as session:
+                    filings.fail(row.Filing.acc_no)
+
+        print(f'{ats()} Finished parsing! Parsed {doc_counter} filing(s).')
+
+    def parse_row(self, row, file_path):
+        """
+        Parse single filing file and mark filing as parsed in index.
+        :param row: Filing and Company objects of filing
+        :param file_path: local file path
+        :return: True if successful
+        """
+        from assets import AssetDb, AssetFiling
+        from models import IndexDb, Filing
+        # Add filing info to database. It also holds parse checkpoint for resuming interrupted parsing
+        with AssetDb.get_session() as session:
+            if session.query(AssetFiling).get(row.Filing.acc_no) is None:
                 flng = AssetFiling(
                     accNo=row.Filing.acc_no,
                     trustCik=row.Company.cik,
@@ -184,81 +208,411 @@ class AbsParser(object):
                     assetType=row.Company.asset_type
                 )
                 session.add(flng)
-
-            doc_counter += 1
-
-        print(f'{ats()} Finished parsing! Parsed {doc_counter} filing(s).')
+        print(f'{ats()} Parsing...')
+
+        # Parse xml
+        parsed = self.parse_filing(file_path, row.Company.asset_type, row.Filing.acc_no, self.output)
+        if not parsed:
+            print(f'{ats()} Parsing failed! Filing will be resumed on next run.')
+            return False
+        print(f'{ats()} Parsing complete!')
+        print("-" * 5)
+        # Mark filing as parsed in index db
+        with IndexDb.get_session() as session:
+            f = session.query(Filing).get(row.Filing.acc_no)
+            if f is not None:
+                f.is_parsed = True
+        return True
 
     @staticmethod
-    def parse_filing(file_path, asset_type, acc_no, output):
+    def parse_filing(file_path, asset_type, acc_no, output, batch_size=defaults['parse_batch_size']):
         """
-        Parse individual xml file and save data to database.
+        Parse individual xml file and save data to database. Records are committed in batches
+        together with a checkpoint, so that an interrupted filing is resumed from the last committed record.
         :param file_path: local file path
         :param asset_type: string describing asset type, e.g. autoloan
         :param acc_no: unique filing's number
         :param output: string argument specifying output: csv or db
+        :param batch_size: number of records per commit
         :return: True if successful
         """
+        from lxml import etree
+        from assets import AssetDb, AssetFiling, Loan, AutoloanStatic, Dictionary, stream
         with open(file_path, 'rb') as datafile:
             # Preview file and extract namespace
             head = datafile.read(1024).decode('utf-8')
             # ns = re.search(r'xmlns="(.*)">', head).group(1)
             ns = re.search(r'xmlns="(http://www\.sec\.gov/edgar/document/absee/.*/assetdata)"\s?', head).group(1)
-            nstag = ''.join(['{', ns, '}assetData'])
+            nstag = ''.join(['{', ns, '}assets'])
             datafile.seek(0)
             # Open database session
             with AssetDb.get_session() as session:
+                # Look up checkpoint
+                flng = session.query(AssetFiling).get(acc_no)
+                if flng.isComplete:
+                    print(f'{ats()} Filing already parsed.')
+                    return True
+                checkpoint = flng.parsedAssets or 0
+                if checkpoint:
+                    print(f'{ats()} Resuming after record {checkpoint}...')
+                # Loan ids already assigned to trust's assets
+                loan_ids = {r.assetNumber: r.loanId for r in stream(session.query(Loan.assetNumber, Loan.loanId)
+                                                                    .filter(Loan.trustCik == flng.trustCik))}
+                # Hashes of static attributes stored in loan dimension
+                static_hashes = {r.loanId: r.staticHash for r in stream(
+                    session.query(AutoloanStatic.loanId, AutoloanStatic.staticHash)
+                    .join(Loan, Loan.loanId == AutoloanStatic.loanId)
+                    .filter(Loan.trustCik == flng.trustCik))}
+                # Ids of dictionary-encoded values
+                value_ids = {(r.field, r.value): r.valueId for r in session.query(Dictionary)}
                 counter = 0
-                # Parse the tree
-                for event, element in etree.iterparse(datafile, events=('end',), tag=nstag):
-                    for assettag in element:
+                batch = []
+                # Range of reporting periods of filing's records
+                period_start, period_end = flng.periodStart, flng.periodEnd
+                # Time spent on field conversion and db writes, the rest of the loop is xml parsing
+                start = perf_counter()
+                convert_time = write_time = 0.0
+                # Parse the tree one asset at a time
+                for event, assettag in etree.iterparse(datafile, events=('end',), tag=nstag):
+                    counter += 1
+                    # Skip records committed before interruption
+                    if counter > checkpoint:
                         if len(assettag) == 0:
                             print(f"{ats()} Issue with data. Please check!")
-                            sys.exit(1)
-                        # Build list of tuples with fieldname-fieldvalue pairs
-                        fields = [(etree.QName(item.tag).localname, item.text) for item in assettag]
-                        # Initiate object
-                        asset = None
-                        if asset_type == 'autoloan':
-                            asset = Autoloan()
-                        elif asset_type == 'autolease':
-                            asset = Autolease()
-                        asset.filingAccNo = acc_no
-                        # Populate object with properties
-                        for field in fields:
-                            field_name = field[0]
-                            field_value = field[1]
-                            # Transform 'special' fields
-                            if field_name in asset.special_fields:
-                                if asset.special_fields[field_name] == 'Date1':
-                                    # Convert date in MM-DD-YYYY format to Date object
-                                    dt_arr = field_value.split("-")
-                                    field_value = date(int(dt_arr[2]), int(dt_arr[0]),int(dt_arr[1]))
-                                elif asset.special_fields[field_name] == 'Date2':
-                                    # Convert date in MM/YYYY format to Date object
-                                    dt_arr = field_value.split("/")
-                                    field_value = date(int(dt_arr[1]), int(dt_arr[0]), 15)
-                                elif asset.special_fields[field_name] == 'Boolean':
-                                    # Convert 'true' and 'false' strings to True and False python objects
-                                    field_value = True if field_value == 'true' else False
-                                elif asset.special_fields[field_name] == 'Unlimited':
-                                    # Join fields with same tag into strings like '2|3|1'
-                                    same_fields = list(filter(lambda x: x[0] == field_name, fields))
-                                    if len(same_fields) > 1:
-                                        field_value = "|".join([str(f[1]) for f in same_fields])
-                                    else:
-                                        field_value = str(field_value)
-                            # Assign field values to asset object properties
-                            setattr(asset, field_name, field_value)
-                            # asset_props = asset.__table__.columns._data.keys()
-                            # asset_dict = OrderedDict([(prop, getattr(asset, prop)) for prop in asset_props])
-                        # Save filing object in db
-                        session.add(asset)
-                        counter += 1
-                        print(f'Processed {counter} records...', end="\r")
+                            # Drop uncommitted part of batch to keep checkpoint consistent
+                            session.rollback()
+                            return False
+                        convert_start = perf_counter()
+                        asset = AbsParser.build_asset(assettag, asset_type, acc_no)
+                        convert_time += perf_counter() - convert_start
+                        batch.append(asset)
+                        period = getattr(asset, asset.period_field, None)
+                        if period is not None:
+                            period_start = min(period_start or period, period)
+                            period_end = max(period_end or period, period)
+                        # Insert and commit batch together with checkpoint
+                        if counter % batch_size == 0:
+                            write_start = perf_counter()
+                            AbsParser.assign_loan_ids(flng.trustCik, batch, loan_ids)
+                            AbsParser.encode_values(batch, value_ids)
+                            AbsParser.store_static(session, batch, static_hashes, value_ids)
+                            session.bulk_save_objects(batch)
+                            metrics.inc('records_parsed', len(batch))
+                            batch = []
+                            flng.parsedAssets = counter
+                            flng.periodStart, flng.periodEnd = period_start, period_end
+                            session.commit()
+                            write_time += perf_counter() - write_start
+                            metrics.observe('db_write_seconds', perf_counter() - write_start)
+                    # Free memory taken by processed elements
+                    assettag.clear()
+                    while assettag.getprevious() is not None:
+                        del assettag.getparent()[0]
+                    metrics.progress('Processed {} records...', counter)
+                metrics.progress('Processed {} records...', counter, force=True)
+                write_start = perf_counter()
+                AbsParser.assign_loan_ids(flng.trustCik, batch, loan_ids)
+                AbsParser.encode_values(batch, value_ids)
+                AbsParser.store_static(session, batch, static_hashes, value_ids)
+                session.bulk_save_objects(batch)
+                metrics.inc('records_parsed', len(batch))
+                flng.parsedAssets = counter
+                flng.periodStart, flng.periodEnd = period_start, period_end
+                flng.isComplete = True
+        # Final batch is committed on leaving session
+        write_time += perf_counter() - write_start
+        metrics.observe('db_write_seconds', perf_counter() - write_start)
+        metrics.observe('field_conversion_seconds', convert_time)
+        metrics.observe('xml_parse_seconds', perf_counter() - start - convert_time - write_time)
+        metrics.inc('filings_parsed')
+        metrics.inc('bytes_parsed', os.path.getsize(file_path))
         print("")
         return True
 
+    @staticmethod
+    def assign_loan_ids(trust_cik, batch, loan_ids):
+        """
+        Set integer loan id of asset records, registering assets seen for the first time.
+        :param trust_cik: trust cik
+        :param batch: list of Autoloan or Autolease objects
+        :param loan_ids: dict of known loan ids by asset number (updated in place)
+        :return: None
+        """
+        from assets import Loan
+        new_loans = {}
+        for asset in batch:
+            # Asset numbers differing only by trailing spaces are the same loan in MySQL
+            asset.assetNumber = asset.assetNumber.rstrip()
+            if asset.assetNumber not in loan_ids and asset.assetNumber not in new_loans:
+                new_loans[asset.assetNumber] = Loan(trustCik=trust_cik, assetNumber=asset.assetNumber)
+
+        def lookup(session, asset_numbers):
+            return {r.assetNumber: r.loanId for r in session.query(Loan.assetNumber, Loan.loanId)
+                    .filter(Loan.trustCik == trust_cik).filter(Loan.assetNumber.in_(asset_numbers))}
+
+        loan_ids.update(AbsParser.register(new_loans, lookup))
+        for asset in batch:
+            asset.loanId = loan_ids[asset.assetNumber]
+
+    @staticmethod
+    def encode_values(batch, value_ids):
+        """
+        Replace values of dictionary-encoded fields of asset records and their static attributes with their ids,
+        adding new values to dictionary.
+        :param batch: list of Autoloan or Autolease objects
+        :param value_ids: dict of known value ids by field name and value (updated in place)
+        :return: None
+        """
+        if len(batch) == 0:
+            return
+        from assets import Dictionary, encoded_fields
+        objects = batch + [asset.static for asset in batch if asset.static is not None]
+        fields = {model: encoded_fields(model) for model in {type(obj) for obj in objects}}
+        new_values = {}
+        for asset in objects:
+            for field in fields[type(asset)]:
+                value = getattr(asset, field)
+                if value is None:
+                    continue
+                # Values differing only by trailing spaces are the same value in MySQL
+                value = value.rstrip()
+                setattr(asset, field, value)
+                if (field, value) not in value_ids and (field, value) not in new_values:
+                    new_values[(field, value)] = Dictionary(field=field, value=value)
+
+        def lookup(session, keys):
+            return {(r.field, r.value): r.valueId for r in session.query(Dictionary)
+                    .filter(Dictionary.field.in_({k[0] for k in keys}))
+                    .filter(Dictionary.value.in_({k[1] for k in keys})) if (r.field, r.value) in keys}
+
+        value_ids.update(AbsParser.register(new_values, lookup))
+        for asset in objects:
+            for field in fields[type(asset)]:
+                value = getattr(asset, field)
+                if value is not None:
+                    setattr(asset, field, value_ids[(field, value)])
+
+    @staticmethod
+    def store_static(session, batch, static_hashes, value_ids, chunk_size=defaults['index_chunk_size']):
+        """
+        Store static attributes of asset records in loan dimension. Attributes of new loans are inserted,
+        stored attributes differing from those of a record of the same or later reporting period are updated
+        and their changes logged. Records of earlier periods (e.g. older filings parsed late) do not change them.
+        :param session: database session of filing
+        :param batch: list of Autoloan or Autolease objects with encoded values
+        :param static_hashes: dict of hashes of stored static attributes by loan id (updated in place)
+        :param value_ids: dict of value ids by field name and value (to log original strings of encoded values)
+        :return: None
+        """
+        if len(batch) == 0 or batch[0].static is None:
+            return
+        from assets import StaticChange, static_hash, normalized_value
+        static_model = batch[0].static_model
+        new_statics = {}
+        for asset in batch:
+            static = asset.static
+            static.loanId = asset.loanId
+            static.staticPeriod = getattr(asset, asset.period_field, None)
+            static.staticHash = static_hash(static)
+            if asset.loanId not in static_hashes and asset.loanId not in new_statics:
+                new_statics[asset.loanId] = static
+
+        def lookup(session, loan_ids):
+            return {r.loanId: r.staticHash for r in session.query(static_model.loanId, static_model.staticHash)
+                    .filter(static_model.loanId.in_(loan_ids))}
+
+        static_hashes.update(AbsParser.register(new_statics, lookup))
+        # Latest record of each loan with attributes differing from stored ones
+        changed = {asset.loanId: asset for asset in batch if static_hashes[asset.loanId] != asset.static.staticHash}
+        if len(changed) == 0:
+            return
+        columns = [c for c in static_model.__table__.columns if c.key not in static_model.meta_fields]
+        encoded = {c.key for c in columns if 'encoded' in c.info}
+        names = {value_id: value for (field, value), value_id in value_ids.items() if field in encoded}
+
+        def text(field, value):
+            return None if value is None else str(names.get(value, value) if field in encoded else value)[:255]
+
+        changes = []
+        loan_ids = list(changed)
+        for i in range(0, len(loan_ids), chunk_size):
+            for stored in session.query(static_model).filter(static_model.loanId.in_(loan_ids[i:i + chunk_size])):
+                static = changed[stored.loanId].static
+                if stored.staticPeriod is not None and static.staticPeriod is not None \
+                        and static.staticPeriod < stored.staticPeriod:
+                    continue
+                acc_no = changed[stored.loanId].filingAccNo
+                for column in columns:
+                    old, new = getattr(stored, column.key), getattr(static, column.key)
+                    if normalized_value(column, old) != normalized_value(column, new):
+                        changes.append(StaticChange(loanId=stored.loanId, filingAccNo=acc_no,
+                                                    reportingPeriod=static.staticPeriod, field=column.key,
+                                                    oldValue=text(column.key, old), newValue=text(column.key, new)))
+                        setattr(stored, column.key, new)
+                stored.staticHash, stored.staticPeriod = static.staticHash, static.staticPeriod
+                static_hashes[stored.loanId] = static.staticHash
+        session.bulk_save_objects(changes)
+        metrics.inc('static_changes', len(changes))
+
+    @staticmethod
+    def register(entries, lookup, chunk_size=defaults['index_chunk_size'], attempts=defaults['register_attempts']):
+        """
+        Insert new loans or dictionary values and look up their ids. Entries are committed in own
+        transactions, so that several parsers can run at once: if another parser inserts some of the
+        same entries first, insert is retried without them.
+        :param entries: dict of new Loan or Dictionary objects by key
+        :param lookup: function taking session and list of keys and returning dict of ids of existing entries by key
+        :param chunk_size: number of keys looked up at once
+        :param attempts: max number of inserts, last error is raised if entries are still missing after that
+        :return: dict of ids by key
+        """
+        from sqlalchemy.exc import IntegrityError
+        from assets import AssetDb
+        keys = list(entries)
+        attempt = 0
+        while len(entries):
+            # Fresh transaction, so that entries committed by other parsers are visible
+            with AssetDb.get_session() as session:
+                ids = {}
+                for i in range(0, len(keys), chunk_size):
+                    ids.update(lookup(session, set(keys[i:i + chunk_size])))
+            missing = [entry for key, entry in entries.items() if key not in ids]
+            if len(missing) == 0:
+                return ids
+            attempt += 1
+            try:
+                with AssetDb.get_session() as session:
+                    session.bulk_save_objects(missing)
+            except IntegrityError:
+                # Entries colliding with stored ones that lookup does not match would fail forever
+                if attempt >= attempts:
+                    raise
+        return {}
+
+    @staticmethod
+    def drop_period(month):
+        """
+        Delete panel records of one reporting month and mark filings holding them for reparsing.
+        Filings are parsed from scratch, so their records of other months are deleted as well.
+        :param month: first day of month
+        :return: None
+        """
+        from assets import AssetDb, AssetFiling, Autoloan, Autolease, PoolMonthly, next_month
+        from models import Filing, update_filings
+        db = AssetDb()
+        with AssetDb.get_session() as session:
+            acc_nos = set()
+            for model in [Autoloan, Autolease]:
+                period = getattr(model, model.period_field)
+                acc_nos |= {r[0] for r in session.query(model.filingAccNo)
+                            .filter(period >= month).filter(period < next_month(month)).distinct()}
+        acc_nos = list(acc_nos)
+        print(f'{ats()} Dropping records of {month.strftime("%Y-%m")} from {len(acc_nos)} filing(s)...')
+        for model in [Autoloan, Autolease]:
+            db.drop_period(model, month)
+        with AssetDb.get_session() as session:
+            for model in [Autoloan, Autolease]:
+                session.query(model).filter(model.filingAccNo.in_(acc_nos)).delete(synchronize_session=False)
+            session.query(PoolMonthly) \
+                .filter(PoolMonthly.reportingPeriodEndingDate >= month) \
+                .filter(PoolMonthly.reportingPeriodEndingDate < next_month(month)) \
+                .delete(synchronize_session=False)
+            session.query(AssetFiling).filter(AssetFiling.accNo.in_(acc_nos)).update({
+                AssetFiling.parsedAssets: 0,
+                AssetFiling.isComplete: False,
+                AssetFiling.isFlattened: False,
+                AssetFiling.isPooled: False,
+                AssetFiling.periodStart: None,
+                AssetFiling.periodEnd: None
+            }, synchronize_session=False)
+        update_filings(acc_nos, {Filing.is_parsed: False})
+
+    @staticmethod
+    def backfill_loan_ids():
+        """
+        Assign loan ids to asset records parsed before loan ids were introduced.
+        :return: None
+        """
+        from sqlalchemy import select, exists, and_, func
+        from assets import AssetDb, AssetFiling, Autoloan, Autolease, Loan
+        from sqlcompat import any_value, exact
+        AssetDb().setup()
+        with AssetDb.get_session() as session:
+            for model in [Autoloan, Autolease]:
+                print(f'{ats()} Registering loans of {model.__tablename__}...')
+                # Asset numbers of trusts without loan id yet, grouped exactly rather than by column collation
+                asset_number = func.rtrim(model.assetNumber)
+                assets = select([AssetFiling.trustCik, any_value(asset_number).label('assetNumber')]) \
+                    .select_from(model.__table__.join(AssetFiling.__table__, model.filingAccNo == AssetFiling.accNo)) \
+                    .where(model.loanId == None) \
+                    .where(~exists().where(and_(Loan.trustCik == AssetFiling.trustCik,
+                                                Loan.assetNumber == model.assetNumber))) \
+                    .group_by(AssetFiling.trustCik, exact(asset_number)) \
+                    .alias()
+                # Select from subquery, so that sequence value is not part of the DISTINCT
+                session.execute(Loan.__table__.insert().from_select(
+                    names=['trustCik', 'assetNumber'], select=select([assets.c.trustCik, assets.c.assetNumber])))
+                print(f'{ats()} Updating loan ids of {model.__tablename__}...')
+                loan_id = select([Loan.loanId]) \
+                    .where(Loan.trustCik == AssetFiling.trustCik) \
+                    .where(AssetFiling.accNo == model.filingAccNo) \
+                    .where(Loan.assetNumber == model.assetNumber) \
+                    .correlate(model.__table__) \
+                    .as_scalar()
+                session.execute(model.__table__.update().where(model.loanId == None).values(loanId=loan_id))
+                session.commit()
+
+    @staticmethod
+    def build_asset(assettag, asset_type, acc_no):
+        """
+        Build asset object from xml element.
+        :param assettag: lxml element with asset data
+        :param asset_type: string describing asset type, e.g. autoloan
+        :param acc_no: unique filing's number
+        :return: Autoloan or Autolease object
+        """
+        from lxml import etree
+        from assets import Autoloan, Autolease
+        # Build list of tuples with fieldname-fieldvalue pairs
+        fields = [(etree.QName(item.tag).localname, item.text) for item in assettag]
+        # Initiate object
+        asset = None
+        if asset_type == 'autoloan':
+            asset = Autoloan()
+        elif asset_type == 'autolease':
+            asset = Autolease()
+        asset.filingAccNo = acc_no
+        # Static attributes go to separate object stored in loan dimension
+        asset.static = asset.static_model() if asset.static_model is not None else None
+        static_columns = asset.static_model.__table__.columns if asset.static is not None else ()
+        # Populate object with properties
+        for field in fields:
+            field_name = field[0]
+            field_value = field[1]
+            # Transform 'special' fields
+            if field_name in asset.special_fields:
+                if asset.special_fields[field_name] == 'Date1':
+                    # Convert date in MM-DD-YYYY format to Date object
+                    dt_arr = field_value.split("-")
+                    field_value = date(int(dt_arr[2]), int(dt_arr[0]),int(dt_arr[1]))
+                elif asset.special_fields[field_name] == 'Date2':
+                    # Convert date in MM/YYYY format to Date object
+                    dt_arr = field_value.split("/")
+                    field_value = date(int(dt_arr[1]), int(dt_arr[0]), 15)
+                elif asset.special_fields[field_name] == 'Boolean':
+                    # Convert 'true' and 'false' strings to True and False python objects
+                    field_value = True if field_value == 'true' else False
+                elif asset.special_fields[field_name] == 'Unlimited':
+                    # Join fields with same tag into strings like '2|3|1'
+                    same_fields = list(filter(lambda x: x[0] == field_name, fields))
+                    if len(same_fields) > 1:
+                        field_value = "|".join([str(f[1]) for f in same_fields])
+                    else:
+                        field_value = str(field_value)
+            # Assign field values to asset object properties
+            setattr(asset.static if field_name in static_columns else asset, field_name, field_value)
+        return asset
+
 
 def main():
 
@@ -280,6 +634,17 @@ def main():
                     help="filing accession numbers separated by ':'")
     ap.add_argument("-o", "--output", required=False, type=str, default='db',
                     help="output type: csv (default) or db")
+    ap.add_argument("-k", "--prefetch", required=False, type=int, default=defaults['prefetch_depth'],
+                    help="number of filings to download from s3 ahead of parsing")
+    ap.add_argument("-l", "--loan-ids", required=False, action='store_true', default=False,
+                    help="assign loan ids to records parsed by earlier versions")
+    ap.add_argument("-d", "--drop-month", required=False, type=str, default=None,
+                    help="drop records of reporting month (YYYY-MM) and reparse filings holding them")
+    ap.add_argument("--lease", required=False, action='store_true', default=False,
+                    help="share work with other workers using the same index database by leasing filings")
+    ap.add_argument("--metrics", required=False, type=str, default=defaults['metrics_folder'],
+                    help="folder for run metrics in json and Prometheus textfile formats")
+    add_profile_arguments(ap)
 
     args = vars(ap.parse_args())
 
@@ -308,6 +673,25 @@ def main():
         ap.print_help()
         sys.exit(2)
 
+    drop_month = None
+    if args['drop_month'] is not None:
+        try:
+            drop_month = datetime.strptime(args['drop_month'], '%Y-%m').date()
+        except ValueError:
+            print('Month should be in YYYY-MM format:', args['drop_month'])
+            ap.print_help()
+            sys.exit(2)
+
+    if args['lease'] and args['rebuild']:
+        print("Cannot use both lease and rebuild options.")
+        ap.print_help()
+        sys.exit(2)
+    if args['profile_mode'] not in profiler.modes:
+        print('Unknown profile mode:', args['profile_mode'])
+        ap.print_help()
+        sys.exit(2)
+    profiler.configure(args['profile'], args['profile_mode'], args['profile_memory'])
+
     ind_trusts = []
     if args['trust'] is not None:
         ind_trusts = list(map(lambda x: int(x), args['trust'].split(":")))
@@ -317,8 +701,14 @@ def main():
 
     # Initiate and run parser
     abs_parser = AbsParser(args['warn'], args['rebuild'], args['s3'], args['number'], asset_types, \
-                           ind_trusts, ind_filings, args['output'])
-    abs_parser.dispatch()
+                           ind_trusts, ind_filings, args['output'], args['prefetch'], args['loan_ids'], drop_month,
+                           args['lease'])
+    metrics.reset('absparser')
+    try:
+        abs_parser.dispatch()
+    finally:
+        if args['metrics']:
+            metrics.export(args['metrics'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,366 @@
+import argparse
+import sys
+import os
+import queue
+import threading
+from time import perf_counter
+from contextlib import nullcontext
+from config import defaults
+from helpers import FileDownloader, ats, ok, s3_resource, filing_filename, filing_key
+from absscraper import AbsScraper
+from absparser import AbsParser
+from abshandler import AbsHandler
+from metrics import metrics
+from profiling import profiler, add_profile_arguments
+
+# End of stream marker passed through queues
+DONE = None
+
+
+class AbsPipeline(object):
+    """
+    End-to-end pipeline: index update, download, parsing and flattening run concurrently in their own
+    threads and are linked by queues. A filing is parsed while next ones are downloading and folded into
+    flat table as soon as it is parsed. Downloads wait while parse queue is full, which caps the number
+    of downloaded files waiting on disk.
+    """
+    def __init__(self, index=False, use_s3=False, n_limit=0, asset_types={'autoloan', 'autolease'}, ind_trusts=[],
+                 download_workers=2, flatten_workers=1, buckets=1, queue_size=defaults['pipeline_queue_size'],
+                 poll_interval=defaults['pipeline_poll_interval']):
+        """
+        :param index: update index while downloading, newly indexed filings are picked up as they appear
+        :param use_s3: store filings in s3 bucket
+        :param n_limit: max number of filings to process (0 for no limit)
+        :param asset_types: asset types to process
+        :param ind_trusts: only process filings of these trusts
+        :param download_workers: number of concurrent downloads
+        :param flatten_workers: number of flat table partitions processed concurrently
+        :param buckets: number of flat table partitions per trust
+        :param queue_size: max number of downloaded filings waiting for parsing
+        :param poll_interval: seconds between index lookups for new filings while indexing
+        """
+        self.index = index
+        self.use_s3 = use_s3
+        self.n_limit = n_limit
+        self.asset_types = asset_types
+        self.ind_trusts = ind_trusts
+        self.download_workers = max(download_workers, 1)
+        self.flatten_workers = max(flatten_workers, 1)
+        self.buckets = buckets
+        self.poll_interval = poll_interval
+        self.download_queue = queue.Queue(maxsize=self.download_workers)
+        self.parse_queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.flatten_queue = queue.Queue()
+        self.index_done = threading.Event()
+        self.stopped = threading.Event()
+        self.scraper = AbsScraper(use_s3=use_s3, asset_types=asset_types)
+        self.parser = AbsParser(use_s3=use_s3, asset_types=asset_types, output='db')
+        from assets import AssetDb
+        # Sqlite allows a single writer, so parsing and flattening take turns
+        self.db_lock = threading.Lock() if AssetDb().engine.dialect.name == 'sqlite' else nullcontext()
+        self.filings_path = None
+
+    def run(self):
+        """
+        Run all stages until every pending filing is parsed and flattened.
+        :return: True if all stages finished without errors
+        """
+        self.filings_path = self.scraper.prepare_storage()
+        print(f'{ats()} Starting pipeline with {self.download_workers} download worker(s)...')
+        stages = []
+        if self.index:
+            stages.append(self.start(self.run_index, 'index'))
+        else:
+            self.index_done.set()
+        feeder = self.start(self.run_feeder, 'feed')
+        downloaders = [self.start(self.run_downloader, f'download-{i}') for i in range(self.download_workers)]
+        parser = self.start(self.run_parser, 'parse')
+        flattener = self.start(self.run_flattener, 'flatten')
+
+        # Close stages in order, so that each one drains its input queue
+        for thread in stages + [feeder]:
+            thread.join()
+        for _ in downloaders:
+            self.put(self.download_queue, DONE)
+        for thread in downloaders:
+            thread.join()
+        self.put(self.parse_queue, DONE)
+        parser.join()
+        self.put(self.flatten_queue, DONE)
+        flattener.join()
+        if self.scraper.manifest is not None:
+            self.scraper.manifest.save()
+        if self.stopped.is_set():
+            print(f'{ats()} Pipeline stopped because of errors. Rerun to resume.')
+            return False
+        print(f'{ats()} Pipeline finished.')
+        return True
+
+    def start(self, target, name):
+        """
+        Start stage thread. Unexpected errors stop the whole pipeline.
+        :param target: stage method
+        :param name: thread name
+        :return: Thread object
+        """
+        def run():
+            try:
+                target()
+            except BaseException as e:
+                print(f'{ats()} Stage {name} failed: {e!r}')
+                self.stopped.set()
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def put(self, q, item):
+        """
+        Put item to queue, waiting while queue is full unless pipeline is stopped.
+        :return: True if item was queued
+        """
+        while not self.stopped.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q):
+        """
+        Take item from queue, waiting while queue is empty.
+        :return: item, DONE if pipeline is stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                return q.get(timeout=1)
+            except queue.Empty:
+                continue
+        return DONE
+
+    def run_index(self):
+        """
+        Update index of filings (runs in own thread).
+        """
+        try:
+            with profiler.stage('crawl'):
+                self.scraper.build_index()
+        finally:
+            self.index_done.set()
+
+    def run_feeder(self):
+        """
+        Queue filings waiting for download or parsing (runs in own thread). While index is being updated,
+        index is looked up again every poll interval.
+        """
+        queued = set()
+        while not self.stopped.is_set():
+            # Index is checked once more after indexing finished to pick up last filings
+            indexing = not self.index_done.is_set()
+            for acc_no in self.pending_filings():
+                if acc_no in queued:
+                    continue
+                if self.n_limit and len(queued) >= self.n_limit:
+                    return
+                if not self.put(self.download_queue, acc_no):
+                    return
+                queued.add(acc_no)
+            if not indexing:
+                return
+            self.index_done.wait(self.poll_interval)
+
+    def pending_filings(self):
+        """
+        Look up filings that have not been parsed yet.
+        :return: list of accession numbers in filing order
+        """
+        from models import IndexDb, Filing, Company
+        with IndexDb.get_session() as session:
+            q = session.query(Filing.acc_no) \
+                .filter(Company.cik == Filing.cik_trust) \
+                .filter(Filing.skip == False) \
+                .filter(Filing.duplicate_of == None) \
+                .filter(Filing.is_parsed == False) \
+                .filter(Company.asset_type.in_(self.asset_types)) \
+                .order_by(Filing.date_filing, Filing.acc_no)
+            if len(self.ind_trusts):
+                q = q.filter(Company.cik.in_(self.ind_trusts))
+            return [r.acc_no for r in q]
+
+    def run_downloader(self):
+        """
+        Download filings and pass local copies to parser (runs in own thread).
+        """
+        from models import iterate_filings
+        with profiler.stage('download'):
+            while True:
+                acc_no = self.get(self.download_queue)
+                if acc_no is DONE:
+                    return
+                row = next(iterate_filings([acc_no]), None)
+                if row is None:
+                    continue
+                file_path, temporary = self.fetch(row)
+                if file_path is None:
+                    continue
+                start = perf_counter()
+                if not self.put(self.parse_queue, (row, file_path, temporary)):
+                    return
+                metrics.observe('parse_queue_full_seconds', perf_counter() - start)
+
+    def fetch(self, row):
+        """
+        Get local copy of filing: download new filings from SEC, take stored filings from local storage or s3.
+        :param row: Filing and Company objects of filing
+        :return: tuple (local file path or None if not available, True if file has to be removed after parsing)
+        """
+        if not row.Filing.is_downloaded:
+            download_path = os.path.join(self.filings_path, filing_filename(row.Filing))
+            print(f"{ats()} Downloading document {row.Filing.url} ...")
+            try:
+                sha256 = FileDownloader.download(row.Filing.url, download_path)
+            except Exception:
+                sha256 = False
+            if not sha256:
+                print(f"{ats()} Could not download url: {row.Filing.url}")
+                return None, False
+            metrics.inc('filings_downloaded')
+            # Filings with the same content as earlier ones are skipped by parser
+            outcome, path = self.scraper.store_filing(row, download_path, sha256, self.filings_path, keep=True)
+            return path, self.use_s3
+        key = filing_key(row.Filing, row.Company)
+        if not self.use_s3:
+            path = os.path.join(self.filings_path, *key.split("/"))
+            return (path if os.path.exists(path) else None), False
+        entry = self.scraper.manifest.get(key, check=True)
+        if entry is None:
+            print(f'{ats()} Filing {key} is not in s3 bucket.')
+            return None, False
+        path = os.path.join(self.filings_path, key.split("/")[-1])
+        if self.scraper.cache.fetch(key, *entry, path):
+            return path, True
+        try:
+            with metrics.timer('s3_download_seconds'):
+                s3_resource().Bucket(defaults['s3_bucket']).download_file(key, path)
+        except Exception:
+            print(f'{ats()} Could not download filing {key} from s3.')
+            return None, False
+        if not self.scraper.manifest.verify(key, path):
+            print(f'{ats()} Downloaded filing {key} does not match s3 listing.')
+            os.remove(path)
+            return None, False
+        metrics.inc('s3_bytes_downloaded', os.path.getsize(path))
+        self.scraper.cache.put(key, *entry, path)
+        return path, True
+
+    def run_parser(self):
+        """
+        Parse downloaded filings and pass their trusts to flattener (runs in own thread).
+        """
+        from assets import AssetDb
+        AssetDb().setup()
+        with profiler.stage('parse'):
+            while True:
+                start = perf_counter()
+                item = self.get(self.parse_queue)
+                metrics.observe('parse_queue_wait_seconds', perf_counter() - start)
+                if item is DONE:
+                    return
+                row, file_path, temporary = item
+                try:
+                    with self.db_lock:
+                        parsed = self.parser.parse_row(row, file_path)
+                finally:
+                    if temporary and os.path.exists(file_path):
+                        os.remove(file_path)
+                # Flat table only holds auto loans
+                if parsed and row.Company.asset_type == 'autoloan':
+                    self.flatten_queue.put(row.Company.cik)
+
+    def run_flattener(self):
+        """
+        Fold parsed filings into flat table (runs in own thread). Trusts parsed while previous
+        ones were being flattened are processed together.
+        """
+        with profiler.stage('flatten'):
+            done = False
+            while not done:
+                trust_cik = self.get(self.flatten_queue)
+                trusts = set()
+                while True:
+                    if trust_cik is DONE:
+                        done = True
+                    else:
+                        trusts.add(trust_cik)
+                    try:
+                        trust_cik = self.flatten_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if len(trusts) == 0:
+                    continue
+                handler = AbsHandler(None, ind_trusts=sorted(trusts), incremental=True,
+                                     workers=self.flatten_workers, buckets=self.buckets)
+                with self.db_lock:
+                    handler.process()
+
+
+def main():
+
+    ap = argparse.ArgumentParser(description="End-to-end pipeline downloading, parsing and pre-processing "
+                                             "ABS-EE filings concurrently.")
+
+    ap.add_argument("-i", "--index", required=False, action='store_true', default=False,
+                    help="update index of filings while downloading")
+    ap.add_argument("-s", "--s3", required=False, action='store_true', default=False,
+                    help="use s3 bucket for storage. Run 'aws configure' before using this option.")
+    ap.add_argument("-n", "--number", required=False, type=int, default=0,
+                    help="number of filings to process")
+    ap.add_argument("-a", "--asset-type", required=False, type=str, default='autoloan:autolease',
+                    help="asset types separated by ':'")
+    ap.add_argument("-t", "--trust", required=False, type=str,
+                    help="trust ciks separated by ':'")
+    ap.add_argument("-d", "--download-workers", required=False, type=int, default=2,
+                    help="number of concurrent downloads")
+    ap.add_argument("-w", "--workers", required=False, type=int, default=1,
+                    help="number of flat table partitions processed concurrently")
+    ap.add_argument("-b", "--buckets", required=False, type=int, default=1,
+                    help="number of flat table partitions per trust (split by loan id)")
+    ap.add_argument("-q", "--queue-size", required=False, type=int, default=defaults['pipeline_queue_size'],
+                    help="max number of downloaded filings waiting for parsing")
+    ap.add_argument("--metrics", required=False, type=str, default=defaults['metrics_folder'],
+                    help="folder for run metrics in json and Prometheus textfile formats")
+    add_profile_arguments(ap)
+
+    args = vars(ap.parse_args())
+
+    asset_types = set(args['asset_type'].split(':'))
+    if not len(asset_types & {'autoloan', 'autolease'}):
+        print("Asset types can be autoloan:autolease.")
+        ap.print_help()
+        sys.exit(2)
+    if args['profile_mode'] not in profiler.modes:
+        print('Unknown profile mode:', args['profile_mode'])
+        ap.print_help()
+        sys.exit(2)
+    profiler.configure(args['profile'], args['profile_mode'], args['profile_memory'])
+
+    ind_trusts = []
+    if args['trust'] is not None:
+        ind_trusts = list(map(lambda x: int(x), args['trust'].split(":")))
+
+    pipeline = AbsPipeline(args['index'], args['s3'], args['number'], asset_types, ind_trusts,
+                           args['download_workers'], args['workers'], args['buckets'], args['queue_size'])
+    metrics.reset('abspipeline')
+    try:
+        finished = pipeline.run()
+    finally:
+        if args['metrics']:
+            metrics.export(args['metrics'])
+    if not finished:
+        sys.exit(1)
+    print(f"{ats()} Finished. Good job!")
+    ok()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import threading
+from time import monotonic
+from collections import OrderedDict
+from datetime import date
+from sqlalchemy import bindparam, case, func
+from sqlalchemy.ext import baked
+from config import defaults
+from metrics import metrics
+from assets import AssetDb, AssetFiling, Autoloan, AutoloanFlat, Loan, decoded_query, next_month, \
+    record_fields
+
+# Cache of compiled queries shared by all AbsQuery objects
+bakery = baked.bakery()
+
+
+class ResultCache(object):
+    """
+    LRU cache of query results bounded by total number of cached rows. Whole cache is dropped when parsed
+    data changes, which is detected by a cheap summary query over filings run at most every check interval.
+    """
+    def __init__(self, max_rows=defaults['query_cache_rows'], check_interval=defaults['query_cache_check_interval']):
+        """
+        :param max_rows: max total number of cached rows, results with more rows are not cached
+        :param check_interval: seconds between checks for new data, 0 to check on every lookup
+        """
+        self.max_rows = max_rows
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.rows = 0
+        self.version = None
+        self.checked = None
+
+    def lookup(self, key, load):
+        """
+        Get cached result or load and cache it.
+        :param key: hashable key of query and its parameters
+        :param load: function returning query results
+        :return: tuple of rows
+        """
+        self.check()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                metrics.inc('query_cache_hits')
+                return self.entries[key]
+            version = self.version
+        metrics.inc('query_cache_misses')
+        result = tuple(load())
+        with self.lock:
+            # Result loaded while data changed may be stale
+            if version == self.version and key not in self.entries and len(result) <= self.max_rows:
+                self.entries[key] = result
+                self.rows += len(result)
+                while self.rows > self.max_rows:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.rows -= len(evicted)
+        return result
+
+    def check(self):
+        """
+        Drop cached results if parsed data changed since last check.
+        :return: None
+        """
+        now = monotonic()
+        if self.checked is not None and now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        version = data_version()
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.rows = 0
+                self.version = version
+
+    def clear(self):
+        """
+        Drop all cached results.
+        :return: None
+        """
+        with self.lock:
+            self.entries.clear()
+            self.rows = 0
+            self.version = None
+            self.checked = None
+
+
+def data_version():
+    """
+    Summary of filings table that changes whenever filings are added, parsed (every committed batch),
+    flattened or dropped.
+    :return: tuple
+    """
+    with AssetDb.get_session() as session:
+        return tuple(session.query(
+            func.count(AssetFiling.accNo),
+            func.max(AssetFiling.accNo),
+            func.sum(AssetFiling.parsedAssets),
+            func.count(case([(AssetFiling.isFlattened == True, 1)])),
+            func.min(AssetFiling.periodStart),
+            func.max(AssetFiling.periodEnd)).one())
+
+
+class AbsQuery(object):
+    """
+    Read API over parsed auto loan data for dashboards and other consumers. Queries are built and compiled
+    once (baked queries) and results are cached in memory until new data is parsed. Results are tuples of
+    rows with fields accessible by name; dictionary-encoded fields hold original strings.
+    """
+    # Fields of panel records (with static attributes of loans) returned by history and snapshot queries
+    panel_fields = record_fields(Autoloan)
+
+    def __init__(self, cache=None):
+        """
+        :param cache: ResultCache object, new cache with default bounds if None
+        """
+        self.cache = cache if cache is not None else ResultCache()
+
+    def loan_history(self, trust_cik, asset_number):
+        """
+        Monthly records of a loan.
+        :param trust_cik: trust cik
+        :param asset_number: asset number of loan in trust's filings
+        :return: tuple of panel records ordered by reporting period
+        """
+        trust_cik, asset_number = int(trust_cik), str(asset_number)
+
+        def load():
+            bq = bakery(lambda s: decoded_query(s, Autoloan, AbsQuery.panel_fields))
+            bq += lambda q: q.join(Loan, Loan.loanId == Autoloan.loanId) \
+                .filter(Loan.trustCik == bindparam('trust_cik')) \
+                .filter(Loan.assetNumber == bindparam('asset_number')) \
+                .order_by(Autoloan.reportingPeriodEndingDate, Autoloan.filingAccNo)
+            with AssetDb.get_session() as session:
+                return bq(session).params(trust_cik=trust_cik, asset_number=asset_number).all()
+
+        return self.cache.lookup(('loan_history', trust_cik, asset_number), load)
+
+    def trust_snapshot(self, trust_cik, month):
+        """
+        Records of all loans of a trust in one reporting month.
+        :param trust_cik: trust cik
+        :param month: any day of reporting month
+        :return: tuple of panel records ordered by loan id
+        """
+        trust_cik, start = int(trust_cik), self.month_start(month)
+
+        def load():
+            bq = bakery(lambda s: decoded_query(s, Autoloan, AbsQuery.panel_fields))
+            bq += lambda q: q.join(AssetFiling, AssetFiling.accNo == Autoloan.filingAccNo) \
+                .filter(AssetFiling.trustCik == bindparam('trust_cik')) \
+                .filter(Autoloan.reportingPeriodEndingDate >= bindparam('start')) \
+                .filter(Autoloan.reportingPeriodEndingDate < bindparam('end')) \
+                .order_by(Autoloan.loanId, Autoloan.filingAccNo)
+            with AssetDb.get_session() as session:
+                return bq(session).params(trust_cik=trust_cik, start=start, end=next_month(start)).all()
+
+        return self.cache.lookup(('trust_snapshot', trust_cik, start), load)
+
+    def cohort(self, start, end=None, trust_ciks=None):
+        """
+        Flat records of loans originated in a range of months.
+        :param start: any day of first origination month
+        :param end: any day of last origination month, same as start if None
+        :param trust_ciks: list of trust ciks, all trusts if None
+        :return: tuple of flat records ordered by loan id
+        """
+        start = self.month_start(start)
+        end = next_month(self.month_start(end if end is not None else start))
+        trust_ciks = tuple(sorted(int(cik) for cik in trust_ciks)) if trust_ciks is not None else None
+
+        def load():
+            bq = bakery(lambda s: s.query(*AutoloanFlat.__table__.columns))
+            bq += lambda q: q.filter(AutoloanFlat.originationDate >= bindparam('start')) \
+                .filter(AutoloanFlat.originationDate < bindparam('end'))
+            params = {'start': start, 'end': end}
+            if trust_ciks is not None:
+                bq += lambda q: q.filter(AutoloanFlat.trustCik.in_(bindparam('trust_ciks', expanding=True)))
+                params['trust_ciks'] = list(trust_ciks)
+            bq += lambda q: q.order_by(AutoloanFlat.loanId)
+            with AssetDb.get_session() as session:
+                return bq(session).params(**params).all()
+
+        return self.cache.lookup(('cohort', start, end, trust_ciks), load)
+
+    @staticmethod
+    def month_start(day):
+        """
+        First day of month.
+        :param day: date or string in YYYY-MM or YYYY-MM-DD format
+        :return: date
+        """
+        if isinstance(day, str):
+            parts = day.split('-')
+            return date(int(parts[0]), int(parts[1]), 1)
+        return day.replace(day=1)
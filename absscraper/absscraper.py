@@ -3,19 +3,18 @@ import sys
 import os
 import shutil
 import re
-import requests
-import bs4
-import boto3
 from datetime import date
 from config import defaults
-from helpers import FileDownloader, ats, ok
-from models import IndexDb, Filing, Company
+from helpers import FileDownloader, ats, ok, s3_resource, filing_filename, filing_key
+from metrics import metrics
+from profiling import profiler, add_profile_arguments
 
 
 class AbsScraper(object):
 
     """
-    Web scraper class to scrape ABS-EE form data from SEC website.
+    Web scraper class to scrape ABS-EE form data from SEC website. Database models, requests and bs4
+    are imported by methods that use them, so that argument validation starts without loading them.
     """
 
     domain_name = 'https://searchwww.sec.gov'
@@ -25,7 +24,7 @@ class AbsScraper(object):
 
     def __init__(self, index=False, download=False, rebuild=False, use_s3=False, n_limit=0,
                  asset_types={'autoloan', 'autolease', 'rmbs'},
-                 start_date=defaults['start_date'], end_date=defaults['end_date']):
+                 start_date=defaults['start_date'], end_date=defaults['end_date'], lease=False):
         # Set run mode defaults
         self.rebuild = rebuild
         self.index = index
@@ -34,6 +33,10 @@ class AbsScraper(object):
         self.use_s3 = use_s3
         self.n_limit = n_limit
         self.asset_types = asset_types
+        self.lease = lease
+        # Listing of s3 bucket, set up with storage
+        self.manifest = None
+        self.cache = None
         # Build url
         self.start_url = self.url_str.format(domain=self.domain_name, start=start_date, end=end_date)
         # Define paths for saved html
@@ -45,11 +48,13 @@ class AbsScraper(object):
         Main class method that calls other methods depending on mode (index, download, update).
         :return: None
         """
+        indexed = True
         if self.index:
             if self.rebuild:
                 answer = input("You sure you want to rebuild? [yes/No]? ")
                 if answer.lower() == 'yes':
                     # Drop and recreate tables
+                    from models import IndexDb
                     db = IndexDb()
                     db.clear()
                     db.setup()
@@ -57,19 +62,26 @@ class AbsScraper(object):
                 else:
                     print(f"{ats()} Aborting...")
                     sys.exit(1)
-            self.build_index()
+            with profiler.stage('crawl'):
+                indexed = self.build_index()
 
         if self.download:
-            self.download_filings()
+            with profiler.stage('download'):
+                self.download_filings()
 
+        if not indexed:
+            print(f"{ats()} Finished with incomplete index. Run index update again to resume.")
+            sys.exit(1)
         print(f"{ats()} Finished. Good job!")
         ok()
 
     def build_index(self):
         """
         Iterate through search result pages and scrape them for filings information.
-        :return: None
+        Entries scraped before a request fails are kept, so that next index update resumes from them.
+        :return: True if all search result pages were scraped
         """
+        from governor import RequestFailed
         url = self.start_url
 
         # Search from last available date if not rebuilding and index is not empty
@@ -86,10 +98,19 @@ class AbsScraper(object):
         print(f"{ats()} Starting index build..." if self.rebuild else f"{ats()} Starting index update...")
         # Iterate through search results pages until no Next button found
         while True:
-            page = self.load_page(url)
-            # Scrape, parse and record into database current search results page
-            entries_counter += self.scrape_page(page)
+            try:
+                page = self.load_page(url)
+                # Scrape, parse and record into database current search results page
+                with metrics.timer('scrape_page_seconds'):
+                    entries = self.scrape_page(page)
+            except RequestFailed as e:
+                print(f'{ats()} Index update stopped after {page_counter} search result page(s): '
+                      f'could not load {e}')
+                return False
+            entries_counter += entries
             page_counter += 1
+            metrics.inc('pages_scraped')
+            metrics.inc('index_entries', entries)
             print(f"{ats()} Scraped results page {page_counter}, {entries_counter} entries...")
             # Get url of next search results page
             url = self.get_next(page)
@@ -107,6 +128,7 @@ class AbsScraper(object):
         else:
             print(f'{ats()} Index updated! Total {page_counter} search result page(s) scraped. '
                   f'{entries_counter} index entries (re)added.')
+        return True
 
     def scrape_page(self, page=None, counter=0, saved_page=False):
         """
@@ -124,6 +146,8 @@ class AbsScraper(object):
             except:
                 page = self.load_page()
 
+        import bs4
+        from models import IndexDb, Filing, Company
         soup = bs4.BeautifulSoup(page, features="html.parser")
         tables = soup.find_all("table", attrs={'xmlns:autn': "http://schemas.autonomy.com/aci/"})
         if len(tables) == 0:
@@ -231,6 +255,7 @@ class AbsScraper(object):
         cik = None
         trust = None
 
+        import bs4
         soup = bs4.BeautifulSoup(page, features="html.parser")
         # Extract trust's cik
         page_text = soup.get_text(" ", strip=True).replace("\n", " ")
@@ -255,6 +280,7 @@ class AbsScraper(object):
         if page is None:
             return None
 
+        import bs4
         soup = bs4.BeautifulSoup(page, features="html.parser")
         a_next = soup.select("a[title='Next Page']")
         if len(a_next) > 0:
@@ -265,18 +291,18 @@ class AbsScraper(object):
     @staticmethod
     def load_page(url):
         """
-        Load html content of a given url.
+        Load html content of a given url. Request is paced and retried by shared request governor.
         :param url: url of web page
         :return: html string
+        :raises RequestFailed: if page could not be loaded
         """
+        from governor import governor
         parameters = {'User-Agent': "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) \
         Chrome/69.0.3497.100 Safari/537.36"}
-        response = requests.get(url, params=parameters)
-
-        # Abort if server is responding with error
-        if not response.status_code == 200:
-            print("Server stopped responding. Execution aborted.")
-            sys.exit(1)
+        with metrics.timer('http_fetch_seconds'):
+            response = governor.get(url, params=parameters)
+        metrics.inc('http_requests')
+        metrics.inc('http_bytes', len(response.content))
 
         content = response.content.decode(response.encoding)
 
@@ -292,6 +318,7 @@ class AbsScraper(object):
         Look up most recent date's filings in the db.
         :return: list of dicts or empty dict
         """
+        from models import IndexDb, Filing
         with IndexDb.get_session() as session:
             last_filing = session.query(Filing).order_by(Filing.date_filing.desc()).first()
             if last_filing is None:
@@ -305,8 +332,8 @@ class AbsScraper(object):
         and launch download routine.
         :return: None
         """
-        filings = []
-
+        from models import IndexDb, Filing, Company, update_filings
+        from leases import FilingQueue, FilingLeases
         with IndexDb.get_session() as session:
             q = session.query(Filing, Company)\
                 .filter(Company.cik == Filing.cik_trust)\
@@ -318,34 +345,96 @@ class AbsScraper(object):
                 print("Index is empty! Please rebuild.")
                 sys.exit(1)
 
-            # Apply document limit
-            if self.n_limit:
-                q = q[:self.n_limit]
-
             # Only leave filings that have not been downloaded
             if self.rebuild:
+                # Storage is cleared on rebuild, so all filings have to be downloaded again
                 print(f"{ats()} Updating index...")
-                for row in q.all():
-                    row.Filing.is_downloaded=False
+                update_filings([r.acc_no for r in q.with_entities(Filing.acc_no)],
+                               {Filing.is_downloaded: False, Filing.sha256: None, Filing.duplicate_of: None})
                 print(f'{ats()} Done!')
             else:
-                q = q.filter(Filing.id_downloaded == False)
+                q = q.filter(Filing.is_downloaded == False)
 
             # Filter by user-defined asset type
             q = q.filter(Company.asset_type.in_(self.asset_types))
-            filings = q.all()
 
-        # Prepare storage
+            # Apply document limit
+            if self.n_limit:
+                q = q.limit(self.n_limit)
+
+            # Only keep accession numbers in memory, filings are loaded in chunks while downloading
+            acc_nos = [r.acc_no for r in q.with_entities(Filing.acc_no)]
+
+        filings_path = self.prepare_storage()
+
+        # Iterate through entries on the index
+        doc_counter = 0
+        duplicate_counter = 0
+        # Consecutive failed downloads
+        failed_counter = 0
+        aborted = False
+        # Filings are claimed in batches if work is shared with other workers
+        with (FilingLeases('download', acc_nos) if self.lease else FilingQueue(acc_nos)) as filings:
+            for row in filings: # row contains two objects: Filing and Company
+                # Download file to temporary location, final location depends on content hash
+                download_path = os.path.join(filings_path, filing_filename(row.Filing))
+                print("-"*5)
+                print(f"{ats()} Downloading document {row.Filing.url} ...")
+                downloaded = False
+                try:
+                    downloaded = FileDownloader.download(row.Filing.url, download_path)
+                except Exception:
+                    print(f"{ats()} Download failed for document {row.Filing.url} Skipping...")
+
+                if downloaded:
+                    failed_counter = 0
+                    print(f"{ats()} Downloaded successfully!")
+                    if self.store_filing(row, download_path, downloaded, filings_path)[0] == 'duplicate':
+                        duplicate_counter += 1
+                    doc_counter += 1
+                    metrics.inc('filings_downloaded')
+                    filings.complete(row.Filing.acc_no)
+                else:
+                    print(f"{ats()} Could not download url: {row.Filing.url}")
+                    filings.fail(row.Filing.acc_no)
+                    # Failed requests are already retried, so a run of failures means server is unavailable
+                    failed_counter += 1
+                    if failed_counter == defaults['download_max_failures']:
+                        print(f"{ats()} Failed downloading several documents. Aborting...")
+                        aborted = True
+                        break
+
+        # Keep uploaded objects in cached bucket listing
+        if self.manifest is not None:
+            self.manifest.save()
+        if aborted:
+            sys.exit(1)
+        if duplicate_counter:
+            print(f'{ats()} Skipped storing {duplicate_counter} duplicate documents.')
+        if self.use_s3:
+            print(f'{ats()} Finished. Downloaded and uploaded to s3 {doc_counter} documents.')
+        else:
+            print(f'{ats()} Finished. Downloaded {doc_counter} documents.')
+
+    def prepare_storage(self):
+        """
+        Prepare local folder or S3 bucket for filings (cleared on rebuild).
+        :return: local folder for downloaded files
+        """
         if self.use_s3:
-            # Use S3
+            from s3manifest import S3Manifest
+            from filecache import FileCache
+            # Use S3, project folder serves as temporary storage
             filings_path = os.path.dirname(__file__)
-            s3_client = boto3.client('s3')
-            bucket_name = defaults['s3_bucket']
-            s3_resource = boto3.resource('s3')
+            bucket = s3_resource().Bucket(defaults['s3_bucket'])
+            self.manifest = S3Manifest(bucket)
+            self.cache = FileCache()
             # Delete all folders in the bucket
             if self.rebuild:
-                bucket_obj = s3_resource.Bucket(bucket_name)
-                bucket_obj.objects.all().delete()
+                bucket.objects.all().delete()
+                self.manifest.clear()
+            else:
+                self.manifest.load()
         else:
             # Use local storage
             filings_path = os.path.join(os.path.dirname(__file__), defaults['filings_folder'])
@@ -355,70 +444,70 @@ class AbsScraper(object):
             # Create folder if not exists
             if not os.path.exists(filings_path):
                 os.mkdir(filings_path)
+        return filings_path
 
-        # Iterate through entries on the index
-        doc_counter = 0
-        for row in filings: # row contains two objects: Filing and Company
-            # Build filename
-            xml_name = row.Filing.url.split("/")[-1]  # Original filename from filing
-            filename = "_".join([row.Filing.date_filing.strftime("%Y-%m-%d"), str(row.Filing.acc_no), xml_name])
-            # Build filepath
-            if self.use_s3:
-                # Use project folder for temporary storage
-                subfolder_path = filings_path
-            else:
-                # Create folder tree
-                asset_path = os.path.join(filings_path, row.Company.asset_type)
-                if not os.path.exists(asset_path):
-                    os.mkdir(asset_path)
-                subfolder_path = os.path.join(asset_path, row.Company.name)
-                # Create subfolder if not exists
-                if not os.path.exists(subfolder_path):
-                    os.mkdir(subfolder_path)
-
-            # Download file
-            download_path = os.path.join(subfolder_path, filename)
-            print("-"*5)
-            print(f"{ats()} Downloading document {row.Filing.url} ...")
-            failed_counter = 0
-            downloaded = False
-            try:
-                downloaded = FileDownloader.download(row.Filing.url, download_path)
-            except:
-                print(f"{ats()} Download failed for document {row.Filing.url} Skipping...")
-                failed_counter += 1
-                if failed_counter == 5:
-                    print(f"{ats()} Failed downloading several documents. Aborting...")
-                    sys.exit(1)
-
-            if downloaded:
-                print(f"{ats()} Downloaded successfully!")
-                # Upload to s3
-                if self.use_s3 and downloaded:
-                    s3_path_components = [row.Company.asset_type, row.Company.name, filename]
-                    s3_path = "/".join(s3_path_components)
-                    try:
-                        # Check if file exists on s3
-                        s3_resource.Object(bucket_name, s3_path).load()
-                    except:
-                        print(f"{ats()} Uploading to s3...")
-                        s3_client.upload_file(download_path, bucket_name, s3_path)
-                        print(f'{ats()} Uploaded document {s3_path}')
-                        os.remove(download_path)
-                # Update index
-                with IndexDb.get_session() as session:
-                    f = session.query(Filing).get(row.Filing.acc_no)
-                    if f is not None:
-                        f.is_downloaded = True
-                        # f.update()
-                doc_counter += 1
+    def store_filing(self, row, download_path, sha256, filings_path, keep=False):
+        """
+        Save content hash of downloaded filing to index and move file to its storage location.
+        Files with the same content as earlier filings are not stored.
+        :param row: Filing and Company objects of filing
+        :param download_path: path of downloaded file
+        :param sha256: hex digest of file content
+        :param filings_path: local folder for filings
+        :param keep: keep local copy of file uploaded to s3 (has to be removed by caller)
+        :return: tuple (outcome, path): outcome is 'stored' or 'duplicate', path is local path of stored file
+                 (None for duplicates and files uploaded to s3 unless kept)
+        """
+        from models import IndexDb, Filing
+        with IndexDb.get_session() as session:
+            # Look for previously downloaded filing with identical content
+            original = session.query(Filing) \
+                .filter(Filing.sha256 == sha256) \
+                .filter(Filing.is_downloaded == True) \
+                .filter(Filing.acc_no != row.Filing.acc_no) \
+                .order_by(Filing.date_filing, Filing.acc_no).first()
+            f = session.query(Filing).get(row.Filing.acc_no)
+            f.sha256 = sha256
+            f.duplicate_of = original.acc_no if original is not None else None
+            storage_key = filing_key(f, row.Company)
+
+        outcome, path = 'stored', None
+        if original is not None:
+            print(f"{ats()} Same content as filing {original.acc_no}. Not storing duplicate.")
+            os.remove(download_path)
+            outcome = 'duplicate'
+            metrics.inc('duplicates_skipped')
+        elif self.use_s3:
+            # Upload to s3 unless bucket listing has the object (keys are content hashes, so content is the same)
+            entry = self.manifest.get(storage_key)
+            if entry is None:
+                print(f"{ats()} Uploading to s3...")
+                size = os.path.getsize(download_path)
+                with metrics.timer('s3_upload_seconds'):
+                    s3_resource().meta.client.upload_file(download_path, defaults['s3_bucket'], storage_key)
+                self.manifest.add(storage_key, size)
+                entry = (size, None)
+                metrics.inc('s3_bytes_uploaded', size)
+                print(f'{ats()} Uploaded document {storage_key}')
+            # Keep a copy for the parser
+            self.cache.put(storage_key, *entry, download_path)
+            if keep:
+                path = download_path
             else:
-                print(f"{ats()} Could not download url: {row.Filing.url}")
-
-        if self.use_s3:
-            print(f'{ats()} Finished. Downloaded and uploaded to s3 {doc_counter} documents.')
+                os.remove(download_path)
         else:
-            print(f'{ats()} Finished. Downloaded {doc_counter} documents.')
+            # Move to content-addressed location
+            path = os.path.join(filings_path, *storage_key.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(download_path, path)
+
+        # Update index
+        with IndexDb.get_session() as session:
+            f = session.query(Filing).get(row.Filing.acc_no)
+            if f is not None:
+                f.is_downloaded = True
+                # f.update()
+        return outcome, path
 
 
 def main():
@@ -437,6 +526,11 @@ def main():
                     help="number of filings to download/index")
     ap.add_argument("-a", "--asset-type", required=False, type=str, default='autoloan:autolease',
                     help="asset types for downloading separated by ':'. Ignored for indexing.")
+    ap.add_argument("--lease", required=False, action='store_true', default=False,
+                    help="share downloads with other workers using the same index database by leasing filings")
+    ap.add_argument("--metrics", required=False, type=str, default=defaults['metrics_folder'],
+                    help="folder for run metrics in json and Prometheus textfile formats")
+    add_profile_arguments(ap)
 
     args = vars(ap.parse_args())
 
@@ -451,9 +545,25 @@ def main():
         ap.print_help()
         sys.exit(2)
 
+    if args['lease'] and args['rebuild']:
+        print("Cannot use both lease and rebuild options.")
+        ap.print_help()
+        sys.exit(2)
+    if args['profile_mode'] not in profiler.modes:
+        print('Unknown profile mode:', args['profile_mode'])
+        ap.print_help()
+        sys.exit(2)
+    profiler.configure(args['profile'], args['profile_mode'], args['profile_memory'])
+
     # Initiate and run scraper
-    scraper = AbsScraper(args['index'], args['download'], args['rebuild'], args['s3'], args['number'], asset_types)
-    scraper.dispatch()
+    scraper = AbsScraper(args['index'], args['download'], args['rebuild'], args['s3'], args['number'], asset_types,
+                         lease=args['lease'])
+    metrics.reset('absscraper')
+    try:
+        scraper.dispatch()
+    finally:
+        if args['metrics']:
+            metrics.export(args['metrics'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,270 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import Float, select, type_coerce
+from config import defaults
+from assets import AssetFiling, Autoloan, Dictionary, PoolCurve, PoolTransition, next_month
+
+
+class PanelAnalytics(object):
+    """
+    Delinquency transitions and prepayment and loss curves of auto loan pools computed with vectorized array
+    operations. Panel of a trust is read one reporting month at a time in columnar batches from the database
+    or from Parquet files, and only states of the previous month's loans are carried over, so memory is bounded
+    by the number of loans in a pool rather than the length of the panel.
+    """
+    # Loan states: days delinquent (under 30, 30-59, 60-89, 90-119, 120 and more), then states of loans leaving pool
+    states = ['current', 'dq30', 'dq60', 'dq90', 'dq120', 'prepaid', 'chargedoff', 'closed']
+
+    # Lower bounds of days delinquent of delinquency states
+    delinquency_bounds = [30, 60, 90, 120]
+
+    # States of zero balance codes in order of precedence (4: charged off, 1: prepaid or matured),
+    # loans with other codes (e.g. repurchased) are closed
+    zero_balance_states = {'4': 'chargedoff', '1': 'prepaid'}
+
+    # Amount fields read from panel
+    amount_fields = ['reportingPeriodBeginningLoanBalanceAmount', 'reportingPeriodActualEndBalanceAmount',
+                     'scheduledPrincipalAmount', 'chargedoffPrincipalAmount', 'recoveredAmount']
+
+    def __init__(self, parquet_path=None, chunk_size=defaults['vector_chunk_size']):
+        """
+        :param parquet_path: file or folder with Parquet files holding autoloans table, database is used if None
+        :param chunk_size: number of panel rows read at once
+        """
+        self.parquet_path = parquet_path
+        self.chunk_size = chunk_size
+        self.read_fields = ['loanId', 'filingAccNo', 'reportingPeriodEndingDate', 'currentDelinquencyStatus',
+                            'zeroBalanceCode'] + self.amount_fields
+        # Loans in these states stay in pool
+        self.active_states = len(self.delinquency_bounds) + 1
+
+    def run(self, session, trust_cik):
+        """
+        Compute transitions and curves of trust and replace its stored results.
+        :param session: database session
+        :param trust_cik: trust cik
+        :return: number of panel records read
+        """
+        filings = session.query(AssetFiling.accNo, AssetFiling.periodStart, AssetFiling.periodEnd) \
+            .filter(AssetFiling.trustCik == trust_cik) \
+            .filter(AssetFiling.isComplete == True).all()
+        zero_states = self.zero_balance_codes(session)
+        curves = []
+        transitions = []
+        records = 0
+        # Sorted loan ids, states and ending balances of loans staying in pool in previous month
+        previous = None
+        for month in self.months(session, filings):
+            acc_nos = [f.accNo for f in filings if f.periodStart is None
+                       or (f.periodStart < next_month(month) and f.periodEnd >= month)]
+            frame = self.read_month(session, acc_nos, month)
+            records += len(frame)
+            if len(frame) == 0:
+                # Transitions are only counted between consecutive months
+                previous = None
+                continue
+            period = frame['reportingPeriodEndingDate'].max()
+            loan_ids = frame['loanId'].to_numpy()
+            state = self.loan_states(frame, zero_states)
+            curves.append(self.curve(period, frame, state))
+            if previous is not None:
+                transitions.append(self.transitions(period, previous, loan_ids, state))
+            active = state < self.active_states
+            balance = frame['reportingPeriodActualEndBalanceAmount'].fillna(0).to_numpy()
+            previous = (loan_ids[active], state[active], balance[active])
+        self.store(session, trust_cik, curves, transitions)
+        return records
+
+    @staticmethod
+    def months(session, filings):
+        """
+        First days of months from trust's first to last reporting period.
+        :param session: database session
+        :param filings: list of trust's filings with accession numbers and reporting period ranges
+        :return: generator of dates
+        """
+        starts = [f.periodStart for f in filings]
+        ends = [f.periodEnd for f in filings]
+        if None in starts or None in ends:
+            # Filings parsed before reporting periods were recorded
+            periods = [r[0] for r in session.query(Autoloan.reportingPeriodEndingDate)
+                       .filter(Autoloan.filingAccNo.in_([f.accNo for f in filings])).distinct()
+                       if r[0] is not None]
+            starts = ends = periods
+        if len(starts) == 0:
+            return
+        month, last = min(starts).replace(day=1), max(ends)
+        while month <= last:
+            yield month
+            month = next_month(month)
+
+    def zero_balance_codes(self, session):
+        """
+        Look up states of loans by zero balance code.
+        :param session: database session
+        :return: dict of state indexes by value id (and by original string for Parquet files exported before
+                 encoding)
+        """
+        codes = {}
+        for r in session.query(Dictionary).filter(Dictionary.field == 'zeroBalanceCode'):
+            parts = r.value.split('|')
+            state = next((s for code, s in self.zero_balance_states.items() if code in parts), 'closed')
+            codes[r.valueId] = codes[r.value] = self.states.index(state)
+        return codes
+
+    def read_month(self, session, acc_nos, month):
+        """
+        Read panel records of one reporting month. Loans reported by several filings (e.g. amended ones)
+        are taken from the latest filing.
+        :param session: database session
+        :param acc_nos: accession numbers of filings holding the month
+        :param month: first day of month
+        :return: DataFrame with read fields ordered by loan id
+        """
+        batches = [batch for batch in self.batches(session, acc_nos, month) if len(batch)]
+        if len(batches) == 0:
+            return pd.DataFrame(columns=self.read_fields)
+        frame = pd.concat(batches, ignore_index=True)
+        # Records parsed before loan ids were introduced cannot be followed over time
+        frame = frame[frame['loanId'].notna()].astype({'loanId': 'int64'})
+        for field in self.amount_fields:
+            frame[field] = pd.to_numeric(frame[field], errors='coerce')
+        frame = frame.sort_values(['loanId', 'filingAccNo'], kind='stable').drop_duplicates('loanId', keep='last')
+        return frame.reset_index(drop=True)
+
+    def batches(self, session, acc_nos, month):
+        """
+        Read needed panel columns of one reporting month in batches.
+        :return: generator of DataFrames
+        """
+        if len(acc_nos) == 0:
+            return
+        if self.parquet_path:
+            import pyarrow.dataset as ds
+            dataset = ds.dataset(self.parquet_path, format='parquet')
+            period = ds.field('reportingPeriodEndingDate')
+            condition = ds.field('filingAccNo').isin(acc_nos) & (period >= month) & (period < next_month(month))
+            for batch in dataset.to_batches(columns=self.read_fields, filter=condition, batch_size=self.chunk_size):
+                yield batch.to_pandas()
+            return
+        table = Autoloan.__table__
+        # Amounts are read as floats, skipping conversion to Decimal objects
+        columns = [type_coerce(table.c[f], Float).label(f) if f in self.amount_fields else table.c[f]
+                   for f in self.read_fields]
+        q = select(columns) \
+            .where(table.c.filingAccNo.in_(acc_nos)) \
+            .where(table.c.reportingPeriodEndingDate >= month) \
+            .where(table.c.reportingPeriodEndingDate < next_month(month))
+        result = session.execute(q.execution_options(stream_results=True))
+        while True:
+            rows = result.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records(rows, columns=self.read_fields)
+
+    def loan_states(self, frame, zero_states):
+        """
+        State of each loan at end of reporting period.
+        :param frame: DataFrame of one reporting month
+        :param zero_states: dict of state indexes by zero balance code
+        :return: array of state indexes
+        """
+        days = pd.to_numeric(frame['currentDelinquencyStatus'], errors='coerce').fillna(0).to_numpy()
+        state = np.searchsorted(self.delinquency_bounds, days, side='right')
+        closed = frame['zeroBalanceCode'].map(zero_states).to_numpy(dtype='float64', na_value=np.nan)
+        state = np.where(np.isnan(closed), state, closed).astype(int)
+        state[frame['chargedoffPrincipalAmount'].fillna(0).to_numpy() > 0] = self.states.index('chargedoff')
+        return state
+
+    def curve(self, period, frame, state):
+        """
+        Summarize prepayments and losses of one reporting month.
+        :param period: reporting period ending date
+        :param frame: DataFrame of one reporting month
+        :param state: array of state indexes of loans
+        :return: dict of curve fields
+        """
+        begin = frame['reportingPeriodBeginningLoanBalanceAmount'].fillna(0).to_numpy()
+        end = frame['reportingPeriodActualEndBalanceAmount'].fillna(0).to_numpy()
+        scheduled = np.minimum(frame['scheduledPrincipalAmount'].fillna(0).to_numpy(), begin)
+        # Balance reduction beyond schedule of loans that kept paying or were paid off
+        paying = state <= self.states.index('prepaid')
+        prepaid = np.where(paying, np.clip(begin - end - scheduled, 0, None), 0)
+        base = (begin - scheduled).sum()
+        return {
+            'reportingPeriodEndingDate': period,
+            'loanCount': len(frame),
+            'beginningBalance': begin.sum(),
+            'endingBalance': end.sum(),
+            'scheduledPrincipal': scheduled.sum(),
+            'prepaidAmount': prepaid.sum(),
+            'smm': prepaid.sum() / base if base > 0 else np.nan,
+            'chargedoffAmount': frame['chargedoffPrincipalAmount'].fillna(0).sum(),
+            'recoveredAmount': frame['recoveredAmount'].fillna(0).sum()
+        }
+
+    def transitions(self, period, previous, loan_ids, state):
+        """
+        Count loans by state in previous and current month. Loans missing from current month are not counted.
+        :param period: reporting period ending date
+        :param previous: tuple of sorted loan ids, states and ending balances of active loans in previous month
+        :param loan_ids: sorted loan ids of current month
+        :param state: array of state indexes of current month
+        :return: DataFrame with loan counts, balances and rates of non-empty transitions
+        """
+        previous_ids, previous_state, previous_balance = previous
+        n = len(self.states)
+        index = np.searchsorted(loan_ids, previous_ids)
+        found = index < len(loan_ids)
+        found[found] = loan_ids[index[found]] == previous_ids[found]
+        pairs = previous_state[found] * n + state[index[found]]
+        counts = np.bincount(pairs, minlength=n * n).reshape(n, n)
+        balances = np.bincount(pairs, weights=previous_balance[found], minlength=n * n).reshape(n, n)
+        totals = counts.sum(axis=1, keepdims=True)
+        rates = np.divide(counts, totals, out=np.zeros((n, n)), where=totals > 0)
+        from_state, to_state = np.nonzero(counts)
+        states = np.array(self.states)
+        return pd.DataFrame({
+            'reportingPeriodEndingDate': period,
+            'fromState': states[from_state],
+            'toState': states[to_state],
+            'loanCount': counts[from_state, to_state],
+            'balance': balances[from_state, to_state],
+            'rate': rates[from_state, to_state]
+        })
+
+    def store(self, session, trust_cik, curves, transitions):
+        """
+        Replace stored results of trust. Cumulative losses and pool factor are relative to the beginning
+        balance of the first reporting period.
+        :param session: database session
+        :param trust_cik: trust cik
+        :param curves: list of dicts of curve fields by reporting month
+        :param transitions: list of DataFrames of transitions by reporting month
+        :return: None
+        """
+        session.query(PoolCurve).filter(PoolCurve.trustCik == trust_cik).delete(synchronize_session=False)
+        session.query(PoolTransition).filter(PoolTransition.trustCik == trust_cik).delete(synchronize_session=False)
+        if len(curves):
+            frame = pd.DataFrame(curves)
+            initial = frame['beginningBalance'].iloc[0] or np.nan
+            frame['cpr'] = 1 - (1 - frame['smm']) ** 12
+            frame['cumulativeNetLoss'] = (frame['chargedoffAmount'] - frame['recoveredAmount']).cumsum()
+            frame['cumulativeNetLossRate'] = frame['cumulativeNetLoss'] / initial
+            frame['poolFactor'] = frame['endingBalance'] / initial
+            frame['trustCik'] = trust_cik
+            session.execute(PoolCurve.__table__.insert(), self.records(frame))
+        if len(transitions):
+            frame = pd.concat(transitions, ignore_index=True)
+            frame['trustCik'] = trust_cik
+            session.execute(PoolTransition.__table__.insert(), self.records(frame))
+
+    @staticmethod
+    def records(frame):
+        """
+        Convert frame to list of dicts suitable for bulk insert.
+        :param frame: DataFrame
+        :return: list of dicts
+        """
+        frame = frame.astype(object).where(frame.notna(), None)
+        return frame.to_dict('records')
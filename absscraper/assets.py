@@ -1,14 +1,142 @@
-from config import db_config
-from sqlalchemy import create_engine, ForeignKey
+import os
+import hashlib
+from decimal import Decimal, InvalidOperation
+from datetime import date, datetime
+from config import db_config, defaults
+from sqlalchemy import create_engine, text, true, select, ForeignKey, Sequence, Index, UniqueConstraint
 from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, Date
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, aliased
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 from contextlib import contextmanager
+from helpers import ats, migrate_schema
 from sqlalchemy.types import DECIMAL
+from sqlalchemy.dialects import mysql
 
 AssetBase = declarative_base()
 
+# Engines shared by AssetDb instances, keyed by uri and process id
+engines = {}
+
+
+def build_engine_uri(config):
+    """
+    Build SQLAlchemy engine uri for configured database backend.
+    :param config: dict with database settings (see config.db_config)
+    :return: uri string
+    """
+    # Full engine uri in config takes precedence over other settings
+    if config.get('db_uri'):
+        return config['db_uri']
+    if config['db_type'] in ('sqlite', 'duckdb'):
+        # Embedded databases only need a file
+        return "{0}:///{1}".format(config['db_type'], config['db_file'])
+    return "{0}+pymysql://{1}:{2}@{3}:{4}/{5}".format(
+        config['db_type'],
+        config['db_user'], config['db_password'], config['db_host'],
+        config['db_port'], config['db_name'])
+
+
+def next_month(day):
+    """
+    First day of month following the day's month.
+    """
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    """
+    Name of panel table partition holding records of month.
+    """
+    return 'p' + month.strftime('%Y%m')
+
+
+def partition_definitions(months, lower=True, upper=True):
+    """
+    Build MySQL RANGE COLUMNS partition definitions with a partition per month and ones for earlier and later dates.
+    :param months: list of first days of months in ascending order
+    :param lower: add partition for dates before first month
+    :param upper: add partition for dates after last month
+    :return: string
+    """
+    partitions = [f"PARTITION {partition_name(m)} VALUES LESS THAN ('{next_month(m).isoformat()}')" for m in months]
+    if lower:
+        partitions.insert(0, f"PARTITION pmin VALUES LESS THAN ('{months[0].isoformat()}')")
+    if upper:
+        partitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+    return ", ".join(partitions)
+
+
+def exact_string(length):
+    """
+    String type of identifiers compared byte by byte. MySQL compares strings case-insensitively by default,
+    so unique keys differing only by case would collide. Trailing spaces are still ignored by MySQL
+    and have to be stripped before values are stored.
+    :param length: max length of string
+    :return: type object
+    """
+    return String(length).with_variant(mysql.VARCHAR(length, charset='utf8mb4', collation='utf8mb4_bin'), 'mysql')
+
+
+def encoded_column(length):
+    """
+    Column of string field with few distinct values, stored as id of value in dictionary table.
+    :param length: max length of original string
+    :return: Column object
+    """
+    return Column(Integer, info={'encoded': String(length)})
+
+
+def encoded_fields(model):
+    """
+    Names of dictionary-encoded fields of model.
+    """
+    return [c.key for c in model.__table__.columns if 'encoded' in c.info]
+
+
+def static_fields(model):
+    """
+    Names of static fields of asset records kept in model's loan dimension.
+    """
+    if getattr(model, 'static_model', None) is None:
+        return []
+    return [c.key for c in model.static_model.__table__.columns if c.key not in model.static_model.meta_fields]
+
+
+def record_fields(model):
+    """
+    Names of all fields of asset records, monthly and static.
+    """
+    return [c.key for c in model.__table__.columns] + static_fields(model)
+
+
+def normalized_value(column, value):
+    """
+    Comparable form of field value, equal for values parsed from xml and values loaded from database.
+    :param column: Column object
+    :param value: field value
+    :return: normalized value
+    """
+    if value is None or isinstance(value, (bool, date)):
+        return value
+    if isinstance(column.type, (Integer, DECIMAL)):
+        try:
+            return Decimal(str(value)).normalize()
+        except InvalidOperation:
+            pass
+    return str(value).strip()
+
+
+def static_hash(static):
+    """
+    Hash of static attributes of loan.
+    :param static: AutoloanStatic object
+    :return: hex string
+    """
+    values = [normalized_value(c, getattr(static, c.key, None)) for c in type(static).__table__.columns
+              if c.key not in static.meta_fields]
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
 
 class AssetDb(object):
     """
@@ -16,11 +144,13 @@ class AssetDb(object):
     """
     def __init__(self):
         self.db_config = db_config
-        engine_uri = "{0}+pymysql://{1}:{2}@{3}:{4}/{5}".format(
-            db_config['db_type'],
-            db_config['db_user'], db_config['db_password'], db_config['db_host'],
-            db_config['db_port'], db_config['db_name'])
-        self.engine = create_engine(engine_uri, echo=False)
+        engine_uri = build_engine_uri(db_config)
+        key = (engine_uri, os.getpid())
+        if key not in engines:
+            engines[key] = create_engine(engine_uri, echo=False)
+            # Bring database created by earlier versions up to date
+            migrate_schema(engines[key], AssetBase.metadata)
+        self.engine = engines[key]
         self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
 
     def setup(self):
@@ -29,6 +159,97 @@ class AssetDb(object):
         :return:
         """
         AssetBase.metadata.create_all(self.engine)
+        if self.is_partitioned():
+            for model in [Autoloan, Autolease]:
+                self.partition_table(model)
+
+    def is_partitioned(self):
+        """
+        Check if panel tables are partitioned by month of reporting period.
+        :return: True if partitioning is configured and supported by database
+        """
+        return self.engine.dialect.name == 'mysql' and self.db_config.get('partitioning') == 'month'
+
+    def partitions(self, table_name):
+        """
+        Look up partitions of MySQL table.
+        :param table_name: table name
+        :return: list of partition names
+        """
+        rows = self.engine.execute(text(
+            "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name AND PARTITION_NAME IS NOT NULL"),
+            table_name=table_name)
+        return [r[0] for r in rows]
+
+    def partition_table(self, model):
+        """
+        Partition panel table by month of reporting period or add partitions for new months.
+        Partitions are created up to next month, later records go to the last partition.
+        :param model: Autoloan or Autolease
+        :return: None
+        """
+        table_name = model.__tablename__
+        period = model.period_field
+        month = datetime.strptime(self.db_config.get('partition_start', '2016-01'), '%Y-%m').date()
+        months = []
+        while month <= next_month(date.today()):
+            months.append(month)
+            month = next_month(month)
+        existing = self.partitions(table_name)
+        with self.engine.begin() as conn:
+            if len(existing) == 0:
+                print(f"{ats()} Partitioning table {table_name}...")
+                # Partitioned tables cannot have foreign keys, unique keys must contain partitioning column
+                foreign_keys = conn.execute(text(
+                    "SELECT CONSTRAINT_NAME FROM information_schema.TABLE_CONSTRAINTS "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name "
+                    "AND CONSTRAINT_TYPE = 'FOREIGN KEY'"), table_name=table_name).fetchall()
+                for r in foreign_keys:
+                    conn.execute(f"ALTER TABLE `{table_name}` DROP FOREIGN KEY `{r[0]}`")
+                unique_keys = conn.execute(text(
+                    "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name "
+                    "AND NON_UNIQUE = 0 AND INDEX_NAME != 'PRIMARY'"), table_name=table_name).fetchall()
+                primary_key = model.__table__.primary_key.columns.keys()[0]
+                changes = [f"DROP INDEX `{r[0]}`" for r in unique_keys] + \
+                          ["DROP PRIMARY KEY", f"ADD PRIMARY KEY (`{primary_key}`, `{period}`)"]
+                conn.execute(f"ALTER TABLE `{table_name}` " + ", ".join(changes))
+                conn.execute(f"ALTER TABLE `{table_name}` PARTITION BY RANGE COLUMNS(`{period}`) "
+                             f"({partition_definitions(months)})")
+            else:
+                monthly = sorted(p for p in existing if p not in ('pmin', 'pmax'))
+                if 'pmin' not in existing:
+                    # Tables partitioned without lower partition keep earlier dates in first month's partition
+                    first = datetime.strptime(monthly[0][1:], '%Y%m').date()
+                    conn.execute(f"ALTER TABLE `{table_name}` REORGANIZE PARTITION {monthly[0]} "
+                                 f"INTO ({partition_definitions([first], upper=False)})")
+                new_months = [m for m in months if partition_name(m) > monthly[-1]]
+                if len(new_months):
+                    conn.execute(f"ALTER TABLE `{table_name}` REORGANIZE PARTITION pmax "
+                                 f"INTO ({partition_definitions(new_months, lower=False)})")
+
+    def drop_period(self, model, month):
+        """
+        Delete panel records of one reporting month. Month's partition is truncated if tables are partitioned.
+        :param model: Autoloan or Autolease
+        :param month: first day of month
+        :return: None
+        """
+        table_name = model.__tablename__
+        partitions = self.partitions(table_name) if self.is_partitioned() else []
+        # Without lower partition, first month's partition also holds all earlier dates
+        lowest = min((p for p in partitions if p != 'pmax'), default=None)
+        if partition_name(month) in partitions and ('pmin' in partitions or partition_name(month) != lowest):
+            with self.engine.begin() as conn:
+                conn.execute(f"ALTER TABLE `{table_name}` TRUNCATE PARTITION {partition_name(month)}")
+            return
+        period = getattr(model, model.period_field)
+        with AssetDb.get_session() as session:
+            session.query(model) \
+                .filter(period >= month) \
+                .filter(period < next_month(month)) \
+                .delete(synchronize_session=False)
 
     def setup_table(self, table_name):
         AssetBase.metadata.tables[table_name].create(self.engine)
@@ -61,68 +282,230 @@ class AssetDb(object):
             session.close()
 
 
+def stream(q, chunk_size=defaults['stream_chunk_size']):
+    """
+    Iterate over query results fetching a chunk of rows at a time. Uses server-side cursor
+    where supported (MySQL SSCursor), so that result set is not buffered on client.
+    Session must not run other queries until iteration is finished.
+    :param q: query
+    :param chunk_size: number of rows fetched at once
+    :return: query set up for streaming
+    """
+    return q.execution_options(stream_results=True).yield_per(chunk_size)
+
+
 class AssetFiling(AssetBase):
     """
     Filing class.
     """
     __tablename__ = 'filings'
 
-    accNo = Column(BigInteger, primary_key=True, unique=True, nullable=False)
-    trustCik = Column(Integer)
-    trustName = Column(String(255))
+    accNo = Column(BigInteger, primary_key=True, unique=True, nullable=False, autoincrement=False)
+    trustCik = Column(Integer, index=True)
+    trustName = Column(String(255), index=True)
     url = Column(String(255), nullable=False)
     dateFiling = Column(Date)
     assetType = Column(String(32))
     dateAdd = Column(DateTime(timezone=True), server_default=func.now())
+    # Parse checkpoint: ordinal of last asset record committed to db
+    parsedAssets = Column(Integer, default=0)
+    # Filings stored before checkpoints were introduced were only committed once fully parsed
+    isComplete = Column(Boolean, default=False, info={'backfill': True})
+    # Filing has been folded into flat table
+    isFlattened = Column(Boolean, default=False)
+    # Filing has been summarized in monthly pool table
+    isPooled = Column(Boolean, default=False)
+    # Range of reporting periods of filing's records, used to limit scans to partitions holding them
+    periodStart = Column(Date)
+    periodEnd = Column(Date)
 
     def __repr__(self):
         return f"<AssetFiling(dateFiling={self.dateFiling}, trustName={self.trustName}, acc_no={self.accNo})>"
 
 
-class Autoloan(AssetBase):
+def period_filter(session, period, acc_nos):
     """
-    Auto loan records class.
+    Build filter restricting panel records to reporting periods of filings, so that only partitions
+    holding their records are scanned.
+    :param session: database session
+    :param period: reporting period column of panel table
+    :param acc_nos: accession numbers of filings
+    :return: sql expression, always true if reporting periods of some filings are unknown
     """
-    __tablename__ = 'autoloans'
+    start, end, n_filings, n_known = session.query(
+        func.min(AssetFiling.periodStart), func.max(AssetFiling.periodEnd),
+        func.count(), func.count(AssetFiling.periodStart)) \
+        .filter(AssetFiling.accNo.in_(acc_nos)).one()
+    if n_filings == 0 or n_known < n_filings:
+        return true()
+    return period.between(start, end)
 
-    autoloanId = Column(Integer, primary_key=True, nullable=False, autoincrement=True, unique=True)
-    filingAccNo = Column(BigInteger, ForeignKey(AssetFiling.accNo), nullable=False)
-    assetTypeNumber = Column(String(100))
-    assetNumber = Column(String(25))
-    reportingPeriodBeginningDate = Column(Date)
-    reportingPeriodEndingDate = Column(Date)
-    originatorName = Column(String(50))
+
+class Loan(AssetBase):
+    """
+    Loan (lease) identifiers class. Maps trust's cik and asset number to a compact integer id.
+    """
+    __tablename__ = 'loans'
+    __table_args__ = (UniqueConstraint('trustCik', 'assetNumber'),)
+
+    loanId = Column(Integer, Sequence('loans_id_seq'), primary_key=True, nullable=False, autoincrement=True)
+    trustCik = Column(Integer, nullable=False)
+    assetNumber = Column(exact_string(255), nullable=False)
+
+    def __repr__(self):
+        return f"<Loan(loanId={self.loanId}, trustCik={self.trustCik}, assetNumber={self.assetNumber})>"
+
+
+class Dictionary(AssetBase):
+    """
+    Values of dictionary-encoded string fields of asset records.
+    """
+    __tablename__ = 'dictionary'
+    __table_args__ = (UniqueConstraint('field', 'value'),)
+
+    valueId = Column(Integer, Sequence('dictionary_id_seq'), primary_key=True, nullable=False, autoincrement=True)
+    field = Column(String(64), nullable=False)
+    value = Column(exact_string(255), nullable=False)
+
+    def __repr__(self):
+        return f"<Dictionary(valueId={self.valueId}, field={self.field}, value={self.value})>"
+
+
+def encoded_value(field, value):
+    """
+    Look up id of encoded value in sql.
+    :param field: field name
+    :param value: original string value
+    :return: scalar subquery
+    """
+    return select([Dictionary.valueId]) \
+        .where(Dictionary.field == field) \
+        .where(Dictionary.value == value) \
+        .as_scalar()
+
+
+def decoded_query(session, model, fields, *entities):
+    """
+    Query fields of asset records with dictionary-encoded values replaced by original strings.
+    :param session: database session
+    :param model: Autoloan or Autolease
+    :param fields: names of fields to select, static fields are joined from loan dimension
+    :param entities: other columns to select
+    :return: query selecting from model table
+    """
+    static = static_fields(model)
+    columns = []
+    joins = []
+    for field in fields:
+        source = model.static_model if field in static else model
+        column = getattr(source, field)
+        if 'encoded' in source.__table__.columns[field].info:
+            values = aliased(Dictionary, name='dict_' + field)
+            joins.append((values, values.valueId == column))
+            column = values.value
+        columns.append(column.label(field))
+    q = session.query(*columns, *entities).select_from(model)
+    if any(field in static for field in fields):
+        q = q.outerjoin(model.static_model, model.static_model.loanId == model.loanId)
+    for values, onclause in joins:
+        q = q.outerjoin(values, onclause)
+    return q
+
+
+class AutoloanStatic(AssetBase):
+    """
+    Static attributes of auto loans (origination, vehicle and obligor), stored once per loan instead of in
+    every monthly record. Hash of values lets parser skip loans whose attributes did not change; changed
+    attributes are updated to the latest filing and logged in static_changes table.
+    """
+    __tablename__ = 'autoloans_static'
+
+    # Fields other than loan attributes
+    meta_fields = ('loanId', 'staticHash', 'staticPeriod')
+
+    loanId = Column(Integer, primary_key=True, nullable=False, autoincrement=False)
+    staticHash = Column(String(40))
+    # Reporting period of record the attributes were taken from
+    staticPeriod = Column(Date)
+    assetTypeNumber = encoded_column(100)
+    originatorName = encoded_column(50)
     originationDate = Column(Date)
     originalLoanAmount = Column(DECIMAL(20, 8))
     originalLoanTerm = Column(Integer)
     loanMaturityDate = Column(Date)
     originalInterestRatePercentage = Column(DECIMAL(20, 8))
-    interestCalculationTypeCode = Column(String(255))
-    originalInterestRateTypeCode = Column(String(255))
+    interestCalculationTypeCode = encoded_column(255)
+    originalInterestRateTypeCode = encoded_column(255)
     originalInterestOnlyTermNumber = Column(Integer)
     originalFirstPaymentDate = Column(Date)
     underwritingIndicator = Column(Boolean)
     gracePeriodNumber = Column(Integer)
-    paymentTypeCode = Column(String(255))
-    subvented = Column(String(255))
-    vehicleManufacturerName = Column(String(30))
-    vehicleModelName = Column(String(30))
-    vehicleNewUsedCode = Column(String(255))
+    paymentTypeCode = encoded_column(255)
+    subvented = encoded_column(255)
+    vehicleManufacturerName = encoded_column(30)
+    vehicleModelName = encoded_column(30)
+    vehicleNewUsedCode = encoded_column(255)
     vehicleModelYear = Column(String(4))
-    vehicleTypeCode = Column(String(255))
+    vehicleTypeCode = encoded_column(255)
     vehicleValueAmount = Column(DECIMAL(20, 8))
-    vehicleValueSourceCode = Column(String(255))
-    obligorCreditScoreType = Column(String(35))
+    vehicleValueSourceCode = encoded_column(255)
+    obligorCreditScoreType = encoded_column(35)
     obligorCreditScore = Column(String(20))
-    obligorIncomeVerificationLevelCode = Column(String(255))
-    obligorEmploymentVerificationCode = Column(String(255))
+    obligorIncomeVerificationLevelCode = encoded_column(255)
+    obligorEmploymentVerificationCode = encoded_column(255)
     coObligorIndicator = Column(Boolean)
     paymentToIncomePercentage = Column(DECIMAL(20, 8))
-    obligorGeographicLocation = Column(String(100))
+    obligorGeographicLocation = encoded_column(100)
+
+    def __repr__(self):
+        return f"<AutoloanStatic(loanId={self.loanId})>"
+
+
+class StaticChange(AssetBase):
+    """
+    Log of changes of static loan attributes between filings.
+    """
+    __tablename__ = 'static_changes'
+
+    changeId = Column(Integer, Sequence('static_changes_id_seq'), primary_key=True, nullable=False,
+                      autoincrement=True)
+    loanId = Column(Integer, nullable=False, index=True)
+    filingAccNo = Column(BigInteger, nullable=False)
+    reportingPeriod = Column(Date)
+    field = Column(String(64), nullable=False)
+    oldValue = Column(String(255))
+    newValue = Column(String(255))
+    dateAdd = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f"<StaticChange(loanId={self.loanId}, field={self.field})>"
+
+
+class Autoloan(AssetBase):
+    """
+    Auto loan records class.
+    """
+    __tablename__ = 'autoloans'
+    __table_args__ = (Index('ix_autoloans_filing_asset', 'filingAccNo', 'assetNumber'),
+                      Index('ix_autoloans_loan_period', 'loanId', 'reportingPeriodEndingDate'))
+
+    # Reporting period column (tables can be partitioned by it)
+    period_field = 'reportingPeriodEndingDate'
+
+    # Loan dimension with static attributes
+    static_model = AutoloanStatic
+
+    autoloanId = Column(Integer, Sequence('autoloans_id_seq'), primary_key=True, nullable=False,
+                        autoincrement=True, unique=True)
+    filingAccNo = Column(BigInteger, ForeignKey(AssetFiling.accNo), nullable=False)
+    loanId = Column(Integer)
+    assetNumber = Column(String(25))
+    reportingPeriodBeginningDate = Column(Date)
+    reportingPeriodEndingDate = Column(Date)
     assetAddedIndicator = Column(Boolean)
     remainingTermToMaturityNumber = Column(Integer)
     reportingPeriodModificationIndicator = Column(Boolean)
-    servicingAdvanceMethodCode = Column(String(255))
+    servicingAdvanceMethodCode = encoded_column(255)
     reportingPeriodBeginningLoanBalanceAmount = Column(DECIMAL(20, 8))
     nextReportingPeriodPaymentAmountDue = Column(DECIMAL(20, 8))
     reportingPeriodInterestRatePercentage = Column(DECIMAL(20, 8))
@@ -143,19 +526,19 @@ class Autoloan(AssetBase):
     servicerAdvancedAmount = Column(DECIMAL(20, 8))
     interestPaidThroughDate = Column(Date)
     zeroBalanceEffectiveDate = Column(Date)
-    zeroBalanceCode = Column(String(255))
+    zeroBalanceCode = encoded_column(255)
     currentDelinquencyStatus = Column(Integer)
-    primaryLoanServicerName = Column(String(100))
+    primaryLoanServicerName = encoded_column(100)
     mostRecentServicingTransferReceivedDate = Column(Date)
     assetSubjectDemandIndicator = Column(Boolean)
-    assetSubjectDemandStatusCode = Column(String(255))
+    assetSubjectDemandStatusCode = encoded_column(255)
     repurchaseAmount = Column(DECIMAL(20, 8))
     demandResolutionDate = Column(Date)
-    repurchaserName = Column(String(30))
-    repurchaseReplacementReasonCode = Column(String(255))
+    repurchaserName = encoded_column(30)
+    repurchaseReplacementReasonCode = encoded_column(255)
     chargedoffPrincipalAmount = Column(DECIMAL(20, 8))
     recoveredAmount = Column(DECIMAL(20, 8))
-    modificationTypeCode = Column(String(255))
+    modificationTypeCode = encoded_column(255)
     paymentExtendedNumber = Column(Integer)
     repossessedIndicator = Column(Boolean)
     repossessedProceedsAmount = Column(DECIMAL(20, 8))
@@ -202,14 +585,24 @@ class Autolease(AssetBase):
     Auto lease records class.
     """
     __tablename__ = 'autoleases'
+    __table_args__ = (Index('ix_autoleases_filing_asset', 'filingAccNo', 'assetNumber'),
+                      Index('ix_autoleases_loan_period', 'loanId', 'reportingPeriodEndDate'))
+
+    # Reporting period column (tables can be partitioned by it)
+    period_field = 'reportingPeriodEndDate'
 
-    autoleaseId = Column(Integer, primary_key=True, nullable=False, autoincrement=True, unique=True)
+    # Lease records keep all attributes in monthly records
+    static_model = None
+
+    autoleaseId = Column(Integer, Sequence('autoleases_id_seq'), primary_key=True, nullable=False,
+                         autoincrement=True, unique=True)
     filingAccNo = Column(BigInteger, nullable=False)
-    assetTypeNumber = Column(String(255))
+    loanId = Column(Integer)
+    assetTypeNumber = encoded_column(255)
     assetNumber = Column(String(255))
     reportingPeriodBeginDate = Column(Date)
     reportingPeriodEndDate = Column(Date)
-    originatorName = Column(String(255))
+    originatorName = encoded_column(255)
     originationDate = Column(Date)
     acquisitionCost = Column(DECIMAL(20, 8))
     originalLeaseTermNumber = Column(Integer)
@@ -217,29 +610,29 @@ class Autolease(AssetBase):
     originalFirstPaymentDate = Column(Date)
     underwritingIndicator = Column(Boolean)
     gracePeriod = Column(Integer)
-    paymentTypeCode = Column(String(255))
-    subvented = Column(String(255))
-    vehicleManufacturerName = Column(String(255))
-    vehicleModelName = Column(String(255))
-    vehicleNewUsedCode = Column(String(255))
+    paymentTypeCode = encoded_column(255)
+    subvented = encoded_column(255)
+    vehicleManufacturerName = encoded_column(255)
+    vehicleModelName = encoded_column(255)
+    vehicleNewUsedCode = encoded_column(255)
     vehicleModelYear = Column(String(255))
-    vehicleTypeCode = Column(String(255))
+    vehicleTypeCode = encoded_column(255)
     vehicleValueAmount = Column(DECIMAL(20, 8))
-    vehicleValueSourceCode = Column(String(255))
+    vehicleValueSourceCode = encoded_column(255)
     baseResidualValue = Column(DECIMAL(20, 8))
-    baseResidualSourceCode = Column(String(255))
+    baseResidualSourceCode = encoded_column(255)
     contractResidualValue = Column(DECIMAL(20, 8))
-    lesseeCreditScoreType = Column(String(255))
+    lesseeCreditScoreType = encoded_column(255)
     lesseeCreditScore = Column(String(255))
-    lesseeIncomeVerificationLevelCode = Column(String(255))
-    lesseeEmploymentVerificationCode = Column(String(255))
+    lesseeIncomeVerificationLevelCode = encoded_column(255)
+    lesseeEmploymentVerificationCode = encoded_column(255)
     coLesseePresentIndicator = Column(Boolean)
     paymentToIncomePercentage = Column(DECIMAL(20, 8))
-    lesseeGeographicLocation = Column(String(255))
+    lesseeGeographicLocation = encoded_column(255)
     assetAddedIndicator = Column(Boolean)
     remainingTermNumber = Column(Integer)
     reportingPeriodModificationIndicator = Column(Boolean)
-    servicingAdvanceMethodCode = Column(String(255))
+    servicingAdvanceMethodCode = encoded_column(255)
     reportingPeriodSecuritizationValueAmount = Column(DECIMAL(20, 8))
     securitizationDiscountRate = Column(DECIMAL(20, 8))
     nextReportingPeriodPaymentAmountDue = Column(DECIMAL(20, 8))
@@ -255,20 +648,20 @@ class Autolease(AssetBase):
     servicerAdvancedAmount = Column(DECIMAL(20, 8))
     paidThroughDate = Column(Date)
     zeroBalanceEffectiveDate = Column(Date)
-    zeroBalanceCode = Column(String(255))
+    zeroBalanceCode = encoded_column(255)
     currentDelinquencyStatus = Column(Integer)
-    primaryLeaseServicerName = Column(String(255))
+    primaryLeaseServicerName = encoded_column(255)
     mostRecentServicingTransferReceivedDate = Column(Date)
     assetSubjectDemandIndicator = Column(Boolean)
-    assetSubjectDemandStatusCode = Column(String(255))
+    assetSubjectDemandStatusCode = encoded_column(255)
     repurchaseAmount = Column(DECIMAL(20, 8))
     DemandResolutionDate = Column(Date)
-    repurchaserName = Column(String(255))
-    repurchaseOrReplacementReasonCode = Column(String(255))
+    repurchaserName = encoded_column(255)
+    repurchaseOrReplacementReasonCode = encoded_column(255)
     chargedOffAmount = Column(DECIMAL(20, 8))
-    modificationTypeCode = Column(String(255))
+    modificationTypeCode = encoded_column(255)
     leaseExtended = Column(Integer)
-    terminationIndicator = Column(String(255))
+    terminationIndicator = encoded_column(255)
     excessFeeAmount = Column(DECIMAL(20, 8))
     liquidationProceedsAmount = Column(DECIMAL(20, 8))
     dateAdd = Column(DateTime(timezone=True), server_default=func.now())
@@ -306,7 +699,8 @@ class AutoloanFlat(AssetBase):
     """
     __tablename__ = 'autoloans_flat'
 
-    trustAssetNumber = Column(String(64), primary_key=True, nullable=False, unique=True)
+    loanId = Column(Integer, primary_key=True, nullable=False, autoincrement=False)
+    trustAssetNumber = Column(String(64), nullable=False, unique=True)
     dateFirstFiling = Column(Date)
     trustCik = Column(Integer)
     assetNumber = Column(String(25))
@@ -344,4 +738,119 @@ class AutoloanFlat(AssetBase):
         'delinquency90Days',
         'repossessedIndicator',
         'repossessedDate'
-    ]
\ No newline at end of file
+    ]
+
+    # How values aggregated from new filings are merged into existing records in incremental mode.
+    # Fields not listed keep first seen value.
+    merge_rules = {
+        'dateFirstFiling': 'min',
+        'zeroBalanceEffectiveDate': 'min',
+        'zeroBalanceCode': 'min',
+        'delinquency30Days': 'min',
+        'delinquency90Days': 'min',
+        'repossessedIndicator': 'max',
+        'repossessedDate': 'min'
+    }
+
+
+class FlatPartition(AssetBase):
+    """
+    Status of flat table partition (trust and loan id bucket) processed by handler.
+    """
+    __tablename__ = 'flat_partitions'
+
+    trustCik = Column(Integer, primary_key=True, autoincrement=False)
+    bucket = Column(Integer, primary_key=True, autoincrement=False)
+    buckets = Column(Integer, default=1)
+    status = Column(String(16))
+    attempts = Column(Integer, default=0)
+    error = Column(String(255))
+    dateUpd = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<FlatPartition(trustCik={self.trustCik}, bucket={self.bucket}, status={self.status})>"
+
+
+class PoolMonthly(AssetBase):
+    """
+    Monthly performance of auto loan pools. Summary of panel data by trust and reporting period.
+    """
+    __tablename__ = 'pool_monthly'
+
+    trustCik = Column(Integer, primary_key=True, autoincrement=False)
+    reportingPeriodEndingDate = Column(Date, primary_key=True)
+    loanCount = Column(Integer)
+    beginningBalance = Column(DECIMAL(20, 2))
+    endingBalance = Column(DECIMAL(20, 2))
+    # Number of loans by days delinquent: under 30, 30-59, 60-89, 90-119, 120 and more
+    currentCount = Column(Integer)
+    delinquent30Count = Column(Integer)
+    delinquent60Count = Column(Integer)
+    delinquent90Count = Column(Integer)
+    delinquent120Count = Column(Integer)
+    # Ending balance of loans 30 and more days delinquent
+    delinquentBalance = Column(DECIMAL(20, 2))
+    chargedoffCount = Column(Integer)
+    chargedoffAmount = Column(DECIMAL(20, 2))
+    recoveredAmount = Column(DECIMAL(20, 2))
+    repossessedCount = Column(Integer)
+    # Loans paid off in full during period and their beginning balance
+    prepaidCount = Column(Integer)
+    prepaidAmount = Column(DECIMAL(20, 2))
+    dateUpd = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<PoolMonthly(trustCik={self.trustCik}, reportingPeriodEndingDate={self.reportingPeriodEndingDate})>"
+
+
+class PoolTransition(AssetBase):
+    """
+    Month-over-month transitions of auto loans between delinquency states: loans of a trust by state in
+    previous reporting period and state in this one. Rates of transitions from a state are its roll rates.
+    """
+    __tablename__ = 'pool_transitions'
+
+    trustCik = Column(Integer, primary_key=True, autoincrement=False)
+    reportingPeriodEndingDate = Column(Date, primary_key=True)
+    fromState = Column(String(16), primary_key=True)
+    toState = Column(String(16), primary_key=True)
+    loanCount = Column(Integer)
+    # Ending balance of loans in previous period
+    balance = Column(DECIMAL(20, 2))
+    # Share of loans in previous state that moved to this state
+    rate = Column(DECIMAL(20, 8))
+    dateUpd = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<PoolTransition(trustCik={self.trustCik}, reportingPeriodEndingDate=" \
+               f"{self.reportingPeriodEndingDate}, fromState={self.fromState}, toState={self.toState})>"
+
+
+class PoolCurve(AssetBase):
+    """
+    Prepayment and loss curves of auto loan pools by reporting period.
+    """
+    __tablename__ = 'pool_curves'
+
+    trustCik = Column(Integer, primary_key=True, autoincrement=False)
+    reportingPeriodEndingDate = Column(Date, primary_key=True)
+    loanCount = Column(Integer)
+    beginningBalance = Column(DECIMAL(20, 2))
+    endingBalance = Column(DECIMAL(20, 2))
+    scheduledPrincipal = Column(DECIMAL(20, 2))
+    # Principal paid in excess of scheduled principal, including loans paid off in full
+    prepaidAmount = Column(DECIMAL(20, 2))
+    # Single monthly mortality and its annualized conditional prepayment rate
+    smm = Column(DECIMAL(20, 8))
+    cpr = Column(DECIMAL(20, 8))
+    chargedoffAmount = Column(DECIMAL(20, 2))
+    recoveredAmount = Column(DECIMAL(20, 2))
+    # Charge-offs net of recoveries since first reporting period, amount and share of initial pool balance
+    cumulativeNetLoss = Column(DECIMAL(20, 2))
+    cumulativeNetLossRate = Column(DECIMAL(20, 8))
+    # Ending balance as share of initial pool balance
+    poolFactor = Column(DECIMAL(20, 8))
+    dateUpd = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<PoolCurve(trustCik={self.trustCik}, reportingPeriodEndingDate={self.reportingPeriodEndingDate})>"
@@ -0,0 +1,126 @@
+import os
+import shutil
+import hashlib
+import threading
+from config import defaults
+from metrics import metrics
+
+
+class FileCache(object):
+    """
+    Size-bounded local cache of files downloaded from S3, shared by the downloader and the parser, so that
+    reparsing filings does not download them again. Entries are keyed by S3 key and ETag (by size for own
+    uploads whose ETag is not listed yet) and evicted least recently used first when the cache outgrows its
+    byte budget. Cached files are handed out as hard links, so evicting an entry does not affect a copy
+    being parsed. State is kept in the file system only, so several processes can share a cache folder.
+    """
+    def __init__(self, folder=None, max_bytes=defaults['file_cache_max_bytes']):
+        """
+        :param folder: cache folder, defaults to file_cache_folder in project folder
+        :param max_bytes: max total size of cached files, 0 to disable cache
+        """
+        self.folder = folder or os.path.join(os.path.dirname(__file__), defaults['file_cache_folder'])
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if self.max_bytes:
+            os.makedirs(self.folder, exist_ok=True)
+
+    def names(self, key, size, etag=None):
+        """
+        File names an object may be cached under, most specific first.
+        :param key: S3 key
+        :param size: object size in bytes
+        :param etag: object ETag if known
+        :return: list of file names
+        """
+        prefix = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        names = [f'{prefix}.{etag}'] if etag else []
+        return names + [f'{prefix}.s{size}']
+
+    def fetch(self, key, size, etag, local_path):
+        """
+        Put cached copy of object at local path.
+        :param key: S3 key
+        :param size: object size in bytes
+        :param etag: object ETag if known
+        :param local_path: local file path
+        :return: True if object was cached
+        """
+        if not self.max_bytes:
+            return False
+        for name in self.names(key, size, etag):
+            path = os.path.join(self.folder, name)
+            try:
+                # Mark entry as recently used
+                os.utime(path)
+                self.link(path, local_path)
+            except OSError:
+                continue
+            metrics.inc('file_cache_hits')
+            metrics.inc('file_cache_bytes', size)
+            return True
+        metrics.inc('file_cache_misses')
+        return False
+
+    def put(self, key, size, etag, local_path):
+        """
+        Add downloaded or uploaded file to cache.
+        :param key: S3 key
+        :param size: object size in bytes
+        :param etag: object ETag if known
+        :param local_path: local file path (left in place)
+        :return: None
+        """
+        if not self.max_bytes or size > self.max_bytes:
+            return
+        path = os.path.join(self.folder, self.names(key, size, etag)[0])
+        temp_path = os.path.join(self.folder, f'.{os.getpid()}-{threading.get_ident()}.tmp')
+        try:
+            self.link(local_path, temp_path)
+            os.replace(temp_path, path)
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until cache fits into its budget.
+        :return: None
+        """
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.folder):
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(e[1] for e in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+                metrics.inc('file_cache_evictions')
+
+    @staticmethod
+    def link(source_path, target_path):
+        """
+        Hard link file, or copy it if the two paths are on different file systems.
+        :param source_path: existing file
+        :param target_path: new file (replaced if it exists)
+        :return: None
+        """
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        try:
+            os.link(source_path, target_path)
+        except OSError:
+            if not os.path.exists(source_path):
+                raise
+            shutil.copyfile(source_path, target_path)
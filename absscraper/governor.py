@@ -0,0 +1,197 @@
+import random
+import threading
+from time import monotonic, sleep
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from config import defaults
+from helpers import ats
+from metrics import metrics
+
+
+class RequestFailed(Exception):
+    """
+    Request did not succeed after all retries (or was not retried).
+    """
+    def __init__(self, url, reason, response=None):
+        super().__init__(f'{url}: {reason}')
+        self.url = url
+        self.response = response
+
+
+class CircuitOpen(RequestFailed):
+    """
+    Request was not sent because host kept failing and its circuit is open.
+    """
+
+
+class HostState(object):
+    """
+    Token bucket and circuit breaker state of one host.
+    """
+    def __init__(self, rate, burst):
+        """
+        :param rate: requests per second
+        :param burst: max number of requests sent at once after idle time
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        # Consecutive failed requests and time until which circuit stays open
+        self.failures = 0
+        self.open_until = 0.0
+
+
+class RequestGovernor(object):
+    """
+    Rate limiter shared by all http requests of a process. Requests to each host are paced by a token bucket,
+    failed requests (connection errors, 429 and 5xx responses) are retried with exponential backoff and jitter,
+    or after the delay asked by Retry-After header. Throttled requests (429, 503) halve the request rate of the
+    host, which then creeps back to configured rate with every successful request. A host that keeps failing
+    is not contacted for a while (circuit is open), then a single trial request decides whether to resume.
+    """
+    def __init__(self, rate=defaults['request_rate'], min_rate=defaults['request_min_rate'],
+                 burst=defaults['request_burst'], retries=defaults['request_retries'],
+                 backoff=defaults['request_backoff'], max_backoff=defaults['request_max_backoff'],
+                 circuit_failures=defaults['circuit_failures'], circuit_seconds=defaults['circuit_seconds'],
+                 timeout=defaults['request_timeout']):
+        """
+        :param rate: max requests per second to each host
+        :param min_rate: requests per second the rate never drops below when throttled
+        :param burst: max number of requests sent at once after idle time
+        :param retries: max number of retries of a failed request
+        :param backoff: delay before first retry in seconds, doubled with every retry
+        :param max_backoff: max delay before a retry in seconds (also caps Retry-After)
+        :param circuit_failures: number of consecutive failures that open circuit of host
+        :param circuit_seconds: seconds circuit stays open before trial request
+        :param timeout: connect and read timeout of requests in seconds
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.circuit_failures = circuit_failures
+        self.circuit_seconds = circuit_seconds
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def get(self, url, **kwargs):
+        """
+        Send GET request, retrying failures.
+        :param url: url
+        :param kwargs: other arguments of requests.get
+        :return: response with status 200
+        """
+        import requests
+        host = urlsplit(url).netloc
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            self.acquire(host, url)
+            response = None
+            try:
+                response = requests.get(url, **kwargs)
+            except requests.RequestException as e:
+                reason = type(e).__name__
+            else:
+                if response.status_code == 200:
+                    self.succeeded(host)
+                    return response
+                reason = f'status {response.status_code}'
+                if response.status_code != 429 and response.status_code < 500:
+                    # Client errors other than throttling are not retried and do not count against host
+                    raise RequestFailed(url, reason, response)
+                response.close()
+            metrics.inc('http_errors')
+            delay = self.failed(host, response, attempt)
+            if attempt == self.retries:
+                break
+            print(f'{ats()} Request to {url} failed ({reason}). Retrying in {delay:.1f} s...')
+            metrics.inc('http_retries')
+            sleep(delay)
+        raise RequestFailed(url, f'{reason} after {self.retries} retries', response)
+
+    def acquire(self, host, url):
+        """
+        Wait for token of host's bucket.
+        :param host: host name
+        :param url: url (for error message)
+        :return: None
+        """
+        with self.lock:
+            state = self.hosts.setdefault(host, HostState(self.rate, self.burst))
+            now = monotonic()
+            if state.failures >= self.circuit_failures:
+                if now < state.open_until:
+                    raise CircuitOpen(url, f'circuit of {host} open for {state.open_until - now:.0f} s')
+                # Half-open: this request is a trial, others wait until it fails or succeeds
+                state.open_until = now + self.circuit_seconds
+            state.tokens = min(state.burst, state.tokens + (now - state.updated) * state.rate)
+            state.updated = now
+            # Reserve token now and wait for it outside lock, so that waiting threads are served in order
+            state.tokens -= 1
+            wait = -state.tokens / state.rate if state.tokens < 0 else 0
+        if wait > 0:
+            metrics.observe('http_throttle_seconds', wait)
+            sleep(wait)
+
+    def succeeded(self, host):
+        """
+        Close circuit of host and raise its rate towards configured rate.
+        :param host: host name
+        :return: None
+        """
+        with self.lock:
+            state = self.hosts[host]
+            state.failures = 0
+            state.rate = min(self.rate, state.rate + self.rate / 100)
+
+    def failed(self, host, response, attempt):
+        """
+        Record failed request, slow down host if throttled and open its circuit if it keeps failing.
+        :param host: host name
+        :param response: response object, None on connection error
+        :param attempt: number of retries so far
+        :return: seconds to wait before retry
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1)
+        with self.lock:
+            state = self.hosts[host]
+            if response is not None and response.status_code in (429, 503):
+                state.rate = max(self.min_rate, state.rate / 2)
+                metrics.inc('http_throttled')
+                print(f'{ats()} Throttled by {host}, rate lowered to {state.rate:.2f} requests/s.')
+                retry_after = self.retry_after(response)
+                if retry_after is not None:
+                    delay = min(self.max_backoff, retry_after)
+            state.failures += 1
+            if state.failures == self.circuit_failures:
+                print(f'{ats()} {host} keeps failing, pausing requests for {self.circuit_seconds} s.')
+                metrics.inc('circuits_opened')
+            if state.failures >= self.circuit_failures:
+                state.open_until = monotonic() + self.circuit_seconds
+        return delay
+
+    @staticmethod
+    def retry_after(response):
+        """
+        Read delay from Retry-After header.
+        :param response: response object
+        :return: seconds, None if header is missing or invalid
+        """
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+# Governor shared by all modules
+governor = RequestGovernor()
@@ -1,12 +1,15 @@
-import requests
+import hashlib
 from datetime import datetime
+from config import defaults
+from metrics import metrics
 
 
 # CLASSES
 class FileDownloader(object):
 
     """
-    Helper class for downloading large files.
+    Helper class for downloading large files. Requests go through shared request governor,
+    which paces and retries them.
     """
 
     @staticmethod
@@ -15,20 +18,29 @@ class FileDownloader(object):
         Downloads and saves a single document.
         :param url: document url
         :param save_path: relative file path for saving the document
-        :return: True is download was successful, False if unsuccessful
+        :return: sha256 hex digest of document content if download was successful, False if unsuccessful
         """
-        response = requests.get(url, stream=True)
-        if not response.status_code == 200:
-            print("Could not reach url: {}".format(url))
-            return False
+        from governor import governor, RequestFailed
+        with metrics.timer('http_fetch_seconds'):
+            try:
+                response = governor.get(url, stream=True)
+            except RequestFailed as e:
+                print("Could not reach url: {}".format(e))
+                return False
+            metrics.inc('http_requests')
 
-        with open(save_path, 'wb') as file_handle:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    file_handle.write(chunk)
+            sha256 = hashlib.sha256()
+            size = 0
+            with open(save_path, 'wb') as file_handle:
+                for chunk in response.iter_content(chunk_size=1024):
+                    if chunk:
+                        file_handle.write(chunk)
+                        sha256.update(chunk)
+                        size += len(chunk)
+        metrics.inc('http_bytes', size)
 
         # print('Downloaded file {} to path "{}"...'.format(url, save_path))
-        return True
+        return sha256.hexdigest()
 
     @staticmethod
     def preview_download(url):
@@ -36,10 +48,13 @@ class FileDownloader(object):
         Downloads first 5Kb of a file from provided url
         :return: string with first 5Kb of a file
         """
-        response = requests.get(url, stream=True)
-        if not response.status_code == 200:
-            print("Could not reach url: {}".format(url))
+        from governor import governor, RequestFailed
+        try:
+            response = governor.get(url, stream=True)
+        except RequestFailed as e:
+            print("Could not reach url: {}".format(e))
             return None
+        metrics.inc('http_requests')
 
         content_arr = []
         # Not using iter_lines below because some files do not contain line breaks
@@ -52,6 +67,92 @@ class FileDownloader(object):
 
 
 # FUNCTIONS
+def s3_resource():
+    """
+    Create boto3 S3 resource pointing to AWS or to a custom endpoint set in config.
+    :return: boto3 S3 resource
+    """
+    import boto3
+    return boto3.resource('s3', endpoint_url=defaults['s3_endpoint_url'])
+
+
+def filing_filename(filing):
+    """
+    Build original name of saved filing file.
+    :param filing: Filing object
+    :return: filename string
+    """
+    xml_name = filing.url.split("/")[-1]  # Original filename from filing
+    return "_".join([filing.date_filing.strftime("%Y-%m-%d"), str(filing.acc_no), xml_name])
+
+
+def filing_key(filing, company):
+    """
+    Build storage key of filing file (relative path in filings folder or S3 key). Filings with known
+    content hash are stored once per content, older filings are stored under trust folders.
+    :param filing: Filing object
+    :param company: trust's Company object
+    :return: key string with '/' separators
+    """
+    if filing.sha256:
+        return "/".join([company.asset_type, 'content', filing.sha256[:2], filing.sha256 + '.xml'])
+    return "/".join([company.asset_type, company.name, filing_filename(filing)])
+
+
+def migrate_schema(engine, metadata):
+    """
+    Add columns and indexes introduced after tables of existing database were created. Existing rows get
+    the column's scalar default, or the value in its 'backfill' info key if it differs for old rows.
+    Changed column types are not migrated.
+    :param engine: SQLAlchemy engine
+    :param metadata: MetaData of tables
+    :return: None
+    """
+    from sqlalchemy import inspect
+    from sqlalchemy.schema import CreateColumn, CreateIndex
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            print(f"{ats()} Adding column {column.name} to table {table.name}...")
+            definition = CreateColumn(column).compile(dialect=engine.dialect)
+            try:
+                with engine.begin() as conn:
+                    conn.execute(f"ALTER TABLE {engine.dialect.identifier_preparer.format_table(table)} "
+                                 f"ADD COLUMN {definition}")
+            except Exception:
+                # Another process may have added it first
+                if column.name not in {c['name'] for c in inspect(engine).get_columns(table.name)}:
+                    raise
+                continue
+            default = column.default.arg if column.default is not None and column.default.is_scalar else None
+            value = column.info.get('backfill', default)
+            if value is not None:
+                with engine.begin() as conn:
+                    conn.execute(table.update().values({column.name: value}))
+        if engine.dialect.name in ('sqlite', 'duckdb'):
+            # DuckDB cannot reflect indexes, embedded databases create missing ones themselves
+            with engine.begin() as conn:
+                for index in table.indexes:
+                    ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+                    conn.execute(ddl.replace(' INDEX ', ' INDEX IF NOT EXISTS ', 1))
+            continue
+        indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                print(f"{ats()} Adding index {index.name} to table {table.name}...")
+                try:
+                    index.create(engine)
+                except Exception:
+                    if index.name not in {i['name'] for i in inspect(engine).get_indexes(table.name)}:
+                        raise
+
+
 def ats():
     """
     Produces current timestamp string in YYYY-MM-DD hh:mm:ss format
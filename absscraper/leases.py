@@ -0,0 +1,174 @@
+import os
+import socket
+import threading
+from uuid import uuid4
+from datetime import datetime, timedelta
+from sqlalchemy import or_, func
+from config import defaults
+from helpers import ats
+from models import IndexDb, Filing, iterate_filings
+
+
+class FilingQueue(object):
+    """
+    Filings processed by a single worker in given order. Base class of shared work queue, so that
+    callers mark processed filings the same way with or without leases.
+    """
+    def __init__(self, acc_nos):
+        """
+        :param acc_nos: accession numbers of filings in processing order
+        """
+        self.acc_nos = acc_nos
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def __iter__(self):
+        """
+        :return: generator of rows with Filing and Company objects
+        """
+        return iterate_filings(self.acc_nos)
+
+    def complete(self, acc_no):
+        pass
+
+    def fail(self, acc_no):
+        pass
+
+
+class FilingLeases(FilingQueue):
+    """
+    Work queue on top of filings table shared by several worker processes (possibly on different machines).
+    A worker claims a batch of filings by leasing them for a limited time and renews its leases with heartbeats
+    while working. Leases of workers that died expire and filings are claimed again by other workers.
+    Filings that failed max attempts times are no longer claimed. Clocks of worker machines must be in sync.
+    """
+    # Condition of filings waiting for each stage
+    stages = {
+        'download': Filing.is_downloaded == False,
+        'parse': Filing.is_parsed == False
+    }
+
+    def __init__(self, stage, acc_nos, batch_size=defaults['lease_batch_size'],
+                 lease_seconds=defaults['lease_seconds'], max_attempts=defaults['lease_max_attempts']):
+        """
+        :param stage: download or parse
+        :param acc_nos: accession numbers of candidate filings in processing order
+        :param batch_size: number of filings claimed at once
+        :param lease_seconds: lease duration
+        :param max_attempts: max number of claims of a filing
+        """
+        super().__init__(acc_nos)
+        self.stage = stage
+        self.batch_size = batch_size
+        self.lease = timedelta(seconds=lease_seconds)
+        self.max_attempts = max_attempts
+        self.owner = f"{socket.gethostname()[:40]}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+
+    def __enter__(self):
+        # Renew leases a few times per lease period
+        self.heartbeat_thread = threading.Thread(target=self.run_heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.heartbeat_thread.join()
+        # Filings still leased (e.g. on interruption) can be claimed by others right away
+        self.release()
+
+    def __iter__(self):
+        """
+        Claim batches of candidate filings until none can be claimed. Caller has to mark each filing
+        with complete or fail once it is processed.
+        :return: generator of rows with Filing and Company objects
+        """
+        while True:
+            claimed_any = False
+            # Scan candidates in windows, filings leased by other workers are skipped
+            for i in range(0, len(self.acc_nos), self.batch_size):
+                claimed = self.claim(self.acc_nos[i:i + self.batch_size])
+                if len(claimed):
+                    claimed_any = True
+                    yield from iterate_filings(claimed)
+            if not claimed_any:
+                return
+
+    def claim(self, acc_nos):
+        """
+        Lease filings that wait for stage and are not leased by other workers.
+        :param acc_nos: accession numbers of candidate filings
+        :return: list of claimed accession numbers in candidate order
+        """
+        now = datetime.utcnow()
+        with IndexDb.get_session() as session:
+            # Single update checks and takes leases, so concurrent workers never claim the same filing
+            session.query(Filing) \
+                .filter(Filing.acc_no.in_(acc_nos)) \
+                .filter(self.stages[self.stage]) \
+                .filter(or_(Filing.lease_owner == None, Filing.lease_expires < now)) \
+                .filter(or_(Filing.attempts == None, Filing.attempts < self.max_attempts)) \
+                .update({Filing.lease_owner: self.owner, Filing.lease_stage: self.stage,
+                         Filing.lease_expires: now + self.lease, Filing.heartbeat: now,
+                         Filing.attempts: func.coalesce(Filing.attempts, 0) + 1},
+                        synchronize_session=False)
+        with IndexDb.get_session() as session:
+            claimed = {r.acc_no for r in session.query(Filing.acc_no)
+                       .filter(Filing.acc_no.in_(acc_nos))
+                       .filter(Filing.lease_owner == self.owner)}
+        return [acc_no for acc_no in acc_nos if acc_no in claimed]
+
+    def heartbeat(self):
+        """
+        Renew all leases of this worker.
+        :return: None
+        """
+        now = datetime.utcnow()
+        with IndexDb.get_session() as session:
+            session.query(Filing) \
+                .filter(Filing.lease_owner == self.owner) \
+                .update({Filing.lease_expires: now + self.lease, Filing.heartbeat: now},
+                        synchronize_session=False)
+
+    def run_heartbeat(self):
+        while not self.stopped.wait(self.lease.total_seconds() / 3):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                print(f'{ats()} Could not renew leases: {e!r}')
+
+    def complete(self, acc_no):
+        """
+        Release lease of processed filing and reset its attempts for the next stage.
+        :param acc_no: accession number
+        :return: None
+        """
+        self.release([acc_no], {Filing.attempts: 0})
+
+    def fail(self, acc_no):
+        """
+        Release lease of filing that could not be processed, so that it is retried (attempts are kept).
+        :param acc_no: accession number
+        :return: None
+        """
+        self.release([acc_no])
+
+    def release(self, acc_nos=None, values={}):
+        """
+        Release leases of this worker.
+        :param acc_nos: accession numbers, None for all leases of this worker
+        :param values: other values to set
+        :return: None
+        """
+        with IndexDb.get_session() as session:
+            q = session.query(Filing).filter(Filing.lease_owner == self.owner)
+            if acc_nos is not None:
+                q = q.filter(Filing.acc_no.in_(acc_nos))
+            q.update({Filing.lease_owner: None, Filing.lease_stage: None, Filing.lease_expires: None, **values},
+                     synchronize_session=False)
+
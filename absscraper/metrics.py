@@ -0,0 +1,190 @@
+import os
+import json
+import threading
+from time import perf_counter
+from datetime import datetime
+from contextlib import contextmanager
+from config import defaults
+
+
+class Histogram(object):
+    """
+    Distribution of observed values (e.g. durations in seconds) over fixed cumulative buckets.
+    """
+    def __init__(self, bounds):
+        """
+        :param bounds: ascending upper bounds of buckets
+        """
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        """
+        Add single observation.
+        :param value: observed value
+        :return: None
+        """
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        """
+        Cumulative counts by upper bound, as in Prometheus histograms.
+        :return: list of (bound, count) tuples
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'buckets': {str(bound): count for bound, count in self.cumulative()}}
+
+
+class Metrics(object):
+    """
+    Run metrics: counters and histograms of pipeline stages plus throttled progress output.
+    Safe to use from worker threads. Exported per run to json and Prometheus textfile formats.
+    """
+    # Upper bounds of duration buckets in seconds
+    duration_bounds = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+    def __init__(self, progress_interval=defaults['progress_interval']):
+        """
+        :param progress_interval: min number of seconds between progress lines
+        """
+        self.progress_interval = progress_interval
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, name='abs'):
+        """
+        Start new run.
+        :param name: run name (usually name of command line utility)
+        :return: None
+        """
+        with self.lock:
+            self.name = name
+            self.started = datetime.now()
+            self.start_time = perf_counter()
+            self.counters = {}
+            self.histograms = {}
+            self.last_progress = 0.0
+
+    def inc(self, name, value=1):
+        """
+        Increase counter.
+        :param name: counter name
+        :param value: increment
+        :return: None
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """
+        Add observation to histogram.
+        :param name: histogram name
+        :param value: observed value, seconds for durations
+        :return: None
+        """
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(self.duration_bounds)
+            self.histograms[name].observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Observe duration of code block in histogram.
+        :param name: histogram name
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def progress(self, message, *args, force=False):
+        """
+        Overwrite progress line in console at most once per progress interval.
+        Message is only formatted when printed, so calling it for every record is cheap.
+        :param message: message with {} placeholders
+        :param args: placeholder values
+        :param force: print regardless of interval
+        :return: None
+        """
+        now = perf_counter()
+        if force or now - self.last_progress >= self.progress_interval:
+            self.last_progress = now
+            print(message.format(*args), end="\r")
+
+    def to_dict(self):
+        """
+        Snapshot of run metrics.
+        :return: dict
+        """
+        with self.lock:
+            return {
+                'name': self.name,
+                'started': self.started.strftime("%Y-%m-%d %H:%M:%S"),
+                'duration': perf_counter() - self.start_time,
+                'counters': dict(self.counters),
+                'histograms': {name: h.to_dict() for name, h in self.histograms.items()}
+            }
+
+    def to_prometheus(self):
+        """
+        Render run metrics in Prometheus text exposition format.
+        :return: string
+        """
+        data = self.to_dict()
+        job = data['name']
+        lines = []
+        for name, value in sorted(data['counters'].items()):
+            lines.append(f"# TYPE abs_{name}_total counter")
+            lines.append(f'abs_{name}_total{{job="{job}"}} {value}')
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            for name, h in histograms:
+                lines.append(f"# TYPE abs_{name} histogram")
+                for bound, count in h.cumulative():
+                    lines.append(f'abs_{name}_bucket{{job="{job}",le="{bound}"}} {count}')
+                lines.append(f'abs_{name}_bucket{{job="{job}",le="+Inf"}} {h.count}')
+                lines.append(f'abs_{name}_sum{{job="{job}"}} {h.sum}')
+                lines.append(f'abs_{name}_count{{job="{job}"}} {h.count}')
+        lines.append("# TYPE abs_run_duration_seconds gauge")
+        lines.append(f'abs_run_duration_seconds{{job="{job}"}} {data["duration"]}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, folder):
+        """
+        Write run metrics to <folder>/<name>.json and <folder>/<name>.prom (for node exporter textfile collector).
+        Files are replaced atomically, so that collectors never read partial files.
+        :param folder: output folder
+        :return: None
+        """
+        os.makedirs(folder, exist_ok=True)
+        outputs = {'json': json.dumps(self.to_dict(), indent=2), 'prom': self.to_prometheus()}
+        for ext, content in outputs.items():
+            path = os.path.join(folder, f"{self.name}.{ext}")
+            with open(path + '.tmp', 'w') as output_file:
+                output_file.write(content)
+            os.replace(path + '.tmp', path)
+
+
+# Metrics of current run shared by all modules
+metrics = Metrics()
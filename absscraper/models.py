@@ -1,13 +1,18 @@
+import os
 from sqlalchemy import create_engine, ForeignKey
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Date
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, Date
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 from contextlib import contextmanager
 from config import defaults
+from helpers import migrate_schema
 
 IndexBase = declarative_base()
 
+# Engines by database uri and process id
+engines = {}
+
 
 class IndexDb(object):
     """
@@ -15,7 +20,14 @@ class IndexDb(object):
     """
     def __init__(self):
         self.db_file = defaults['db_name']
-        self.engine = create_engine('sqlite:///'+self.db_file, echo=False)
+        # Index can be kept in a shared database server to distribute work among several machines
+        self.db_uri = defaults['index_db_uri'] or 'sqlite:///' + self.db_file
+        key = (self.db_uri, os.getpid())
+        if key not in engines:
+            engines[key] = create_engine(self.db_uri, echo=False)
+            # Bring index created by earlier versions up to date
+            migrate_schema(engines[key], IndexBase.metadata)
+        self.engine = engines[key]
         self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
 
     def setup(self):
@@ -56,7 +68,7 @@ class Filing(IndexBase):
     """
     __tablename__ = 'filings'
 
-    acc_no = Column(Integer, primary_key=True, unique=True, nullable=False)
+    acc_no = Column(BigInteger, primary_key=True, unique=True, nullable=False, autoincrement=False)
     cik_trust = Column(Integer, ForeignKey('companies.cik'))
     cik_filer = Column(Integer)
     url = Column(String(255), nullable=False)
@@ -67,6 +79,15 @@ class Filing(IndexBase):
     date_upd = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     # Added at a later stage after data collection had started
     skip = Column(Boolean, default=False)
+    # Content hash of downloaded document and acc_no of earlier filing with identical content
+    sha256 = Column(String(64), index=True)
+    duplicate_of = Column(BigInteger)
+    # Lease of worker downloading or parsing filing, attempts count claims since stage was last completed
+    lease_owner = Column(String(64), index=True)
+    lease_stage = Column(String(16))
+    lease_expires = Column(DateTime)
+    heartbeat = Column(DateTime)
+    attempts = Column(Integer, default=0)
 
     trust = relationship("Company", back_populates="filings")
 
@@ -92,3 +113,35 @@ class Company(IndexBase):
 
 
 Company.filings = relationship("Filing", order_by=Filing.date_filing, back_populates="trust")
+
+
+def iterate_filings(acc_nos, chunk_size=defaults['index_chunk_size']):
+    """
+    Iterate over filings and their trusts loading a chunk at a time, each in a short session.
+    Index is not locked between chunks, so it can be updated while iterating.
+    :param acc_nos: list of accession numbers in desired order
+    :param chunk_size: number of filings loaded at once
+    :return: generator of rows with Filing and Company objects
+    """
+    for i in range(0, len(acc_nos), chunk_size):
+        chunk = acc_nos[i:i + chunk_size]
+        with IndexDb.get_session() as session:
+            rows = session.query(Filing, Company) \
+                .filter(Company.cik == Filing.cik_trust) \
+                .filter(Filing.acc_no.in_(chunk)).all()
+        order = {acc_no: n for n, acc_no in enumerate(chunk)}
+        yield from sorted(rows, key=lambda row: order[row.Filing.acc_no])
+
+
+def update_filings(acc_nos, values, chunk_size=defaults['index_chunk_size']):
+    """
+    Set field values of filings in chunks.
+    :param acc_nos: list of accession numbers
+    :param values: dict of Filing columns and values
+    :param chunk_size: number of filings updated at once
+    :return: None
+    """
+    for i in range(0, len(acc_nos), chunk_size):
+        with IndexDb.get_session() as session:
+            session.query(Filing).filter(Filing.acc_no.in_(acc_nos[i:i + chunk_size])) \
+                .update(values, synchronize_session=False)
@@ -0,0 +1,119 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from helpers import ats
+from metrics import metrics
+
+
+class S3Prefetcher(object):
+    """
+    Bounded prefetch queue for filings stored in S3. Downloads next filings in background
+    threads while the current one is being processed and caps disk space taken by downloaded files.
+    """
+    def __init__(self, items, bucket, temp_path, depth=2, max_bytes=0, workers=1, manifest=None, cache=None):
+        """
+        :param items: iterable of (s3 key, payload) tuples, payload is passed through to consumer
+        :param bucket: boto3 Bucket object
+        :param temp_path: local folder for downloaded files
+        :param depth: max number of filings downloaded ahead of consumer
+        :param max_bytes: max bytes of downloaded but not yet released files (0 for no limit)
+        :param workers: number of download threads
+        :param manifest: S3Manifest of bucket answering size lookups and checking downloads, None to ask S3
+        :param cache: FileCache keeping downloaded files for later runs (requires manifest), None to always download
+        """
+        self.items = items
+        self.bucket = bucket
+        self.temp_path = temp_path
+        self.depth = max(depth, 1)
+        self.max_bytes = max_bytes
+        self.workers = max(workers, 1)
+        self.manifest = manifest
+        self.cache = cache if manifest is not None else None
+        # Bytes reserved by files being downloaded or held by consumer
+        self.reserved = 0
+        self.sizes = {}
+
+    def __iter__(self):
+        """
+        Iterate through items in original order.
+        :return: generator of (payload, local file path) tuples. File path is None if download failed.
+        """
+        items = iter(self.items)
+        next_item = next(items, None)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while next_item is not None or len(pending):
+                # Top up queue while it is not full and downloads fit into disk budget
+                while next_item is not None and len(pending) < self.depth:
+                    key, payload = next_item
+                    size = self.object_size(key)
+                    if len(pending) and self.max_bytes and self.reserved + size > self.max_bytes:
+                        break
+                    local_path = os.path.join(self.temp_path, key.split("/")[-1])
+                    self.reserved += size
+                    self.sizes[local_path] = size
+                    pending.append((payload, local_path, executor.submit(self.fetch, key, local_path)))
+                    next_item = next(items, None)
+
+                payload, local_path, future = pending.popleft()
+                if not future.result():
+                    self.release(local_path)
+                    local_path = None
+                yield payload, local_path
+
+    def object_size(self, key):
+        """
+        Look up size of an S3 object. Skips the request if disk usage is not capped.
+        :param key: S3 key
+        :return: size in bytes
+        """
+        if not self.max_bytes:
+            return 0
+        if self.manifest is not None:
+            entry = self.manifest.get(key)
+            return entry[0] if entry is not None else 0
+        try:
+            return self.bucket.Object(key).content_length
+        except Exception:
+            return 0
+
+    def fetch(self, key, local_path):
+        """
+        Download single object (runs in worker thread).
+        :param key: S3 key
+        :param local_path: local file path
+        :return: True if successful
+        """
+        entry = self.manifest.get(key, check=True) if self.manifest is not None else None
+        if self.manifest is not None and entry is None:
+            print(f'{ats()} Filing {key} is not in s3 bucket.')
+            return False
+        if self.cache is not None and self.cache.fetch(key, *entry, local_path):
+            print(f'{ats()} Using cached copy of filing {key}.')
+            return True
+        try:
+            print(f'{ats()} Downloading filing {key}...')
+            with metrics.timer('s3_download_seconds'):
+                self.bucket.download_file(key, local_path)
+        except Exception:
+            print(f'{ats()} Could not download filing {key} from s3.')
+            metrics.inc('s3_errors')
+            return False
+        if self.manifest is not None and not self.manifest.verify(key, local_path):
+            print(f'{ats()} Downloaded filing {key} does not match s3 listing.')
+            metrics.inc('s3_errors')
+            return False
+        metrics.inc('s3_bytes_downloaded', os.path.getsize(local_path))
+        if self.cache is not None:
+            self.cache.put(key, *entry, local_path)
+        return True
+
+    def release(self, local_path):
+        """
+        Remove downloaded file and free its share of disk budget.
+        :param local_path: local file path
+        :return: None
+        """
+        self.reserved -= self.sizes.pop(local_path, 0)
+        if os.path.exists(local_path):
+            os.remove(local_path)
@@ -0,0 +1,237 @@
+import os
+import sys
+import threading
+import cProfile
+import pstats
+import tracemalloc
+from time import sleep, perf_counter
+from contextlib import contextmanager
+from config import defaults
+from helpers import ats
+
+
+class Profiler(object):
+    """
+    Per-stage profiler for command line utilities. Disabled unless configured with an output folder.
+    Stages can run in several threads at once (e.g. handler partitions), results of all threads
+    running the same stage are combined and rewritten to the stage's files whenever a thread finishes.
+    Stages nested in another stage of the same thread are part of the outer stage's profile and are only
+    timed, wall times of all stages are written to timings.txt.
+    Modes:
+        cprofile - deterministic profiling with cProfile, saved to <stage>.pstats
+        sample - statistical profiling by sampling call stacks, saved to <stage>.collapsed
+                 (collapsed stack format read by flamegraph.pl, speedscope and similar tools)
+    """
+    modes = ('cprofile', 'sample')
+
+    def __init__(self):
+        self.folder = None
+        self.mode = 'cprofile'
+        self.memory = False
+        self.interval = defaults['profile_interval']
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.samples = {}
+        self.timings = {}
+        # Stage being profiled and reusable profiler of each thread
+        self.local = threading.local()
+
+    def configure(self, folder, mode='cprofile', memory=False, interval=defaults['profile_interval']):
+        """
+        Enable profiling.
+        :param folder: output folder, None to keep profiling disabled
+        :param mode: cprofile or sample
+        :param memory: take tracemalloc snapshot at the end of each stage
+        :param interval: seconds between stack samples in sample mode
+        :return: None
+        """
+        self.folder = folder
+        self.mode = mode
+        self.memory = memory
+        self.interval = interval
+        if folder is None:
+            return
+        os.makedirs(folder, exist_ok=True)
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Profile code block as part of named stage.
+        :param name: stage name, e.g. crawl, download, parse, flatten
+        """
+        if self.folder is None:
+            yield
+            return
+        start = perf_counter()
+        if getattr(self.local, 'stage', None) is not None:
+            # Nested stage, its calls are already recorded by outer stage
+            try:
+                yield
+            finally:
+                self.save_timing(name, perf_counter() - start)
+            return
+        self.local.stage = name
+        try:
+            if self.memory:
+                tracemalloc.reset_peak()
+            if self.mode == 'sample':
+                sampler = StackSampler(threading.get_ident(), self.interval)
+                sampler.start()
+                try:
+                    yield
+                finally:
+                    sampler.stop()
+                    self.save_samples(name, sampler.counts)
+            else:
+                profile = self.thread_profile()
+                try:
+                    profile.enable()
+                except ValueError:
+                    # Python 3.12+ allows one active profiler per process, stage of another thread holds it
+                    profile = None
+                try:
+                    yield
+                finally:
+                    if profile is not None:
+                        profile.disable()
+                        self.save_stats(name, profile)
+            if self.memory:
+                self.save_snapshot(name)
+        finally:
+            self.local.stage = None
+            self.save_timing(name, perf_counter() - start)
+
+    def thread_profile(self):
+        """
+        Profiler of current thread, cleared of calls recorded by previous stages.
+        :return: cProfile.Profile object
+        """
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+        profile.clear()
+        return profile
+
+    def save_timing(self, name, seconds):
+        """
+        Add wall time of stage run and write times of all stages to timings.txt.
+        :param name: stage name
+        :param seconds: wall time of run
+        :return: None
+        """
+        with self.lock:
+            runs, total = self.timings.get(name, (0, 0.0))
+            self.timings[name] = (runs + 1, total + seconds)
+            with open(os.path.join(self.folder, 'timings.txt'), 'w') as output_file:
+                for stage, (runs, total) in sorted(self.timings.items()):
+                    output_file.write(f'{stage} {runs} {total:.3f}\n')
+
+    def save_stats(self, name, profile):
+        """
+        Add profile to stage stats and write them to <stage>.pstats.
+        :param name: stage name
+        :param profile: disabled cProfile.Profile object
+        :return: None
+        """
+        with self.lock:
+            if name in self.stats:
+                self.stats[name].add(profile)
+            else:
+                self.stats[name] = pstats.Stats(profile)
+            path = os.path.join(self.folder, f'{name}.pstats')
+            self.stats[name].dump_stats(path)
+        print(f'{ats()} Profile of stage {name} saved to {path}')
+
+    def save_samples(self, name, counts):
+        """
+        Add sampled stacks to stage samples and write them to <stage>.collapsed.
+        :param name: stage name
+        :param counts: dict of sample counts by collapsed stack
+        :return: None
+        """
+        with self.lock:
+            samples = self.samples.setdefault(name, {})
+            for stack, count in counts.items():
+                samples[stack] = samples.get(stack, 0) + count
+            path = os.path.join(self.folder, f'{name}.collapsed')
+            with open(path, 'w') as output_file:
+                for stack, count in sorted(samples.items()):
+                    output_file.write(f'{stack} {count}\n')
+        print(f'{ats()} Stack samples of stage {name} saved to {path}')
+
+    def save_snapshot(self, name):
+        """
+        Write tracemalloc snapshot to <stage>.tracemalloc and top allocation sites to <stage>-memory.txt.
+        :param name: stage name
+        :return: None
+        """
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            snapshot.dump(os.path.join(self.folder, f'{name}.tracemalloc'))
+            with open(os.path.join(self.folder, f'{name}-memory.txt'), 'w') as output_file:
+                output_file.write(f'Traced memory: {current / 1024 ** 2:.1f} Mb, peak {peak / 1024 ** 2:.1f} Mb\n')
+                for stat in snapshot.statistics('lineno')[:25]:
+                    output_file.write(f'{stat}\n')
+
+
+class StackSampler(threading.Thread):
+    """
+    Background thread sampling call stack of another thread at regular intervals.
+    """
+    def __init__(self, thread_id, interval):
+        """
+        :param thread_id: identifier of sampled thread
+        :param interval: seconds between samples
+        """
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = self.collapse(frame)
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+            sleep(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    @staticmethod
+    def collapse(frame):
+        """
+        Render call stack as semicolon-separated list of functions, outermost first.
+        :param frame: innermost frame
+        :return: string
+        """
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+
+def add_profile_arguments(ap):
+    """
+    Add profiling options to command line argument parser.
+    :param ap: ArgumentParser object
+    :return: None
+    """
+    ap.add_argument("--profile", required=False, type=str, default=None,
+                    help="profile stages and save results to this folder")
+    ap.add_argument("--profile-mode", required=False, type=str, default='cprofile',
+                    help="cprofile (deterministic, default) or sample (collapsed stacks for flame graphs)")
+    ap.add_argument("--profile-memory", required=False, action='store_true', default=False,
+                    help="save tracemalloc snapshot at the end of each profiled stage")
+
+
+# Profiler shared by all modules
+profiler = Profiler()
@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+from config import defaults
+from helpers import ats
+from metrics import metrics
+
+
+class S3Manifest(object):
+    """
+    Local listing of objects in S3 bucket with their sizes and ETags. Built with paginated list requests
+    (1000 objects per request) and cached in a local file, so that existence checks, skip decisions and
+    integrity checks of downloads do not need a request per object. Objects uploaded by this process are
+    added to the manifest. Objects uploaded by others since the listing are missing from it, so callers
+    that cannot treat a miss as absence confirm it with a single request (check=True).
+    """
+    def __init__(self, bucket, path=None, max_age=defaults['s3_manifest_max_age']):
+        """
+        :param bucket: boto3 Bucket object
+        :param path: local cache file, defaults to s3_manifest_filename in project folder
+        :param max_age: seconds after which cached listing is rebuilt
+        """
+        self.bucket = bucket
+        self.path = path or os.path.join(os.path.dirname(__file__), defaults['s3_manifest_filename'])
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # Size and ETag (None for own uploads until next listing) by key
+        self.objects = {}
+        self.built = None
+        self.changed = False
+
+    def load(self):
+        """
+        Load cached listing, rebuild it if missing, stale or made for another bucket.
+        :return: self
+        """
+        try:
+            with open(self.path, 'r') as input_file:
+                cache = json.load(input_file)
+            built = datetime.fromisoformat(cache['built'])
+            if cache['bucket'] == self.bucket.name and (datetime.utcnow() - built).total_seconds() < self.max_age:
+                self.objects = {key: tuple(value) for key, value in cache['objects'].items()}
+                self.built = built
+                return self
+        except (OSError, ValueError, KeyError):
+            pass
+        self.refresh()
+        return self
+
+    def refresh(self):
+        """
+        List all objects of bucket and save listing to cache file.
+        :return: None
+        """
+        print(f'{ats()} Listing objects of s3 bucket {self.bucket.name}...')
+        objects = {}
+        paginator = self.bucket.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket.name):
+            metrics.inc('s3_list_requests')
+            for item in page.get('Contents', []):
+                objects[item['Key']] = (item['Size'], item['ETag'].strip('"'))
+        with self.lock:
+            self.objects = objects
+            self.built = datetime.utcnow()
+            self.changed = True
+        self.save()
+        print(f'{ats()} Listed {len(objects)} object(s).')
+
+    def save(self):
+        """
+        Write listing to cache file if it changed.
+        :return: None
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            cache = {'bucket': self.bucket.name, 'built': self.built.isoformat(), 'objects': self.objects}
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as output_file:
+                json.dump(cache, output_file, separators=(',', ':'))
+            os.replace(temp_path, self.path)
+            self.changed = False
+
+    def get(self, key, check=False):
+        """
+        Look up object in manifest.
+        :param key: S3 key
+        :param check: confirm missing object with a request to S3 (and add it to manifest if found)
+        :return: tuple (size, ETag) or None if object does not exist
+        """
+        with self.lock:
+            entry = self.objects.get(key)
+        if entry is not None or not check:
+            return entry
+        try:
+            obj = self.bucket.Object(key)
+            obj.load()
+        except Exception:
+            return None
+        metrics.inc('s3_manifest_misses')
+        self.add(key, obj.content_length, obj.e_tag.strip('"'))
+        return self.get(key)
+
+    def add(self, key, size, etag=None):
+        """
+        Record uploaded object.
+        :param key: S3 key
+        :param size: size in bytes
+        :param etag: ETag if known
+        :return: None
+        """
+        with self.lock:
+            self.objects[key] = (size, etag)
+            self.changed = True
+
+    def clear(self):
+        """
+        Forget all objects (after bucket was emptied).
+        :return: None
+        """
+        with self.lock:
+            self.objects = {}
+            self.built = datetime.utcnow()
+            self.changed = True
+        self.save()
+
+    def verify(self, key, local_path):
+        """
+        Check downloaded copy of object against manifest. Size is always compared, content is compared
+        with ETag when it is an MD5 hash (objects uploaded in a single part).
+        :param key: S3 key
+        :param local_path: local file path
+        :return: True if file matches manifest entry or object is not in manifest
+        """
+        entry = self.get(key)
+        if entry is None:
+            return True
+        size, etag = entry
+        if os.path.getsize(local_path) != size:
+            return False
+        if etag is None or '-' in etag:
+            return True
+        md5 = hashlib.md5()
+        with open(local_path, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(1024 ** 2), b''):
+                md5.update(chunk)
+        return md5.hexdigest() == etag
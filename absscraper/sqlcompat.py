@@ -0,0 +1,59 @@
+from sqlalchemy import String, cast
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+
+class any_value(FunctionElement):
+    """
+    Aggregate returning value of a column from any row in group. Compiled to native ANY_VALUE
+    on MySQL and DuckDB and to MIN elsewhere.
+    """
+    name = 'any_value'
+
+    @property
+    def type(self):
+        return self.clauses.clauses[0].type
+
+
+@compiles(any_value)
+def compile_any_value(element, compiler, **kw):
+    return "min(%s)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(any_value, 'mysql')
+@compiles(any_value, 'duckdb')
+def compile_any_value_native(element, compiler, **kw):
+    return "any_value(%s)" % compiler.process(element.clauses, **kw)
+
+
+class exact(FunctionElement):
+    """
+    String expression compared byte by byte. Compiled to BINARY operator on MySQL, whose default
+    collations ignore case, and left as is elsewhere.
+    """
+    name = 'exact'
+
+    @property
+    def type(self):
+        return self.clauses.clauses[0].type
+
+
+@compiles(exact)
+def compile_exact(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)
+
+
+@compiles(exact, 'mysql')
+def compile_exact_mysql(element, compiler, **kw):
+    return "BINARY %s" % compiler.process(element.clauses, **kw)
+
+
+def trust_asset_key(trust_cik, asset_number):
+    """
+    Build unique loan identifier '<trust cik>_<asset number>' as sql expression.
+    Renders to CONCAT on MySQL and to || operator on other databases.
+    :param trust_cik: trust cik column
+    :param asset_number: asset number column
+    :return: sql expression
+    """
+    return cast(trust_cik, String) + "_" + asset_number
@@ -0,0 +1,363 @@
+import argparse
+import os
+import random
+import sys
+from datetime import date
+from decimal import Decimal
+from sqlalchemy import Integer, Boolean, Date, String
+from sqlalchemy.types import DECIMAL
+from helpers import ats
+from assets import Autoloan, Autolease
+
+
+class AbsGenerator(object):
+    """
+    Generator of synthetic ABS-EE asset data xml files. Produces a panel of loans (leases)
+    reported over a number of consecutive months, one file per month.
+    """
+
+    namespace = 'http://www.sec.gov/edgar/document/absee/{asset_type}/assetdata'
+
+    # Columns that are not part of xml data
+    skip_columns = {'autoloanId', 'autoleaseId', 'filingAccNo', 'loanId', 'dateAdd'}
+
+    # Column names differing from xml tag names
+    tag_names = {
+        'autolease': {
+            'reportingPeriodBeginDate': 'reportingPeriodBeginningDate',
+            'reportingPeriodEndDate': 'reportingPeriodEndingDate',
+            'DemandResolutionDate': 'demandResolutionDate'
+        }
+    }
+
+    # Fields changing from month to month, values are set by generator logic
+    dynamic_fields = {
+        'autoloan': {
+            'begin_date': 'reportingPeriodBeginningDate',
+            'end_date': 'reportingPeriodEndingDate',
+            'begin_balance': 'reportingPeriodBeginningLoanBalanceAmount',
+            'end_balance': 'reportingPeriodActualEndBalanceAmount',
+            'principal': 'actualPrincipalCollectedAmount',
+            'remaining_term': 'remainingTermToMaturityNumber',
+            'delinquency': 'currentDelinquencyStatus',
+            'zero_balance_code': 'zeroBalanceCode',
+            'zero_balance_date': 'zeroBalanceEffectiveDate',
+            'charged_off': 'chargedoffPrincipalAmount',
+            'repossessed': 'repossessedIndicator'
+        },
+        'autolease': {
+            'begin_date': 'reportingPeriodBeginningDate',
+            'end_date': 'reportingPeriodEndingDate',
+            'begin_balance': None,
+            'end_balance': 'reportingPeriodSecuritizationValueAmount',
+            'principal': 'totalActualAmountPaid',
+            'remaining_term': 'remainingTermNumber',
+            'delinquency': 'currentDelinquencyStatus',
+            'zero_balance_code': 'zeroBalanceCode',
+            'zero_balance_date': 'zeroBalanceEffectiveDate',
+            'charged_off': 'chargedOffAmount',
+            'repossessed': None
+        }
+    }
+
+    manufacturers = {
+        'Toyota': ['Camry', 'Corolla', 'RAV4', 'Tacoma'],
+        'Honda': ['Accord', 'Civic', 'CR-V', 'Pilot'],
+        'Ford': ['F-150', 'Escape', 'Focus', 'Explorer'],
+        'Nissan': ['Altima', 'Rogue', 'Sentra', 'Pathfinder']
+    }
+
+    states = ['CA', 'TX', 'FL', 'NY', 'PA', 'IL', 'OH', 'GA', 'NC', 'MI']
+
+    def __init__(self, asset_type='autoloan', n_loans=1000, n_months=1, start=date(2017, 1, 1), seed=0):
+        """
+        :param asset_type: autoloan or autolease
+        :param n_loans: number of loans in pool at first reporting month
+        :param n_months: number of monthly files in panel
+        :param start: first reporting month
+        :param seed: random seed, same seed produces same files
+        """
+        self.asset_type = asset_type
+        self.n_loans = n_loans
+        self.n_months = n_months
+        self.start = start
+        self.seed = seed
+        model = Autoloan if asset_type == 'autoloan' else Autolease
+        self.special_fields = model.special_fields
+        renames = self.tag_names.get(asset_type, {})
+        # List of (tag, column type) of monthly fields followed by static fields
+        columns = list(model.__table__.columns)
+        if model.static_model is not None:
+            columns += [c for c in model.static_model.__table__.columns if c.key not in model.static_model.meta_fields]
+        self.fields = [(renames.get(c.key, c.key), c.info.get('encoded', c.type)) for c in columns
+                       if c.key not in self.skip_columns]
+
+    def generate(self, folder):
+        """
+        Write panel of monthly files to folder.
+        :param folder: output folder
+        :return: list of file paths
+        """
+        os.makedirs(folder, exist_ok=True)
+        loans = [self.new_loan(i) for i in range(1, self.n_loans + 1)]
+        paths = []
+        for month in range(self.n_months):
+            path = os.path.join(folder, f'{self.asset_type}_{month + 1:03}.xml')
+            with open(path, 'w') as datafile:
+                self.write_month(datafile, loans, month)
+            paths.append(path)
+            # Loans paid off or charged off in this month are not reported further
+            loans = [loan for loan in loans if loan['balance'] > 0]
+        return paths
+
+    def generate_size(self, path, size_bytes):
+        """
+        Write a single month file of approximately given size.
+        :param path: output file path
+        :param size_bytes: target file size in bytes
+        :return: number of records written
+        """
+        # Estimate record size from a small sample
+        sample = [self.new_loan(i) for i in range(1, 101)]
+        for loan in sample:
+            self.step(loan, 0)
+        record_size = sum(len(self.render(loan, 0)) for loan in sample) / len(sample)
+        self.n_loans = max(int(size_bytes / record_size), 1)
+        loans = [self.new_loan(i) for i in range(1, self.n_loans + 1)]
+        with open(path, 'w') as datafile:
+            self.write_month(datafile, loans, 0)
+        return self.n_loans
+
+    def write_month(self, datafile, loans, month):
+        """
+        Write one monthly file.
+        :param datafile: file handle
+        :param loans: list of loan state dicts, updated in place
+        :param month: month number counting from start
+        :return: None
+        """
+        ns = self.namespace.format(asset_type=self.asset_type)
+        datafile.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<assetData xmlns="{ns}">\n')
+        for loan in loans:
+            self.step(loan, month)
+            datafile.write(self.render(loan, month))
+        datafile.write('</assetData>\n')
+
+    def new_loan(self, number):
+        """
+        Build static attributes of a loan.
+        :param number: asset number
+        :return: loan state dict
+        """
+        rnd = random.Random(self.seed * 1000003 + number)
+        make = rnd.choice(sorted(self.manufacturers))
+        term = rnd.choice([36, 48, 60, 72])
+        amount = Decimal(rnd.randrange(800000, 5000000)) / 100
+        age = rnd.randrange(1, 24)
+        orig_month = (self.start.year * 12 + self.start.month - 1) - age
+        end_month = orig_month + term
+        return {
+            'rnd': rnd,
+            'number': number,
+            'filler': {},
+            'static': {
+                'assetTypeNumber': 'Synthetic pool',
+                'assetNumber': f'{number:010}',
+                'originatorName': 'Synthetic Originator',
+                'originationDate': date(orig_month // 12, orig_month % 12 + 1, 1),
+                'originalLoanAmount': amount,
+                'acquisitionCost': amount,
+                'originalLoanTerm': term,
+                'loanMaturityDate': date(end_month // 12, end_month % 12 + 1, 1),
+                'scheduledTerminationDate': date(end_month // 12, end_month % 12 + 1, 1),
+                'originalFirstPaymentDate': date((orig_month + 1) // 12, (orig_month + 1) % 12 + 1, 1),
+                'originalInterestRatePercentage': Decimal(rnd.randrange(100, 1500)) / 10000,
+                'paymentToIncomePercentage': Decimal(rnd.randrange(200, 2500)) / 10000,
+                'vehicleValueAmount': (amount * Decimal('1.1')).quantize(Decimal('0.01')),
+                'originalLeaseTermNumber': term,
+                'vehicleManufacturerName': make,
+                'vehicleModelName': rnd.choice(self.manufacturers[make]),
+                'vehicleModelYear': str(2010 + rnd.randrange(0, 9)),
+                'obligorCreditScore': str(rnd.randrange(550, 850)),
+                'obligorGeographicLocation': rnd.choice(self.states),
+                'lesseeGeographicLocation': rnd.choice(self.states),
+            },
+            'balance': amount * Decimal(term - age) / term,
+            'term': term - age,
+            'delinquency': 0,
+            'zero_balance_code': None,
+            'zero_balance_date': None,
+            'charged_off': Decimal(0),
+            'repossessed': False
+        }
+
+    def step(self, loan, month):
+        """
+        Advance loan state by one month.
+        :param loan: loan state dict
+        :param month: month number counting from start
+        :return: None
+        """
+        rnd = loan['rnd']
+        period = self.period(month)
+        loan['begin_balance'] = loan['balance']
+        # Delinquency moves by roughly a month at a time
+        roll = rnd.random()
+        if loan['delinquency'] == 0:
+            loan['delinquency'] = 30 if roll < 0.03 else 0
+        elif roll < 0.4:
+            loan['delinquency'] = 0
+        elif roll < 0.9:
+            loan['delinquency'] += 30
+        # Payment
+        principal = Decimal(0) if loan['delinquency'] else (loan['balance'] / max(loan['term'], 1))
+        loan['term'] = max(loan['term'] - 1, 0)
+        if rnd.random() < 0.015 and not loan['delinquency']:
+            # Prepayment
+            principal = loan['balance']
+            loan['zero_balance_code'] = '1'
+        elif loan['delinquency'] >= 120:
+            # Charge-off and repossession
+            loan['charged_off'] = loan['balance']
+            loan['repossessed'] = True
+            principal = loan['balance']
+            loan['zero_balance_code'] = '3'
+        elif loan['term'] == 0:
+            principal = loan['balance']
+            loan['zero_balance_code'] = '1'
+        loan['principal'] = principal.quantize(Decimal('0.01'))
+        loan['balance'] = (loan['balance'] - principal).quantize(Decimal('0.01'))
+        if loan['zero_balance_code'] is not None:
+            loan['balance'] = Decimal(0)
+            loan['zero_balance_date'] = period[1]
+
+    def period(self, month):
+        """
+        Reporting period boundaries.
+        :param month: month number counting from start
+        :return: (first day, last day) tuple of dates
+        """
+        m = self.start.year * 12 + self.start.month - 1 + month
+        begin = date(m // 12, m % 12 + 1, 1)
+        end = date.fromordinal(date((m + 1) // 12, (m + 1) % 12 + 1, 1).toordinal() - 1)
+        return begin, end
+
+    def render(self, loan, month):
+        """
+        Render xml of one asset record.
+        :param loan: loan state dict
+        :param month: month number counting from start
+        :return: xml string
+        """
+        roles = self.dynamic_fields[self.asset_type]
+        begin, end = self.period(month)
+        values = dict(loan['static'])
+        values.update({
+            roles['begin_date']: begin,
+            roles['end_date']: end,
+            roles['end_balance']: loan['balance'],
+            roles['principal']: loan['principal'],
+            roles['remaining_term']: loan['term'],
+            roles['delinquency']: loan['delinquency'],
+            roles['charged_off']: loan['charged_off'],
+            roles['zero_balance_code']: loan['zero_balance_code'],
+            roles['zero_balance_date']: loan['zero_balance_date'],
+        })
+        if roles['begin_balance']:
+            values[roles['begin_balance']] = loan['begin_balance']
+        if roles['repossessed']:
+            values[roles['repossessed']] = loan['repossessed']
+        rnd = loan['rnd']
+        parts = ['<assets>']
+        for tag, col_type in self.fields:
+            if tag in values:
+                value = values[tag]
+            elif tag in loan['filler']:
+                value = loan['filler'][tag]
+            else:
+                # Fields not covered by generator logic keep the same random value in every month
+                if tag in self.special_fields and self.special_fields[tag] == 'Unlimited':
+                    value = str(rnd.randrange(1, 4))
+                else:
+                    value = self.filler(col_type, rnd)
+                loan['filler'][tag] = value
+            if value is None:
+                continue
+            parts.append(f'<{tag}>{self.format(tag, value)}</{tag}>')
+        parts.append('</assets>\n')
+        return ''.join(parts)
+
+    def filler(self, col_type, rnd):
+        """
+        Random value for fields not covered by generator logic.
+        :param col_type: SQLAlchemy column type
+        :param rnd: random.Random instance
+        :return: value or None if field should be omitted
+        """
+        if isinstance(col_type, Boolean):
+            return rnd.random() < 0.5
+        if isinstance(col_type, Date):
+            return date(2020, rnd.randrange(1, 13), 1)
+        if isinstance(col_type, DECIMAL):
+            return Decimal(rnd.randrange(0, 100000)) / 100
+        if isinstance(col_type, Integer):
+            return rnd.randrange(0, 100)
+        if isinstance(col_type, String):
+            return str(rnd.randrange(1, 10))[:col_type.length]
+        return None
+
+    def format(self, tag, value):
+        """
+        Format value the way it appears in ABS-EE filings.
+        :param tag: xml tag
+        :param value: python value
+        :return: string
+        """
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, date):
+            if self.special_fields.get(tag) == 'Date2':
+                # MM/YYYY
+                return value.strftime('%m/%Y')
+            # MM-DD-YYYY
+            return value.strftime('%m-%d-%Y')
+        return str(value)
+
+
+def main():
+
+    ap = argparse.ArgumentParser(description="Generator of synthetic ABS-EE asset data.")
+
+    ap.add_argument("-a", "--asset-type", required=False, type=str, default='autoloan',
+                    help="asset type: autoloan (default) or autolease")
+    ap.add_argument("-l", "--loans", required=False, type=int, default=1000,
+                    help="number of loans in pool")
+    ap.add_argument("-m", "--months", required=False, type=int, default=1,
+                    help="number of monthly files")
+    ap.add_argument("-b", "--size-mb", required=False, type=float, default=0,
+                    help="generate single file of approximately this size (overrides -l and -m)")
+    ap.add_argument("-o", "--output", required=False, type=str, default='synthetic',
+                    help="output folder")
+    ap.add_argument("--seed", required=False, type=int, default=0,
+                    help="random seed")
+
+    args = vars(ap.parse_args())
+
+    if args['asset_type'] not in ('autoloan', 'autolease'):
+        print("Asset type can be autoloan or autolease.")
+        ap.print_help()
+        sys.exit(2)
+
+    generator = AbsGenerator(args['asset_type'], args['loans'], args['months'], seed=args['seed'])
+    if args['size_mb']:
+        os.makedirs(args['output'], exist_ok=True)
+        path = os.path.join(args['output'], f"{args['asset_type']}_001.xml")
+        n = generator.generate_size(path, int(args['size_mb'] * 1024 ** 2))
+        print(f"{ats()} Generated {path} with {n} records.")
+    else:
+        paths = generator.generate(args['output'])
+        print(f"{ats()} Generated {len(paths)} file(s) in {args['output']}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import pandas as pd
+from sqlalchemy import Date, String, select
+from config import defaults
+from assets import AssetFiling, Autoloan, AutoloanStatic, AutoloanFlat, Dictionary, Loan, period_filter, \
+    encoded_fields, static_fields
+
+
+class FrameFlattener(object):
+    """
+    In-process engine aggregating auto loan panel into flat records with vectorized pandas group-by.
+    Panel is read in columnar batches from the database or from Parquet files. Each batch is aggregated
+    on its own and folded into a running aggregate, so memory is bounded by batch size and number of loans.
+    Static attributes of loans are joined from the loan dimension in the database.
+    """
+    def __init__(self, parquet_path=None, chunk_size=defaults['vector_chunk_size']):
+        """
+        :param parquet_path: file or folder with Parquet files holding autoloans table, database is used if None
+        :param chunk_size: number of panel rows read at once
+        """
+        self.parquet_path = parquet_path
+        self.chunk_size = chunk_size
+        flat_fields = [c.key for c in AutoloanFlat.__table__.columns]
+        # Fields taken over from panel (trust cik comes from filings)
+        self.panel_fields = [f for f in flat_fields if f in Autoloan.__table__.columns and f != 'trustCik']
+        self.read_fields = self.panel_fields + ['filingAccNo', 'reportingPeriodEndingDate', 'currentDelinquencyStatus']
+        # Fields taken over from loan dimension
+        self.static_fields = [f for f in flat_fields if f in static_fields(Autoloan)]
+        # Any value of fields constant over a loan's records will do, changing fields follow merge rules
+        self.rules = {f: AutoloanFlat.merge_rules.get(f, 'first') for f in flat_fields
+                      if f not in ('loanId', 'trustAssetNumber') and f not in self.static_fields}
+        self.date_fields = [c.key for c in AutoloanFlat.__table__.columns if isinstance(c.type, Date)]
+        self.text_rules = {f: r for f, r in self.rules.items()
+                           if r != 'first' and isinstance(AutoloanFlat.__table__.c[f].type, String)}
+
+    def flatten(self, session, acc_nos, bucket=0, buckets=1):
+        """
+        Aggregate panel data of filings into flat records.
+        :param session: database session
+        :param acc_nos: accession numbers of filings to aggregate
+        :param bucket: loan id bucket
+        :param buckets: total number of buckets, 1 for no bucketing
+        :return: DataFrame with columns of flat table ordered by loan id
+        """
+        q = session.query(AssetFiling.accNo, AssetFiling.trustCik, AssetFiling.dateFiling) \
+            .filter(AssetFiling.accNo.in_(acc_nos))
+        filings = pd.DataFrame.from_records(q.all(), columns=['filingAccNo', 'trustCik', 'dateFirstFiling'])
+        # Original strings of dictionary-encoded fields by value id
+        encoded = [f for f in encoded_fields(Autoloan) if f in self.read_fields] + \
+                  [f for f in encoded_fields(AutoloanStatic) if f in self.static_fields]
+        values = {f: {} for f in encoded}
+        for r in session.query(Dictionary).filter(Dictionary.field.in_(encoded)):
+            values[r.field][r.valueId] = r.value
+        panel_values = {f: mapping for f, mapping in values.items() if f in self.read_fields}
+        # Running aggregate, each batch is folded in as soon as it is read
+        frame = None
+        for batch in self.batches(session, acc_nos, bucket, buckets):
+            if len(batch) == 0:
+                continue
+            partial = self.aggregate(self.prepare(batch, filings, panel_values))
+            frame = partial if frame is None else self.aggregate(pd.concat([frame, partial]).reset_index())
+        if frame is None:
+            return pd.DataFrame(columns=[c.key for c in AutoloanFlat.__table__.columns])
+        frame = frame.join(self.static(session, filings['trustCik'].unique(), bucket, buckets, values)).reset_index()
+        frame['trustAssetNumber'] = frame['trustCik'].astype(str) + '_' + frame['assetNumber']
+        return frame[[c.key for c in AutoloanFlat.__table__.columns]]
+
+    def batches(self, session, acc_nos, bucket, buckets):
+        """
+        Read needed panel columns in batches.
+        :return: generator of DataFrames
+        """
+        if self.parquet_path:
+            import pyarrow.dataset as ds
+            dataset = ds.dataset(self.parquet_path, format='parquet')
+            for batch in dataset.to_batches(columns=self.read_fields, filter=ds.field('filingAccNo').isin(acc_nos),
+                                            batch_size=self.chunk_size):
+                batch = batch.to_pandas()
+                if buckets > 1:
+                    batch = batch[batch['loanId'] % buckets == bucket]
+                yield batch
+            return
+        table = Autoloan.__table__
+        q = select([table.c[f] for f in self.read_fields]) \
+            .where(table.c.filingAccNo.in_(acc_nos)) \
+            .where(period_filter(session, table.c.reportingPeriodEndingDate, acc_nos))
+        if buckets > 1:
+            q = q.where(table.c.loanId % buckets == bucket)
+        result = session.execute(q.execution_options(stream_results=True))
+        while True:
+            rows = result.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records(rows, columns=self.read_fields)
+
+    def static(self, session, trust_ciks, bucket, buckets, values):
+        """
+        Read static attributes of trusts' loans from loan dimension.
+        :param session: database session
+        :param trust_ciks: trust ciks
+        :param bucket: loan id bucket
+        :param buckets: total number of buckets, 1 for no bucketing
+        :param values: dict of original strings by value id for each dictionary-encoded field
+        :return: DataFrame with static fields of flat table indexed by loan id
+        """
+        table = AutoloanStatic.__table__
+        q = select([table.c.loanId] + [table.c[f] for f in self.static_fields]) \
+            .select_from(table.join(Loan.__table__, Loan.loanId == table.c.loanId)) \
+            .where(Loan.trustCik.in_([int(cik) for cik in trust_ciks]))
+        if buckets > 1:
+            q = q.where(table.c.loanId % buckets == bucket)
+        frame = pd.DataFrame.from_records(session.execute(q).fetchall(), columns=['loanId'] + self.static_fields,
+                                          index='loanId')
+        for field in self.static_fields:
+            if field in values:
+                frame[field] = frame[field].map(values[field])
+            elif field in self.date_fields:
+                frame[field] = pd.to_datetime(frame[field])
+        return frame
+
+    def prepare(self, batch, filings, values):
+        """
+        Add filing data and fields derived from monthly observations to panel batch.
+        :param batch: DataFrame with panel columns
+        :param filings: DataFrame with trust cik and filing date by accession number
+        :param values: dict of original strings by value id for each dictionary-encoded field
+        :return: DataFrame with columns of flat table
+        """
+        frame = batch.merge(filings, on='filingAccNo', how='left')
+        for field, mapping in values.items():
+            # Parquet files exported before encoding hold original strings
+            if pd.api.types.is_numeric_dtype(frame[field]):
+                frame[field] = frame[field].map(mapping)
+        period = pd.to_datetime(frame['reportingPeriodEndingDate'])
+        status = frame['currentDelinquencyStatus']
+        repossessed = frame['repossessedIndicator'].astype('boolean')
+        frame['repossessedIndicator'] = repossessed
+        frame['delinquency30Days'] = period.where(status > 30)
+        frame['delinquency90Days'] = period.where(status > 90)
+        frame['repossessedDate'] = period.where(repossessed.fillna(False))
+        for field in self.date_fields:
+            if field in self.rules:
+                frame[field] = pd.to_datetime(frame[field])
+        return frame[['loanId'] + list(self.rules)]
+
+    def aggregate(self, frame):
+        """
+        Group records by loan. Aggregates are idempotent, so partial results can be aggregated again.
+        :param frame: DataFrame with loan id column
+        :return: DataFrame indexed by loan id
+        """
+        result = frame.groupby('loanId', sort=True).agg(
+            {f: r for f, r in self.rules.items() if f not in self.text_rules})
+        for field, rule in self.text_rules.items():
+            # Min and max of strings are not vectorized in pandas, take first value in sorted order instead
+            values = frame[['loanId', field]].dropna().sort_values(field, ascending=rule == 'min')
+            result[field] = values.groupby('loanId')[field].first()
+        return result[list(self.rules)]
+
+    def records(self, frame):
+        """
+        Convert aggregated frame to list of dicts suitable for bulk insert.
+        :param frame: DataFrame with columns of flat table
+        :return: list of dicts
+        """
+        frame = frame.copy()
+        for field in self.date_fields:
+            frame[field] = frame[field].dt.date
+        frame = frame.astype(object).where(frame.notna(), None)
+        return frame.to_dict('records')